@@ -0,0 +1,163 @@
+import asyncio
+import time
+from typing import List,Optional,Tuple
+
+import metrics
+from checkpoints import CrawlRun
+from crawler_service import CrawlerService
+from models import RepositoryRecord
+from search_batcher import AsyncSearchBatcher
+from shard_planner import QueryShard
+
+
+class AsyncCrawlerService(CrawlerService):
+
+    def _search_batcher(self,max_batch:int,linger:float):
+        return AsyncSearchBatcher(self._api_client,max_batch,linger)
+
+    def crawl(self,target_count:int=100_000,batch_size:int=100,resume:bool=False):
+        return asyncio.run(self.crawl_async(target_count,batch_size,resume))
+
+    async def crawl_async(self,target_count:int=100_000,batch_size:int=100,resume:bool=False):
+
+        start_time = time.time()
+
+        try:
+            run = self._resume_run() if resume else None
+            if run is None:
+                run = self._start_run(await self._planner.plan_async(target_count), target_count, batch_size)
+
+            pipeline=self._start_writer(expected_rows=run.target_count)
+            try:
+                # max_workers bounds requests in flight rather than threads.
+                semaphore = asyncio.Semaphore(self._max_workers)
+                await asyncio.gather(*(
+                    self._crawl_shard(shard, run.cursors.get(shard.key), semaphore, run, start_time)
+                    for shard in run.pending_shards()
+                ))
+            finally:
+                await asyncio.to_thread(self._stop_writer, pipeline)
+        finally:
+            await self._api_client.aclose()
+
+        if self._total_crawled < run.target_count:
+            print(f"All shards exhausted. Total crawled: {self._total_crawled}")
+
+        self._finish_run(run)
+        return self._print_summary(start_time)
+
+    def work(self,run_key:str,target_count:int=100_000,batch_size:int=100)->int:
+        return asyncio.run(self.work_async(run_key,target_count,batch_size))
+
+    async def work_async(self,run_key:str,target_count:int=100_000,batch_size:int=100)->int:
+
+        start_time = time.time()
+
+        try:
+            run = await self._join_run_async(run_key, target_count, batch_size)
+
+            pipeline=self._start_writer(expected_rows=run.target_count)
+            self._coordinator.start_heartbeat(run)
+            try:
+                semaphore = asyncio.Semaphore(self._max_workers)
+                await asyncio.gather(*(
+                    self._work_shards(semaphore, run, start_time) for _ in range(self._max_workers)
+                ))
+            finally:
+                await asyncio.to_thread(self._stop_writer, pipeline)
+                self._coordinator.stop_heartbeat()
+                await asyncio.to_thread(self._coordinator.release_all, run)
+        finally:
+            await self._api_client.aclose()
+
+        self._finish_worker(run)
+        return self._print_summary(start_time)
+
+    async def _join_run_async(self, run_key: str, target_count: int, batch_size: int) -> CrawlRun:
+        self._check_worker_mode()
+        await asyncio.to_thread(self._coordinator.acquire_planning_lock)
+        try:
+            run = await asyncio.to_thread(self._load_keyed_run, run_key)
+            if run is None:
+                run = self._start_run(await self._planner.plan_async(target_count), target_count, batch_size,
+                                      run_key)
+        finally:
+            await asyncio.to_thread(self._coordinator.release_planning_lock)
+        return run
+
+    async def _work_shards(self, semaphore: asyncio.Semaphore, run: CrawlRun, start_time: float):
+        while self._total_crawled < run.target_count:
+            claimed = await asyncio.to_thread(self._coordinator.wait_for_shard, run)
+            if claimed is None:
+                return
+            shard, cursor = claimed
+            await self._crawl_shard(shard, cursor, semaphore, run, start_time, coordinated=True)
+            self._coordinator.finished(shard.key)
+
+    def refresh(self,budget_points:int=500,rest_limit:int=0)->int:
+        return asyncio.run(self.refresh_async(budget_points,rest_limit))
+
+    async def refresh_async(self,budget_points:int=500,rest_limit:int=0)->int:
+
+        start_time = time.time()
+
+        try:
+            batches = await asyncio.to_thread(self._refresh_batches, budget_points)
+
+            pipeline=self._start_writer(self._refresh_write(), expected_rows=sum(map(len, batches)))
+            try:
+                semaphore = asyncio.Semaphore(self._max_workers)
+                await asyncio.gather(*(
+                    self._refresh_batch(node_ids, semaphore, start_time) for node_ids in batches
+                ))
+                # Conditional REST requests go through the blocking session.
+                await asyncio.to_thread(self._refresh_legacy, rest_limit, start_time)
+            finally:
+                await asyncio.to_thread(self._stop_writer, pipeline)
+        finally:
+            await self._api_client.aclose()
+
+        if self._writer_error:
+            raise Exception(f"Writer failed during refresh: {self._writer_error}")
+        await asyncio.to_thread(self._delete_gone)
+
+        return self._print_summary(start_time)
+
+    async def _refresh_batch(self, node_ids: List[str], semaphore: asyncio.Semaphore, start_time: float):
+        async with semaphore:
+            try:
+                repos = self._parse_nodes_result(await self._api_client.fetch_nodes(node_ids, self._refresh_fields),
+                                                 node_ids)
+            except Exception as e:
+                metrics.CRAWL_PAGES.inc(outcome='error')
+                print(f"Refresh batch error: {e}")
+                return
+
+        await asyncio.to_thread(self._record_batch, repos, start_time)
+
+    async def _crawl_shard(self, shard: QueryShard, cursor: Optional[str], semaphore: asyncio.Semaphore,
+                           run: CrawlRun, start_time: float, coordinated: bool = False):
+
+        while self._total_crawled < run.target_count:
+            async with semaphore:
+                if self._total_crawled >= run.target_count:
+                    return
+                try:
+                    batch_repos, cursor = await self._fetch_batch_async(cursor, run.batch_size, shard)
+                except Exception as e:
+                    self._failed_shards += 1
+                    metrics.CRAWL_PAGES.inc(outcome='error')
+                    print(f"Batch error in shard {shard.key}: {e}")
+                    return
+
+            # The writer queues are bounded, so block in a worker thread rather than the loop.
+            await asyncio.to_thread(self._record_batch, batch_repos, start_time, shard, cursor)
+
+            if not cursor or (coordinated and not self._coordinator.holds(shard.key)):
+                return
+
+    async def _fetch_batch_async(self, cursor: Optional[str], batch_size: int,
+                                 shard: QueryShard) -> Tuple[List[RepositoryRecord], Optional[str]]:
+
+        result = await self._search.fetch_repositories(cursor, batch_size, shard.search_query)
+        return self._parse_search_page(result, cursor)
@@ -0,0 +1,123 @@
+import asyncio
+from typing import Dict,List,Optional,Tuple,Union
+import httpx
+
+from github_client import (DEFAULT_SEARCH_QUERY,REFRESH_FIELDS,SEARCH_REPOSITORIES_QUERY,SEARCH_STATS_QUERY,
+                           GitHubClient,GraphQLExchange,multi_search_query)
+from rate_limiter import RateLimiter
+from page_size import PageSizeController
+from response_cache import ResponseCache
+
+
+class AsyncGitHubClient:
+
+    # Same methods as GitHubClient, but the GraphQL ones are coroutines, so it is not a
+    # GitHubClient. It wraps one for the shared rate limiters, page sizer, cache and
+    # response handling that GraphQLExchange runs on, and for the blocking REST calls.
+
+    def __init__(self,tokens:Union[str,List[str]],max_connections:int=20,http2:bool=True,
+                 rate_limiter:Optional[RateLimiter]=None,base_url:Optional[str]=None,
+                 response_cache:Optional[ResponseCache]=None,page_sizer:Optional[PageSizeController]=None):
+        self._github=GitHubClient(tokens,max_connections,rate_limiter,base_url,response_cache,page_sizer)
+        self._http2=http2
+        self._client=None
+
+    async def fetch_repositories(self,cursor:Optional[str]=None,per_page:int=100,
+                                 search_query:str=DEFAULT_SEARCH_QUERY)->Optional[Dict]:
+        variables = self._github._repositories_variables(cursor, per_page, search_query)
+        try:
+            result = await self._execute_with_retry(SEARCH_REPOSITORIES_QUERY, variables, resizable=True)
+            return self._github._validate_result(result)
+        except Exception as e:
+            print(f"Error fetching repositories: {e}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+    async def fetch_repositories_batch(self,searches:List[Tuple[str,Optional[str]]],
+                                       per_page:int=100)->List[Optional[Dict]]:
+        results:List[Optional[Dict]]=[None]*len(searches)
+        indexes=list(range(len(searches)))
+        for attempt in range(2):
+            query=multi_search_query(len(indexes))
+            variables=self._github._multi_search_variables([searches[i] for i in indexes],per_page)
+            try:
+                result=await self._execute_with_retry(query,variables,allow_partial=True,resizable=True)
+            except Exception as e:
+                print(f"Error fetching {len(indexes)} search pages: {e}")
+                return results
+            indexes=self._github._split_search_batch(result,indexes,results)
+            if not indexes:
+                break
+        return results
+
+    async def fetch_nodes(self,node_ids:List[str],fields:str='full')->Optional[Dict]:
+        try:
+            result = await self._execute_with_retry(REFRESH_FIELDS[fields], {"ids": node_ids}, allow_partial=True)
+            return self._github._validate_result(result)
+        except Exception as e:
+            print(f"Error fetching {len(node_ids)} nodes: {e}")
+            return None
+
+    async def search_stats(self,search_query:str)->Optional[Tuple[int,Optional[int]]]:
+        try:
+            result = await self._execute_with_retry(SEARCH_STATS_QUERY, {"searchQuery": search_query})
+            return self._github._parse_search_stats(result)
+        except Exception as e:
+            print(f"Error counting repositories for '{search_query}': {e}")
+            return None
+
+    def fetch_repository_rest(self,repository_id:int,etag:Optional[str]=None)->Tuple[Optional[Dict],Optional[str]]:
+        # Conditional REST requests stay blocking; refresh runs them in worker threads.
+        return self._github.fetch_repository_rest(repository_id,etag)
+
+    async def aclose(self):
+        if self._client:
+            await self._client.aclose()
+            self._client=None
+        self._github.close()
+
+    def _get_client(self)->httpx.AsyncClient:
+        # One keep-alive client per event loop; with HTTP/2 every in-flight request
+        # is multiplexed over a single connection.
+        if self._client is None:
+            self._client=httpx.AsyncClient(
+                http2=self._http2,
+                headers=self._github._headers,
+                timeout=30,
+                limits=httpx.Limits(max_connections=self._github._max_connections,
+                                    max_keepalive_connections=self._github._max_connections)
+            )
+        return self._client
+
+    async def _execute_with_retry(self,query:str,variables:Dict, max_retries:int=3,allow_partial:bool=False,
+                                  resizable:bool=False)->Dict:
+
+        exchange=GraphQLExchange(self._github,query,variables,max_retries,allow_partial,resizable)
+        if exchange.cached:
+            return exchange.cached
+
+        while exchange.next_attempt():
+            try:
+                wait_time=exchange.acquire()
+                if wait_time>0:
+                    await asyncio.sleep(wait_time)
+
+                body,headers=exchange.request()
+                response=await self._get_client().post(self._github._base_url,json=body,headers=headers)
+                result,retry_delay=exchange.response(response.status_code,response.headers,response.json)
+                if result is not None:
+                    return result
+                if retry_delay is not None:
+                    await asyncio.sleep(retry_delay)
+                    continue
+
+                response.raise_for_status()
+
+            except httpx.HTTPError:
+                retry_delay=exchange.transport_error()
+                if retry_delay is None:
+                    raise
+                await asyncio.sleep(retry_delay)
+
+        raise Exception("Max retries exceeded")
@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import time
+from threading import Lock
+from urllib.request import urlopen
+
+from bench_ingest import cleanup
+from crawler_service import CrawlerService
+from db import setup_schema
+from fake_graphql_server import start_server_process
+from github_client import GitHubClient
+from page_size import PageSizeController
+from repository import INGEST_MODES, RepositoryRepository
+
+
+class PageTimings:
+
+    def __init__(self):
+        self.samples = []
+        self._lock = Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class TimedGitHubClient(GitHubClient):
+
+    def __init__(self, *args, timings: PageTimings, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._timings = timings
+
+    def fetch_repositories(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().fetch_repositories(*args, **kwargs)
+        finally:
+            self._timings.add(time.perf_counter() - start)
+
+    def fetch_repositories_batch(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().fetch_repositories_batch(*args, **kwargs)
+        finally:
+            self._timings.add(time.perf_counter() - start)
+
+
+def build_crawler(engine: str, url: str, tokens, timings: PageTimings, repository: RepositoryRepository,
+                  workers: int, writers: int, page_sizer: PageSizeController, search_batch: int) -> CrawlerService:
+    if engine == 'async':
+        from async_crawler_service import AsyncCrawlerService
+        from async_github_client import AsyncGitHubClient
+
+        class TimedAsyncGitHubClient(AsyncGitHubClient):
+            async def fetch_repositories(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await super().fetch_repositories(*args, **kwargs)
+                finally:
+                    timings.add(time.perf_counter() - start)
+
+            async def fetch_repositories_batch(self, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await super().fetch_repositories_batch(*args, **kwargs)
+                finally:
+                    timings.add(time.perf_counter() - start)
+
+        return AsyncCrawlerService(TimedAsyncGitHubClient(tokens, base_url=url, page_sizer=page_sizer), repository,
+                                   max_workers=workers, writers=writers, search_batch=search_batch)
+
+    return CrawlerService(TimedGitHubClient(tokens, base_url=url, timings=timings, page_sizer=page_sizer), repository,
+                          max_workers=workers, writers=writers, search_batch=search_batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end crawl benchmark against a local fake GraphQL API")
+    parser.add_argument('--target', type=int, default=50_000)
+    parser.add_argument('--repos', type=int, default=200_000, help="size of the synthetic dataset")
+    parser.add_argument('--engine', choices=('threads', 'async'), default='threads')
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--tokens', type=int, default=1)
+    parser.add_argument('--ingest-mode', choices=INGEST_MODES, default='copy')
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-403', type=float, default=0.0)
+    parser.add_argument('--error-5xx', type=float, default=0.0)
+    parser.add_argument('--node-latency-ms', type=float, default=0.0)
+    parser.add_argument('--timeout-page-size', type=int)
+    parser.add_argument('--fixed-page-size', action='store_true', help="disable adaptive page sizing")
+    parser.add_argument('--search-batch', type=int, default=1, help="search pages per multi-search request")
+    parser.add_argument('--alias-error', type=float, default=0.0, help="fraction of aliased searches that fail")
+    args = parser.parse_args()
+
+    setup_schema()
+    cleanup()
+
+    server, url = start_server_process(
+        args.repos,
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_403_rate=args.error_403,
+        error_5xx_rate=args.error_5xx,
+        node_latency=args.node_latency_ms / 1000,
+        timeout_page_size=args.timeout_page_size,
+        alias_error_rate=args.alias_error,
+        rate_limit=1_000_000
+    )
+
+    repository = RepositoryRepository(os.environ['DATABASE_URL'], min_conn=1, max_conn=max(2, args.writers),
+                                      ingest_mode=args.ingest_mode)
+    timings = PageTimings()
+    # A floor equal to the ceiling pins every page at 100.
+    page_sizer = PageSizeController(min_size=100) if args.fixed_page_size else PageSizeController()
+    crawler = build_crawler(args.engine, url, [f"bench-token-{i}" for i in range(args.tokens)],
+                            timings, repository, args.workers, args.writers, page_sizer, args.search_batch)
+
+    try:
+        start_time = time.perf_counter()
+        crawled = crawler.crawl(target_count=args.target)
+        elapsed = time.perf_counter() - start_time
+        writer_stats = crawler._pipeline.stats
+        requests = json.load(urlopen(url.replace('/graphql', '/stats')))['requests']
+    finally:
+        repository.close()
+        server.terminate()
+        cleanup()
+
+    rows_written = sum(stats.rows for stats in writer_stats)
+    busy_seconds = sum(stats.commit_seconds for stats in writer_stats)
+    # Writer throughput while committing, i.e. what the write stage could sustain.
+    db_rate = rows_written / busy_seconds * len(writer_stats) if busy_seconds else 0
+
+    print(f"\nCrawl benchmark: engine={args.engine} workers={args.workers} writers={len(writer_stats)} "
+          f"ingest={args.ingest_mode} latency={args.latency_ms:.0f}ms "
+          f"403={args.error_403:.1%} 5xx={args.error_5xx:.1%} "
+          f"page size={'fixed' if args.fixed_page_size else 'adaptive'} search batch={args.search_batch}")
+    print(f"{'repos':>10}{'repos/sec':>12}{'page p50 ms':>14}{'page p99 ms':>14}{'db rows/sec':>14}{'requests':>10}"
+          f"{'last page':>11}")
+    print(f"{crawled:>10,}{crawled / elapsed:>12,.0f}{timings.percentile(0.5) * 1000:>14.1f}"
+          f"{timings.percentile(0.99) * 1000:>14.1f}{db_rate:>14,.0f}{requests:>10,}{page_sizer.size:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import csv
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+from models import RepositoryModel, decode_nodes
+
+
+def make_page(size: int) -> str:
+    return json.dumps({'data': {'search': {'nodes': [
+        {
+            'id': f"R_kgDO{i:08d}",
+            'databaseId': 100_000 + i,
+            'name': f"repo-{i}",
+            'nameWithOwner': f"owner-{i % 5000}/repo-{i}",
+            'owner': {'login': f"owner-{i % 5000}"},
+            'stargazerCount': 1000 + i % 100_000,
+            'createdAt': "2015-06-01T12:00:00Z",
+            'updatedAt': "2024-01-01T00:00:00Z",
+        }
+        for i in range(size)
+    ]}}})
+
+
+def model_path(nodes):
+    # What a page cost before: a model per node, read back through properties into rows.
+    repos = [RepositoryModel.from_api_response(node) for node in nodes if node and 'databaseId' in node]
+    return [(r.db_id, r.owner, r.name, r.full_name, r.star_count, r.created_at, r.updated_at, r.node_id)
+            for r in repos]
+
+
+def record_path(nodes):
+    return decode_nodes(nodes)
+
+
+def measure(decode, payload: str, with_csv: bool):
+    nodes = json.loads(payload)['data']['search']['nodes']
+
+    start = time.perf_counter()
+    rows = decode(nodes)
+    if with_csv:
+        csv.writer(io.StringIO()).writerows(rows)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    rows = decode(nodes)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak, len(rows)
+
+
+def main():
+    total_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    payload = make_page(total_nodes)
+
+    print(f"Decode benchmark: {total_nodes:,} nodes, best of {repeats}")
+    print(f"{'path':<22}{'decode ms':>12}{'decode+csv ms':>16}{'peak MiB':>12}")
+    for name, decode in (('RepositoryModel', model_path), ('tuple records', record_path)):
+        decode_ms = min(measure(decode, payload, False)[0] for _ in range(repeats)) * 1000
+        csv_ms = min(measure(decode, payload, True)[0] for _ in range(repeats)) * 1000
+        _, peak, _ = measure(decode, payload, False)
+        print(f"{name:<22}{decode_ms:>12.1f}{csv_ms:>16.1f}{peak / 2**20:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
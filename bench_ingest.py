@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+import time
+
+from db import get_connection, setup_schema
+from local_store import SQLiteRepositoryStore
+from repository import INGEST_MODES, RepositoryRepository
+
+
+# Synthetic ids live far above real GitHub databaseIds so runs can be cleaned up.
+ID_OFFSET = 9_000_000_000
+
+
+def make_batch(start: int, size: int, star_bump: int = 0):
+    return [
+        (
+            ID_OFFSET + i,
+            f"bench-owner-{i % 5000}",
+            f"bench-repo-{i}",
+            f"bench-owner-{i % 5000}/bench-repo-{i}",
+            1000 + (i % 100_000) + star_bump,
+            "2015-06-01T12:00:00Z",
+            "2024-01-01T00:00:00Z",
+            None,
+        )
+        for i in range(start, start + size)
+    ]
+
+
+def cleanup():
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM repositories WHERE id >= %s", (ID_OFFSET,))
+    cur.execute("DELETE FROM repository_tombstones WHERE repository_id >= %s", (ID_OFFSET,))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def run(mode: str, total_rows: int, batch_size: int):
+    if mode == 'sqlite':
+        with tempfile.TemporaryDirectory() as directory:
+            return run_store(SQLiteRepositoryStore(os.path.join(directory, 'bench.sqlite')), total_rows, batch_size)
+
+    repository = RepositoryRepository(os.environ['DATABASE_URL'], min_conn=1, max_conn=2, ingest_mode=mode)
+    try:
+        return run_store(repository, total_rows, batch_size)
+    finally:
+        cleanup()
+
+
+def run_store(repository, total_rows: int, batch_size: int):
+    results = {}
+    try:
+        # First pass inserts new repositories, the second refreshes them through ON CONFLICT.
+        for phase, star_bump in (('insert', 0), ('refresh', 1)):
+            start_time = time.perf_counter()
+            for start in range(0, total_rows, batch_size):
+                repository.upsert_batch(make_batch(start, min(batch_size, total_rows - start), star_bump))
+            elapsed = time.perf_counter() - start_time
+            results[phase] = total_rows / elapsed if elapsed > 0 else 0
+    finally:
+        repository.close()
+    return results
+
+
+def main():
+    total_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    setup_schema()
+    cleanup()
+
+    print(f"Ingest benchmark: {total_rows:,} rows in batches of {batch_size}")
+    print(f"{'mode':<15}{'insert rows/sec':>18}{'refresh rows/sec':>18}")
+    # sqlite is the embedded local store, for comparison with a networked Postgres.
+    for mode in INGEST_MODES + ('sqlite',):
+        results = run(mode, total_rows, batch_size)
+        print(f"{mode:<15}{results['insert']:>18,.0f}{results['refresh']:>18,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import psycopg2
+
+from bench_schema import schema_url
+from crawler_service import CrawlerService
+from db import setup_schema
+from delta_export import export_delta
+from fake_graphql_server import ID_OFFSET, is_deleted, start_server_process
+from github_client import GitHubClient
+from refresh_scheduler import RefreshScheduler
+from repository import RepositoryRepository
+
+
+SCHEMA = 'bench_refresh'
+
+
+def read_delta(output_dir: str, entry) -> tuple:
+    upserts, deletes = set(), set()
+    with open(os.path.join(output_dir, entry['file']), newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            (upserts if row['op'] == 'upsert' else deletes).add(int(row['id']))
+    return upserts, deletes
+
+
+def run(db_url: str, args) -> bool:
+    server, api_url = start_server_process(args.repos, latency=args.latency_ms / 1000, deleted_rate=args.deleted,
+                                           rate_limit=1_000_000)
+    repository = RepositoryRepository(db_url, min_conn=1, max_conn=4, ingest_mode='copy')
+    crawler = CrawlerService(GitHubClient(['bench-token'], base_url=api_url), repository,
+                             max_workers=args.workers,
+                             refresh_scheduler=RefreshScheduler(db_url, min_age_hours=0))
+    conn = psycopg2.connect(db_url)
+    conn.autocommit = True
+    curr = conn.cursor()
+
+    try:
+        crawler.crawl(target_count=args.target)
+        # Rows without node ids take the REST path, one request each.
+        curr.execute("UPDATE repositories SET node_id = NULL WHERE id %% %s = 0", (args.legacy_every,))
+        curr.execute("SELECT id, node_id IS NULL FROM repositories")
+        crawled = curr.fetchall()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            # Nothing else writes to this schema, so the deltas need no overlap.
+            export_delta(output_dir, snapshot=True, overlap_seconds=0)
+
+            start_time = time.perf_counter()
+            crawler.refresh(budget_points=len(crawled) // 100 + 1, rest_limit=len(crawled))
+            elapsed = time.perf_counter() - start_time
+
+            entry = export_delta(output_dir, overlap_seconds=0)
+            upserts, deletes = read_delta(output_dir, entry) if entry else (set(), set())
+    finally:
+        curr.close()
+        conn.close()
+        repository.close()
+        server.terminate()
+
+    # The fake API reports every refreshed node one star up, so each live node-refreshed
+    # row changed; REST rows come back as crawled and must not be re-sent.
+    expected_deletes = {repository_id for repository_id, _ in crawled
+                        if is_deleted(repository_id - ID_OFFSET, args.deleted)}
+    expected_upserts = {repository_id for repository_id, legacy in crawled
+                        if not legacy and repository_id not in expected_deletes}
+
+    print(f"\nRefresh benchmark: {len(crawled):,} repositories in {elapsed:.2f}s "
+          f"({len(crawled) / elapsed:,.0f} repos/sec), deleted={args.deleted:.1%}")
+    print(f"{'':<10}{'expected':>10}{'delta':>10}")
+    print(f"{'upserts':<10}{len(expected_upserts):>10,}{len(upserts):>10,}")
+    print(f"{'deletes':<10}{len(expected_deletes):>10,}{len(deletes):>10,}")
+    return upserts == expected_upserts and deletes == expected_deletes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh benchmark; checks that deletions reach the next delta export")
+    parser.add_argument('--target', type=int, default=5_000)
+    parser.add_argument('--repos', type=int, default=20_000, help="size of the synthetic dataset")
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--deleted', type=float, default=0.02, help="fraction of repositories deleted since the crawl")
+    parser.add_argument('--legacy-every', type=int, default=10, help="clear the node id of every n-th repository")
+    args = parser.parse_args()
+
+    # Runs in its own schema so the export watermarks of the real tables are untouched.
+    db_url = os.environ['DATABASE_URL']
+    admin = psycopg2.connect(db_url)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    admin.cursor().execute(f"CREATE SCHEMA {SCHEMA}")
+
+    url = schema_url(db_url, SCHEMA)
+    os.environ['DATABASE_URL'] = url
+    try:
+        setup_schema()
+        ok = run(url, args)
+    finally:
+        os.environ['DATABASE_URL'] = db_url
+        admin.cursor().execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        admin.close()
+
+    print("Delta matches the refresh" if ok else "Delta does not match the refresh")
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
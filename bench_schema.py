@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+from urllib.parse import quote
+
+import psycopg2
+
+from bench_ingest import make_batch
+from db import setup_schema
+from repository import RepositoryRepository
+
+
+# setup_schema(schema_version=0) is the baseline table layout; before the migrations
+# existed it also created these indexes.
+LEGACY_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_repos_full_name ON repositories(full_name)",
+    "CREATE INDEX IF NOT EXISTS idx_repos_last_crawled_at ON repositories(last_crawled_at)",
+    "CREATE INDEX IF NOT EXISTS idx_stars_repo_id ON repository_stars(repository_id)",
+)
+
+SCHEMAS = (('legacy', 0), ('lean', None))
+
+
+def schema_url(db_url: str, schema: str) -> str:
+    separator = '&' if '?' in db_url else '?'
+    return f"{db_url}{separator}options={quote(f'-c search_path={schema}')}"
+
+
+def wal_position(conn) -> str:
+    curr = conn.cursor()
+    curr.execute("SELECT pg_current_wal_lsn()")
+    return curr.fetchone()[0]
+
+
+def wal_bytes_since(conn, position: str) -> int:
+    curr = conn.cursor()
+    curr.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)::bigint", (position,))
+    return curr.fetchone()[0]
+
+
+def relation_sizes(conn):
+    curr = conn.cursor()
+    curr.execute("""
+        SELECT c.relname, pg_relation_size(c.oid), pg_indexes_size(c.oid),
+               COALESCE(s.n_tup_upd, 0), COALESCE(s.n_tup_hot_upd, 0)
+        FROM pg_class c
+        LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+        WHERE c.relnamespace = current_schema()::regnamespace
+          AND c.relname IN ('repositories', 'repository_stars', 'repository_latest_stars')
+        ORDER BY c.relname
+    """)
+    return curr.fetchall()
+
+
+def run(db_url: str, schema: str, version, total_rows: int, batch_size: int, refreshes: int):
+    admin = psycopg2.connect(db_url)
+    admin.autocommit = True
+    admin.cursor().execute(f"DROP SCHEMA IF EXISTS bench_{schema} CASCADE")
+    admin.cursor().execute(f"CREATE SCHEMA bench_{schema}")
+
+    url = schema_url(db_url, f"bench_{schema}")
+    previous_url = os.environ['DATABASE_URL']
+    os.environ['DATABASE_URL'] = url
+    try:
+        setup_schema(schema_version=version)
+    finally:
+        os.environ['DATABASE_URL'] = previous_url
+
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    if version == 0:
+        for statement in LEGACY_INDEXES:
+            conn.cursor().execute(statement)
+
+    repository = RepositoryRepository(url, min_conn=1, max_conn=2, ingest_mode='copy')
+    phases = []
+    try:
+        for phase in range(refreshes + 1):
+            position = wal_position(conn)
+            start_time = time.perf_counter()
+            for start in range(0, total_rows, batch_size):
+                repository.upsert_batch(make_batch(start, min(batch_size, total_rows - start), star_bump=phase))
+            elapsed = time.perf_counter() - start_time
+            phases.append(('insert' if phase == 0 else f'refresh {phase}', total_rows / elapsed,
+                           wal_bytes_since(conn, position) / total_rows))
+    finally:
+        repository.close()
+
+    # Table statistics reach the shared view shortly after each commit.
+    time.sleep(1.5)
+    sizes = relation_sizes(conn)
+    conn.close()
+    admin.cursor().execute(f"DROP SCHEMA bench_{schema} CASCADE")
+    admin.close()
+    return phases, sizes
+
+
+def main():
+    total_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    refreshes = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    db_url = os.environ['DATABASE_URL']
+
+    print(f"Schema benchmark: {total_rows:,} repositories, {refreshes} refresh passes, batches of {batch_size}")
+    for schema, version in SCHEMAS:
+        phases, sizes = run(db_url, schema, version, total_rows, batch_size, refreshes)
+
+        print(f"\n{schema} schema")
+        print(f"{'phase':<12}{'rows/sec':>12}{'WAL bytes/row':>16}")
+        for name, rate, wal_per_row in phases:
+            print(f"{name:<12}{rate:>12,.0f}{wal_per_row:>16,.0f}")
+        print(f"{'table':<26}{'heap MB':>10}{'index MB':>10}{'updates':>10}{'HOT':>8}")
+        for table, heap, indexes, updates, hot in sizes:
+            hot_ratio = f"{hot / updates:.0%}" if updates else '-'
+            print(f"{table:<26}{heap / 1024 / 1024:>10.1f}{indexes / 1024 / 1024:>10.1f}{updates:>10,}{hot_ratio:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+from typing import Dict, List, Optional
+
+import psycopg2
+from psycopg2.extras import execute_batch
+
+from shard_planner import QueryShard
+
+
+class ShardProgress:
+
+    __slots__ = ('shard_key', 'cursor', 'row_count', 'done')
+
+    def __init__(self, shard_key: str, cursor: Optional[str] = None, row_count: int = 0, done: bool = False):
+        self.shard_key = shard_key
+        self.cursor = cursor
+        self.row_count = row_count
+        self.done = done
+
+
+class CrawlRun:
+
+    __slots__ = ('run_id', 'target_count', 'batch_size', 'shards', 'cursors', 'done', 'flushed_count')
+
+    def __init__(self, run_id: Optional[int], target_count: int, batch_size: int, shards: List[QueryShard],
+                 cursors: Optional[Dict[str, str]] = None, done: Optional[set] = None, flushed_count: int = 0):
+        self.run_id = run_id
+        self.target_count = target_count
+        self.batch_size = batch_size
+        self.shards = shards
+        self.cursors = cursors or {}
+        self.done = done or set()
+        self.flushed_count = flushed_count
+
+    def pending_shards(self) -> List[QueryShard]:
+        return [shard for shard in self.shards if shard.key not in self.done]
+
+
+def create_checkpoint_tables(curr):
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS crawl_runs(
+                 id BIGSERIAL PRIMARY KEY,
+                 target_count INTEGER NOT NULL,
+                 batch_size INTEGER NOT NULL,
+                 status VARCHAR(16) NOT NULL DEFAULT 'running',
+                 started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                 updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                 );
+""")
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS crawl_checkpoints(
+                 run_id BIGINT NOT NULL REFERENCES crawl_runs(id) ON DELETE CASCADE,
+                 shard_key VARCHAR(255) NOT NULL,
+                 position INTEGER NOT NULL,
+                 min_stars INTEGER NOT NULL,
+                 max_stars INTEGER NOT NULL,
+                 created_from DATE,
+                 created_to DATE,
+                 expected_count INTEGER NOT NULL DEFAULT 0,
+                 cursor TEXT,
+                 flushed_count INTEGER NOT NULL DEFAULT 0,
+                 done BOOLEAN NOT NULL DEFAULT FALSE,
+                 updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                 PRIMARY KEY (run_id, shard_key)
+                 );
+""")
+    # Lease columns for coordinated workers (see coordinator.py); a single-process
+    # crawl leaves them NULL.
+    curr.execute("""
+    ALTER TABLE crawl_checkpoints
+        ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(255),
+        ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+""")
+    curr.execute("""
+    CREATE INDEX IF NOT EXISTS idx_checkpoints_claimable
+    ON crawl_checkpoints(run_id, position) WHERE NOT done;
+""")
+
+
+def write_progress(curr, run_id: int, progress: List[ShardProgress]):
+    # Runs inside the upsert transaction, so a cursor only ever advances past pages
+    # whose rows are committed.
+    execute_batch(curr, """
+        UPDATE crawl_checkpoints
+        SET cursor = COALESCE(%s, cursor),
+            flushed_count = flushed_count + %s,
+            done = done OR %s,
+            updated_at = NOW()
+        WHERE run_id = %s AND shard_key = %s
+    """, [(p.cursor, p.row_count, p.done, run_id, p.shard_key) for p in progress], page_size=1000)
+    curr.execute("UPDATE crawl_runs SET updated_at = NOW() WHERE id = %s", (run_id,))
+
+
+class CheckpointStore:
+
+    def __init__(self, db_url: str):
+        self._db_url = db_url
+
+    def start_run(self, target_count: int, batch_size: int, shards: List[QueryShard],
+                  run_key: Optional[str] = None) -> CrawlRun:
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                INSERT INTO crawl_runs (target_count, batch_size, run_key)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            """, (target_count, batch_size, run_key))
+            run_id = curr.fetchone()[0]
+
+            execute_batch(curr, """
+                INSERT INTO crawl_checkpoints (
+                    run_id, shard_key, position, min_stars, max_stars, created_from, created_to, expected_count)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, [
+                (run_id, shard.key, position, shard.min_stars, shard.max_stars,
+                 shard.created_from, shard.created_to, shard.expected_count)
+                for position, shard in enumerate(shards)
+            ], page_size=1000)
+
+            conn.commit()
+            curr.close()
+            return CrawlRun(run_id, target_count, batch_size, shards)
+
+        except Exception:
+            conn.rollback()
+            raise
+
+        finally:
+            conn.close()
+
+    def load_latest_run(self) -> Optional[CrawlRun]:
+        # Keyed runs belong to the dispatch that started them and are only joined by key.
+        return self._load_run("""
+            SELECT id, target_count, batch_size
+            FROM crawl_runs
+            WHERE status = 'running' AND run_key IS NULL
+            ORDER BY id DESC
+            LIMIT 1
+        """)
+
+    def load_keyed_run(self, run_key: str) -> Optional[CrawlRun]:
+        # Whatever its status, so a worker starting after the run completed finds
+        # nothing left to claim instead of planning a second run.
+        return self._load_run("SELECT id, target_count, batch_size FROM crawl_runs WHERE run_key = %s",
+                              (run_key,))
+
+    def _load_run(self, query: str, params: tuple = ()) -> Optional[CrawlRun]:
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute(query, params)
+            row = curr.fetchone()
+            if not row:
+                return None
+
+            run_id, target_count, batch_size = row
+            curr.execute("""
+                SELECT shard_key, min_stars, max_stars, created_from, created_to,
+                       expected_count, cursor, flushed_count, done
+                FROM crawl_checkpoints
+                WHERE run_id = %s
+                ORDER BY position
+            """, (run_id,))
+
+            shards = []
+            cursors = {}
+            done = set()
+            flushed_count = 0
+            for (shard_key, min_stars, max_stars, created_from, created_to,
+                 expected_count, cursor, shard_flushed, shard_done) in curr.fetchall():
+                shards.append(QueryShard(min_stars, max_stars, created_from, created_to, expected_count))
+                if cursor:
+                    cursors[shard_key] = cursor
+                if shard_done:
+                    done.add(shard_key)
+                flushed_count += shard_flushed
+
+            curr.close()
+            return CrawlRun(run_id, target_count, batch_size, shards, cursors, done, flushed_count)
+
+        finally:
+            conn.close()
+
+    def complete_run(self, run_id: int):
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                UPDATE crawl_runs SET status = 'completed', updated_at = NOW() WHERE id = %s
+            """, (run_id,))
+            conn.commit()
+            curr.close()
+
+        finally:
+            conn.close()
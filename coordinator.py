@@ -0,0 +1,258 @@
+import os
+import socket
+import time
+from threading import Event, Lock, Thread
+from typing import Optional, Set, Tuple
+
+import psycopg2
+
+from checkpoints import CrawlRun
+from shard_planner import QueryShard
+
+
+# Any fixed 64-bit key works; it only has to be the same for every worker.
+PLANNING_LOCK_KEY = 0x63726177_6c706c6e
+
+
+def default_worker_id() -> str:
+    return os.environ.get('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class CrawlCoordinator:
+
+    # Shares one crawl run between worker processes, possibly on different machines.
+    # The checkpoint rows are the work queue: a worker claims a shard by leasing its
+    # row with FOR UPDATE SKIP LOCKED, resumes it from the committed cursor, and keeps
+    # the lease alive with heartbeats while it is working. A worker that dies stops
+    # heartbeating, its leases expire, and the shards go back to the queue.
+    #
+    # Leases are renewed until the shard is done or the worker's write pipeline has
+    # drained, so two workers never have pages of the same shard queued at the same time.
+
+    def __init__(self, db_url: str, worker_id: Optional[str] = None, lease_seconds: float = 120,
+                 heartbeat_seconds: float = 30, max_attempts: int = 5):
+        if heartbeat_seconds >= lease_seconds:
+            raise ValueError("Heartbeat interval must be shorter than the lease")
+        self._db_url = db_url
+        self.worker_id = worker_id or default_worker_id()
+        self._lease_seconds = lease_seconds
+        self._heartbeat_seconds = heartbeat_seconds
+        self._max_attempts = max_attempts
+        self._held: Set[str] = set()
+        self._draining: Set[str] = set()
+        self._held_lock = Lock()
+        self._planning_conn = None
+        self._stop = Event()
+        self._heartbeat_thread: Optional[Thread] = None
+
+    def acquire_planning_lock(self):
+        # Held while a worker looks for an open run and, if there is none, plans one,
+        # so workers that start together join a single run.
+        self._planning_conn = psycopg2.connect(self._db_url)
+        self._planning_conn.autocommit = True
+        self._planning_conn.cursor().execute("SELECT pg_advisory_lock(%s)", (PLANNING_LOCK_KEY,))
+
+    def release_planning_lock(self):
+        if self._planning_conn is None:
+            return
+        try:
+            self._planning_conn.cursor().execute("SELECT pg_advisory_unlock(%s)", (PLANNING_LOCK_KEY,))
+        finally:
+            self._planning_conn.close()
+            self._planning_conn = None
+
+    def claim(self, run: CrawlRun) -> Optional[Tuple[QueryShard, Optional[str]]]:
+        # Shards are handed out in plan order. Nothing more is claimed once the run's
+        # committed rows reach its target.
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                UPDATE crawl_checkpoints c
+                SET lease_owner = %(worker)s,
+                    lease_expires_at = NOW() + make_interval(secs => %(lease)s),
+                    attempts = c.attempts + 1
+                FROM (
+                    SELECT run_id, shard_key
+                    FROM crawl_checkpoints
+                    WHERE run_id = %(run_id)s
+                      AND NOT done
+                      AND attempts < %(max_attempts)s
+                      AND (lease_expires_at IS NULL OR lease_expires_at < NOW())
+                      AND (SELECT COALESCE(SUM(flushed_count), 0) FROM crawl_checkpoints
+                           WHERE run_id = %(run_id)s) < %(target)s
+                    ORDER BY position
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                ) free
+                WHERE c.run_id = free.run_id AND c.shard_key = free.shard_key
+                RETURNING c.shard_key, c.min_stars, c.max_stars, c.created_from, c.created_to,
+                          c.expected_count, c.cursor, c.attempts
+            """, {'worker': self.worker_id, 'lease': self._lease_seconds, 'run_id': run.run_id,
+                  'max_attempts': self._max_attempts, 'target': run.target_count})
+            row = curr.fetchone()
+            conn.commit()
+            curr.close()
+
+        except Exception:
+            conn.rollback()
+            raise
+
+        finally:
+            conn.close()
+
+        if row is None:
+            return None
+
+        shard_key, min_stars, max_stars, created_from, created_to, expected_count, cursor, attempts = row
+        with self._held_lock:
+            self._held.add(shard_key)
+        retry = f" (attempt {attempts})" if attempts > 1 else ""
+        print(f"Worker {self.worker_id} claimed shard {shard_key}{retry}")
+        return QueryShard(min_stars, max_stars, created_from, created_to, expected_count), cursor
+
+    def wait_for_shard(self, run: CrawlRun) -> Optional[Tuple[QueryShard, Optional[str]]]:
+        # For a worker with nothing in flight: shards leased elsewhere may still come
+        # back (their worker dies or fails them), so keep polling until every shard
+        # is done or out of attempts.
+        while True:
+            claimed = self.claim(run)
+            if claimed or not self._has_unfinished(run):
+                return claimed
+            time.sleep(self._heartbeat_seconds)
+
+    def holds(self, shard_key: str) -> bool:
+        with self._held_lock:
+            return shard_key in self._held
+
+    def finished(self, shard_key: str):
+        # No more pages are fetched for the shard, but the ones already queued may not
+        # be committed yet. The heartbeat keeps renewing its lease until the shard's row
+        # is marked done, or until release_all() once the write pipeline has drained.
+        with self._held_lock:
+            if shard_key in self._held:
+                self._held.discard(shard_key)
+                self._draining.add(shard_key)
+
+    def start_heartbeat(self, run: CrawlRun):
+        self._stop.clear()
+        self._heartbeat_thread = Thread(target=self._heartbeat, args=(run.run_id,), daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat_thread:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def release_all(self, run: CrawlRun):
+        with self._held_lock:
+            self._held.clear()
+            self._draining.clear()
+
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                UPDATE crawl_checkpoints
+                SET lease_owner = NULL, lease_expires_at = NULL
+                WHERE run_id = %s AND lease_owner = %s
+            """, (run.run_id, self.worker_id))
+            conn.commit()
+            curr.close()
+
+        finally:
+            conn.close()
+
+    def finish_run(self, run: CrawlRun) -> bool:
+        # Whichever worker sees the run finished closes it: every shard is done or out
+        # of attempts, or enough rows are committed.
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                UPDATE crawl_runs
+                SET status = 'completed', updated_at = NOW()
+                WHERE id = %(run_id)s
+                  AND status = 'running'
+                  AND (
+                      NOT EXISTS (
+                          SELECT 1 FROM crawl_checkpoints
+                          WHERE run_id = %(run_id)s AND NOT done AND attempts < %(max_attempts)s
+                      )
+                      OR (SELECT COALESCE(SUM(flushed_count), 0) FROM crawl_checkpoints
+                          WHERE run_id = %(run_id)s) >= target_count
+                  )
+            """, {'run_id': run.run_id, 'max_attempts': self._max_attempts})
+            completed = curr.rowcount > 0
+            conn.commit()
+            curr.close()
+
+        finally:
+            conn.close()
+
+        if completed:
+            print(f"Crawl run {run.run_id} completed")
+        return completed
+
+    def _has_unfinished(self, run: CrawlRun) -> bool:
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM crawl_checkpoints
+                    WHERE run_id = %(run_id)s AND NOT done AND attempts < %(max_attempts)s
+                ) AND (SELECT COALESCE(SUM(flushed_count), 0) FROM crawl_checkpoints
+                       WHERE run_id = %(run_id)s) < %(target)s
+            """, {'run_id': run.run_id, 'max_attempts': self._max_attempts, 'target': run.target_count})
+            return curr.fetchone()[0]
+
+        finally:
+            conn.close()
+
+    def _heartbeat(self, run_id: int):
+        conn = None
+        while not self._stop.wait(self._heartbeat_seconds):
+            with self._held_lock:
+                held = sorted(self._held | self._draining)
+            if not held:
+                continue
+
+            try:
+                if conn is None or conn.closed:
+                    conn = psycopg2.connect(self._db_url)
+                curr = conn.cursor()
+                curr.execute("""
+                    UPDATE crawl_checkpoints
+                    SET lease_expires_at = NOW() + make_interval(secs => %s)
+                    WHERE run_id = %s AND shard_key = ANY(%s) AND lease_owner = %s
+                    RETURNING shard_key, done
+                """, (self._lease_seconds, run_id, held, self.worker_id))
+                rows = curr.fetchall()
+                conn.commit()
+                curr.close()
+
+                renewed = {key for key, _ in rows}
+                with self._held_lock:
+                    # A done shard can't be claimed again, so its lease no longer matters.
+                    self._draining -= {key for key, done in rows if done} | (set(held) - renewed)
+                    lost = (set(held) - renewed) & self._held
+                    self._held -= lost
+                if lost:
+                    # Another worker took over after our lease ran out and resumes from
+                    # the committed cursor; this one stops the shard at its next page.
+                    print(f"Worker {self.worker_id} lost leases on {', '.join(sorted(lost))}")
+
+            except Exception as e:
+                print(f"Heartbeat error: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = None
+
+        if conn is not None:
+            conn.close()
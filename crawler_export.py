@@ -1,132 +1,180 @@
 import os
 import json
-import csv
 from datetime import datetime
-import psycopg2
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
-def get_connection():
-    return psycopg2.connect(os.environ['DATABASE_URL'])
+from local_store import DEFAULT_STORE_PATH, SQLiteRepositoryStore
+from repository import RepositoryRepository
+from storage import CHUNK_SIZE, EXPORT_COLUMNS, RepositoryStore
 
 
-def export_to_csv():
+EXPORT_FORMATS = ('csv', 'json', 'ndjson', 'parquet')
+
+
+def open_store(backend='postgres') -> RepositoryStore:
+    # STORAGE_BACKEND=sqlite exports the embedded store at LOCAL_STORE_PATH instead.
+    if backend == 'sqlite':
+        return SQLiteRepositoryStore(os.environ.get('LOCAL_STORE_PATH', DEFAULT_STORE_PATH))
+    return RepositoryRepository(os.environ['DATABASE_URL'], min_conn=1, max_conn=2)
+
+
+def parquet_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('full_name', pa.string()),
+        ('owner', pa.string()),
+        ('name', pa.string()),
+        ('star_count', pa.int32()),
+        ('created_at', pa.timestamp('us', tz='UTC')),
+        ('updated_at', pa.timestamp('us', tz='UTC')),
+        ('last_star_count_at', pa.timestamp('us', tz='UTC')),
+    ])
+
+
+def export_to_csv(store, timestamp=None):
 
-    conn = get_connection()
-    cur = conn.cursor()
- 
     os.makedirs('exports', exist_ok=True)
-    
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-   
-
-    cur.execute("""
-        SELECT 
-            r.id,
-            r.full_name,
-            r.owner,
-            r.name,
-            rs.star_count,
-            r.created_at,
-            r.updated_at,
-            rs.observed_at as last_star_count_at
-        FROM repositories r
-        JOIN LATERAL (
-            SELECT star_count, observed_at
-            FROM repository_stars
-            WHERE repository_id = r.id
-            ORDER BY observed_at DESC
-            LIMIT 1
-        ) rs ON true
-        ORDER BY rs.star_count DESC
-    """)
-    
-    rows = cur.fetchall()
-    columns = ['id', 'full_name', 'owner', 'name', 'star_count', 
-               'created_at', 'updated_at', 'last_star_count_at']
-    
+
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
 
     csv_path = f'exports/repositories_{timestamp}.csv'
     with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(columns)
-        writer.writerows(rows)
-    
-    print(f"Exported {len(rows)} repositories to {csv_path}")
-    
-
-    cur.execute("""
-        SELECT 
-            COUNT(*) as total_repos,
-            SUM(star_count) as total_stars,
-            AVG(star_count) as avg_stars,
-            MAX(star_count) as max_stars,
-            MIN(star_count) as min_stars
-        FROM latest_repository_stars
-    """)
-    
-    stats = cur.fetchone()
-    
-    cur.close()
-    conn.close()
-    
-    return csv_path, stats
-
-
-def export_to_json():
-
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    cur.execute("""
-        SELECT 
-            r.id,
-            r.full_name,
-            r.owner,
-            r.name,
-            rs.star_count,
-            r.created_at::text,
-            r.updated_at::text,
-            rs.observed_at::text as last_star_count_at
-        FROM repositories r
-        JOIN LATERAL (
-            SELECT star_count, observed_at
-            FROM repository_stars
-            WHERE repository_id = r.id
-            ORDER BY observed_at DESC
-            LIMIT 1
-        ) rs ON true
-        ORDER BY rs.star_count DESC
-        LIMIT 1000
-    """)
-    
-    rows = cur.fetchall()
-    columns = ['id', 'full_name', 'owner', 'name', 'star_count', 
-               'created_at', 'updated_at', 'last_star_count_at']
-    
-
-    data = [dict(zip(columns, row)) for row in rows]
-    
+        count = store.write_csv(f)
+
+    print(f"Exported {count} repositories to {csv_path}")
+
+    return csv_path, store.export_stats()
+
+
+def export_to_json(store, timestamp=None):
+
+    os.makedirs('exports', exist_ok=True)
+
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+
     json_path = f'exports/top_1000_repositories_{timestamp}.json'
     with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2)
-    
+        f.write('[')
+        first = True
+        for rows in store.latest_stars(CHUNK_SIZE, limit=1000):
+            for row in rows:
+                f.write('\n' if first else ',\n')
+                json.dump(dict(zip(EXPORT_COLUMNS, row)), f, default=str)
+                first = False
+        f.write('\n]\n')
+
     print(f"Exported top 1000 repositories to {json_path}")
-    
-    cur.close()
-    conn.close()
-    
+
     return json_path
 
 
+def export_to_ndjson(store, timestamp=None):
+
+    os.makedirs('exports', exist_ok=True)
+
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    count = 0
+    ndjson_path = f'exports/repositories_{timestamp}.ndjson'
+    with open(ndjson_path, 'w', encoding='utf-8') as f:
+        for rows in store.latest_stars(CHUNK_SIZE):
+            for row in rows:
+                f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str))
+                f.write('\n')
+            count += len(rows)
+
+    print(f"Exported {count} repositories to {ndjson_path}")
+
+    return ndjson_path
+
+
+def export_to_parquet(store, timestamp=None, compression=None):
+
+    if pa is None:
+        raise ImportError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    os.makedirs('exports', exist_ok=True)
+
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    compression = compression or os.environ.get('EXPORT_PARQUET_COMPRESSION', 'zstd')
+
+    schema = parquet_schema()
+
+    count = 0
+    parquet_path = f'exports/repositories_{timestamp}.parquet'
+    with pq.ParquetWriter(parquet_path, schema, compression=compression) as writer:
+        # One row group per chunk keeps peak memory at a single chunk.
+        for rows in store.latest_stars(CHUNK_SIZE):
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            ))
+            count += len(rows)
+
+    print(f"Exported {count} repositories to {parquet_path}")
+
+    return parquet_path
+
+
 def main():
-    
+
     print("Exporting crawled data...")
-    
-    csv_path, stats = export_to_csv()
-    json_path = export_to_json()
-    
+
+    formats = [f.strip() for f in os.environ.get('EXPORT_FORMATS', 'csv,json').split(',') if f.strip()]
+    unknown = [f for f in formats if f not in EXPORT_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown export formats: {', '.join(unknown)}")
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    stats = None
+    backend = os.environ.get('STORAGE_BACKEND', 'postgres')
+    store = open_store(backend)
+    try:
+        # EXPORT_MODE=delta replaces the full CSV with a snapshot + delta chain, see delta_export.py.
+        # It runs before the sharded export, which then writes only the other formats.
+        if 'csv' in formats and os.environ.get('EXPORT_MODE', 'full') == 'delta' and backend == 'postgres':
+            from delta_export import export_delta
+            export_delta(compact_every=int(os.environ.get('EXPORT_COMPACT_EVERY', '7')), timestamp=timestamp)
+            formats = [f for f in formats if f != 'csv']
+
+        shards = int(os.environ.get('EXPORT_SHARDS', '1'))
+        if shards > 1 and backend == 'sqlite':
+            print("Sharded export reads Postgres directly, exporting the local store in one pass")
+        elif shards > 1 and any(f != 'json' for f in formats):
+            from export_pipeline import run_sharded_export
+            merge = os.environ.get('EXPORT_MERGE', 'false').lower() in ('1', 'true', 'yes')
+            stats = run_sharded_export(shards, formats, merge, timestamp)
+            # The top-1000 file is a bounded index scan, no need to shard it.
+            formats = [f for f in formats if f == 'json']
+
+        if 'csv' in formats:
+            csv_path, stats = export_to_csv(store, timestamp)
+        if 'json' in formats:
+            json_path = export_to_json(store, timestamp)
+        if 'ndjson' in formats:
+            export_to_ndjson(store, timestamp)
+        if 'parquet' in formats:
+            export_to_parquet(store, timestamp)
+
+        # EXPORT_RANK_CHANGES=true adds rank_changes_*.csv: moves, entrants and dropouts
+        # between the two newest snapshots taken by rank_snapshots.py.
+        if os.environ.get('EXPORT_RANK_CHANGES', 'false').lower() in ('1', 'true', 'yes') and backend == 'postgres':
+            from rank_snapshots import export_rank_changes
+            export_rank_changes(timestamp=timestamp)
+
+        if stats is None:
+            stats = store.export_stats()
+    finally:
+        store.close()
+
     print("\n" + "="*60)
     print("Export Summary:")
     print(f"Total repositories: {stats[0] or 0:,}")
@@ -138,4 +186,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
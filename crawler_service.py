@@ -1,7 +1,8 @@
 import os,time
 from datetime import datetime
 from typing import List,Dict,Optional,Iterator,Tuple
-from concurrent.futures import ThreadPoolExecutor,as_completed
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor,as_completed,wait,FIRST_COMPLETED
 from queue import Queue
 from threading import Lock,Thread
 import requests
@@ -9,156 +10,452 @@ import psycopg2
 from psycopg2.extras import execute_batch
 from psycopg2.pool import ThreadedConnectionPool
 
-from github_client import GitHubClient
-from models import RepositoryModel
-from repository import RepositoryRepository
+import metrics
+from checkpoints import CheckpointStore,CrawlRun,ShardProgress
+from coordinator import CrawlCoordinator
+from github_client import REFRESH_FIELDS,GitHubClient
+from models import RepositoryRecord,decode_nodes,decode_rest_repository,decode_star_nodes
+from refresh_scheduler import NODES_PER_REQUEST,RefreshScheduler
+from search_batcher import SearchBatcher
+from seen_ids import SEEN_MODES,SeenIds,make_seen_ids
+from shard_planner import QueryShard,ShardPlanner
+from storage import RepositoryStore
+from write_pipeline import WritePipeline
 
 
 class CrawlerService:
 
-    def __init__(self,api_client:'GitHubClient',repository:'RepositoryRepository',max_workers:int=10):
+    def __init__(self,api_client:'GitHubClient',repository:'RepositoryStore',max_workers:int=10,
+                 planner:Optional['ShardPlanner']=None,checkpoints:Optional['CheckpointStore']=None,
+                 refresh_scheduler:Optional['RefreshScheduler']=None,writers:int=4,flush_interval:float=2.0,
+                 refresh_fields:str='stars',coordinator:Optional['CrawlCoordinator']=None,
+                 dedup_mode:str='exact',dedup_false_positive_rate:float=0.001,
+                 search_batch:int=1,search_linger:float=0.025):
+        if dedup_mode not in SEEN_MODES:
+            raise ValueError(f"Unknown dedup mode '{dedup_mode}', expected one of {', '.join(SEEN_MODES)}")
+        if refresh_fields not in REFRESH_FIELDS:
+            raise ValueError(f"Unknown refresh fields '{refresh_fields}', expected one of {', '.join(REFRESH_FIELDS)}")
         self._api_client=api_client
+        # With search_batch > 1 concurrent shard pages share multi-search requests.
+        self._search=self._search_batcher(search_batch,search_linger) if search_batch>1 else api_client
         self._repository=repository
         self._max_workers=max_workers
-        self._write_queue=Queue(maxsize=1000)
+        self._planner=planner or ShardPlanner(api_client)
+        self._checkpoints=checkpoints
+        self._refresh_scheduler=refresh_scheduler
+        self._writers=writers
+        self._flush_interval=flush_interval
+        self._refresh_fields=refresh_fields
+        self._coordinator=coordinator
+        self._dedup_mode=dedup_mode
+        self._dedup_false_positive_rate=dedup_false_positive_rate
+        self._seen:Optional[SeenIds]=None
+        self._pipeline=None
         self._total_crawled=0
+        self._failed_shards=0
+        self._writer_error=None
+        self._run_id=None
+        self._refresh_ids:Dict[str,int]={}
+        self._gone_ids:List[int]=[]
         self._lock=Lock()
 
         
 
-    def crawl(self,target_count:int=100_000,batch_size:int=100):
+    def crawl(self,target_count:int=100_000,batch_size:int=100,resume:bool=False):
 
         start_time = time.time()
-        writer_thread=Thread(target=self._background_writer,daemon=True)
-        writer_thread.start()
+        run = self._resume_run() if resume else None
+        if run is None:
+            run = self._start_run(self._planner.plan(target_count), target_count, batch_size)
 
-        cursor = None
-        pending_futures = set()
-        
+        pipeline=self._start_writer(expected_rows=run.target_count)
+        try:
+            self._crawl_shards(run, start_time)
+        finally:
+            self._stop_writer(pipeline)
+
+        self._finish_run(run)
+        return self._print_summary(start_time)
+
+    def work(self,run_key:str,target_count:int=100_000,batch_size:int=100)->int:
+        # Worker mode: join the run named run_key (planning it if it does not exist yet)
+        # and crawl whatever shards the coordinator hands out until the queue is empty.
+        start_time = time.time()
+        run = self._join_run(run_key, target_count, batch_size)
+
+        pipeline=self._start_writer(expected_rows=run.target_count)
+        self._coordinator.start_heartbeat(run)
+        try:
+            self._crawl_shards(run, start_time, coordinated=True)
+        finally:
+            self._stop_writer(pipeline)
+            self._coordinator.stop_heartbeat()
+            self._coordinator.release_all(run)
+
+        self._finish_worker(run)
+        return self._print_summary(start_time)
+
+    def refresh(self,budget_points:int=500,rest_limit:int=0)->int:
+
+        start_time = time.time()
+        batches = self._refresh_batches(budget_points)
+
+        pipeline=self._start_writer(self._refresh_write(), expected_rows=sum(map(len, batches)))
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                futures = [executor.submit(self._fetch_nodes_batch, batch) for batch in batches]
+                for future in as_completed(futures):
+                    try:
+                        self._record_batch(future.result(), start_time)
+                    except Exception as e:
+                        metrics.CRAWL_PAGES.inc(outcome='error')
+                        print(f"Refresh batch error: {e}")
+            self._refresh_legacy(rest_limit, start_time)
+        finally:
+            self._stop_writer(pipeline)
+
+        if self._writer_error:
+            raise Exception(f"Writer failed during refresh: {self._writer_error}")
+        self._delete_gone()
+
+        return self._print_summary(start_time)
+
+    def _refresh_batches(self,budget_points:int)->List[List[str]]:
+        if not self._refresh_scheduler:
+            raise ValueError("Refresh requires a RefreshScheduler")
+
+        candidates = self._refresh_scheduler.select_stale(budget_points)
+        self._refresh_ids = {node_id: repository_id for repository_id, node_id in candidates}
+        node_ids = [node_id for _, node_id in candidates]
+        batches = [node_ids[i:i + NODES_PER_REQUEST] for i in range(0, len(node_ids), NODES_PER_REQUEST)]
+        print(f"Refreshing {len(node_ids):,} stale repositories in {len(batches)} requests")
+        return batches
+
+    def _refresh_legacy(self,limit:int,start_time:float):
+        candidates = self._refresh_scheduler.select_legacy(limit) if limit > 0 else []
+        if not candidates:
+            return
+
+        print(f"Refreshing {len(candidates):,} repositories without node ids over REST")
+        records, etags, unchanged_ids, gone_ids = [], [], [], []
         with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
-            # Submit initial batch
-            future = executor.submit(self._fetch_batch, cursor, batch_size)
-            pending_futures.add(future)
-
-            while pending_futures and self._total_crawled < target_count:
-                # Wait for at least one future to complete
-                done_future = next(as_completed(pending_futures), None)
-                if not done_future:
-                    break
-                
-                pending_futures.remove(done_future)
-                
+            futures = {
+                executor.submit(self._api_client.fetch_repository_rest, repository_id, etag): repository_id
+                for repository_id, etag in candidates
+            }
+            for future in as_completed(futures):
+                repository_id = futures[future]
                 try:
-                    batch_repos, next_cursor = done_future.result()
-
-                    if batch_repos:
-                        self._write_queue.put(batch_repos)
-                        self._total_crawled += len(batch_repos)
-
-                        if self._total_crawled % 1000 == 0:
-                            elapsed = time.time() - start_time
-                            rate = self._total_crawled / elapsed if elapsed > 0 else 0
-                            print(f"Progress: {self._total_crawled:,} repos | "
-                                  f"Rate: {rate:.0f} repos/sec")
-                    
-                    # Submit next batch if we have a cursor and haven't reached target
-                    if next_cursor and self._total_crawled < target_count:
-                        new_future = executor.submit(self._fetch_batch, next_cursor, batch_size)
-                        pending_futures.add(new_future)
-                    elif not next_cursor:
-                        print(f"No more cursors available. Total crawled: {self._total_crawled}")
-                        break
-                        
+                    data, etag = future.result()
                 except Exception as e:
-                    print(f"Batch error: {e}")
-                
-                # Check if we should break
-                if self._total_crawled >= target_count:
-                    break
+                    print(f"REST refresh error for repository {repository_id}: {e}")
+                    continue
+                if data:
+                    records.append(decode_rest_repository(data))
+                    if etag:
+                        etags.append((repository_id, etag))
+                elif etag:
+                    unchanged_ids.append(repository_id)
+                else:
+                    gone_ids.append(repository_id)
+
+        if records:
+            # REST records carry full metadata, including the node id these rows lack,
+            # so they take the full upsert even when the pipeline only writes stars.
+            self._repository.upsert_batch(records)
+            self._count_rows(records, start_time)
+        self._repository.record_rest_validation(etags, unchanged_ids)
+        with self._lock:
+            self._gone_ids.extend(gone_ids)
+        print(f"REST refresh: {len(records)} changed, {len(unchanged_ids)} not modified, {len(gone_ids)} gone")
+
+    def _fetch_nodes_batch(self,node_ids:List[str])->List[RepositoryRecord]:
+        return self._parse_nodes_result(self._api_client.fetch_nodes(node_ids, self._refresh_fields), node_ids)
+
+    def _refresh_write(self):
+        return self._repository.refresh_stars if self._refresh_fields=='stars' else None
+
+    def _parse_nodes_result(self,result:Optional[Dict],node_ids:List[str])->List[RepositoryRecord]:
+        if not result or not result.get('data'):
+            raise Exception(f"No result returned for {len(node_ids)} nodes")
+
+        nodes = result['data'].get('nodes') or []
+        repos = decode_star_nodes(nodes) if self._refresh_fields=='stars' else self._parse_nodes(nodes)
+        gone_ids = self._gone_repository_ids(result, nodes, node_ids)
+        if gone_ids:
+            with self._lock:
+                self._gone_ids.extend(gone_ids)
+        print(f"Refreshed {len(repos)} of {len(node_ids)} repositories" + (f", {len(gone_ids)} gone" if gone_ids else ""))
+        return repos
+
+    def _gone_repository_ids(self,result:Dict,nodes:List[Optional[Dict]],node_ids:List[str])->List[int]:
+        # Deleted or private repositories come back as null nodes with a NOT_FOUND error
+        # at their index. A node nulled by any other error is left for the next refresh.
+        error_types = {}
+        for error in result.get('errors') or []:
+            path = error.get('path') or []
+            if len(path) >= 2 and path[0] == 'nodes':
+                error_types[path[1]] = error.get('type')
+        return [
+            self._refresh_ids[node_id]
+            for index, node_id in enumerate(node_ids[:len(nodes)])
+            if nodes[index] is None and error_types.get(index, 'NOT_FOUND') == 'NOT_FOUND'
+            and node_id in self._refresh_ids
+        ]
+
+    def _delete_gone(self):
+        # After the writers have drained, so no queued refresh write races the delete.
+        with self._lock:
+            gone_ids, self._gone_ids = self._gone_ids, []
+        if gone_ids:
+            deleted = self._repository.delete_repositories(gone_ids)
+            print(f"Removed {deleted:,} repositories GitHub no longer serves")
+
+    def _search_batcher(self,max_batch:int,linger:float):
+        return SearchBatcher(self._api_client,max_batch,linger)
+
+    def _resume_run(self)->Optional[CrawlRun]:
+        if not self._checkpoints:
+            print("Resume requested but checkpoints are disabled, starting a new crawl")
+            return None
+
+        run = self._checkpoints.load_latest_run()
+        if run is None:
+            print("No interrupted crawl to resume, starting a new crawl")
+            return None
+
+        self._adopt_run(run)
+        print(f"Resuming crawl run {run.run_id}: {len(run.pending_shards())} of {len(run.shards)} shards pending, "
+              f"{run.flushed_count:,} repositories already stored")
+        return run
+
+    def _adopt_run(self,run:CrawlRun):
+        self._run_id = run.run_id
+        self._total_crawled = run.flushed_count
+
+    def _start_run(self,shards:List[QueryShard],target_count:int,batch_size:int,
+                   run_key:Optional[str]=None)->CrawlRun:
+        if not self._checkpoints:
+            return CrawlRun(None, target_count, batch_size, shards)
+
+        run = self._checkpoints.start_run(target_count, batch_size, shards, run_key)
+        self._run_id = run.run_id
+        return run
+
+    def _join_run(self,run_key:str,target_count:int,batch_size:int)->CrawlRun:
+        self._check_worker_mode()
+        self._coordinator.acquire_planning_lock()
+        try:
+            run = self._load_keyed_run(run_key)
+            if run is None:
+                run = self._start_run(self._planner.plan(target_count), target_count, batch_size, run_key)
+        finally:
+            self._coordinator.release_planning_lock()
+        return run
+
+    def _check_worker_mode(self):
+        if not self._coordinator or not self._checkpoints:
+            raise ValueError("Worker mode requires a CrawlCoordinator and checkpoints")
+
+    def _load_keyed_run(self,run_key:str)->Optional[CrawlRun]:
+        # Only the run started under this key is ever joined, never some other open run.
+        run = self._checkpoints.load_keyed_run(run_key)
+        if run is not None:
+            self._adopt_run(run)
+            print(f"Joining crawl run {run.run_id} ({run_key}): {len(run.pending_shards())} of "
+                  f"{len(run.shards)} shards pending, {run.flushed_count:,} repositories already stored")
+        return run
+
+    def _finish_worker(self,run:CrawlRun):
+        if self._writer_error:
+            raise Exception(f"Writer failed, another worker will pick up this worker's shards: {self._writer_error}")
+        self._coordinator.finish_run(run)
+
+    def _finish_run(self,run:CrawlRun):
+        if self._writer_error:
+            raise Exception(f"Writer failed, crawl can be resumed from the last checkpoint: {self._writer_error}")
+
+        # A run with failed shards stays open so --resume can retry them.
+        if self._checkpoints and run.run_id is not None and \
+                (self._total_crawled >= run.target_count or not self._failed_shards):
+            self._checkpoints.complete_run(run.run_id)
+
+    def _start_writer(self,write=None,expected_rows:int=100_000)->WritePipeline:
+        # Dedup is per run (per worker in worker mode): a resumed or parallel run can
+        # still write a repo twice, which the upsert absorbs.
+        self._seen=make_seen_ids(self._dedup_mode,expected_rows,self._dedup_false_positive_rate)
+        self._pipeline=WritePipeline(self._repository,self._run_id,writers=self._writers,
+                                     flush_interval=self._flush_interval,write=write).start()
+        pipeline=self._pipeline
+        metrics.WRITE_QUEUE_DEPTH.set_function(lambda: pipeline.queue_depth)
+        return pipeline
 
-        self._write_queue.put(None)
-        writer_thread.join()
+    def _stop_writer(self,pipeline:WritePipeline):
+        pipeline.close()
+        metrics.WRITE_QUEUE_DEPTH.set_function(None)
+        metrics.WRITE_QUEUE_DEPTH.set(0)
+        self._writer_error=pipeline.error
 
+    def _print_summary(self,start_time:float)->int:
         elapsed = time.time() - start_time
         rate = self._total_crawled / elapsed if elapsed > 0 else 0
         
         print(f"\n{'='*70}")
         print(f"Crawl completed!")
         print(f"Total repositories: {self._total_crawled:,}")
+        if self._seen is not None and self._seen.duplicates:
+            print(f"Duplicates skipped: {self._seen.duplicates:,} ({self._seen.nbytes / 1024 / 1024:.1f} MB seen-set)")
         print(f"Time elapsed: {elapsed:.2f}s ({elapsed/60:.1f} minutes)")
         print(f" Average speed: {rate:.0f} repos/second")
         print(f"{'='*70}")
         
         return self._total_crawled
-    
-    def _fetch_batch(self, cursor: Optional[str], 
-                    batch_size: int) -> Tuple[List[RepositoryModel], Optional[str]]:
 
-        try:
-            result = self._api_client.fetch_repositories(cursor, batch_size)
-            
-            if not result:
-                print(f"Warning: No result returned for cursor: {cursor}")
-                return [], None
-            
-            data = result.get('data', {})
-            if not data:
-                print(f"Warning: No data in response for cursor: {cursor}")
-                return [], None
-                
-            search = data.get('search', {})
-            if not search:
-                print(f"Warning: No search data in response for cursor: {cursor}")
-                return [], None
-                
-            nodes = search.get('nodes', [])
-            page_info = search.get('pageInfo', {})
-            next_cursor = page_info.get('endCursor') if page_info else None
-            
-            if not nodes:
-                print(f"Warning: No nodes returned for cursor: {cursor}")
-                return [], next_cursor
- 
-            repos = []
-            for node in nodes:
+    def _record_batch(self,batch_repos:List[RepositoryRecord],start_time:float,
+                      shard:Optional[QueryShard]=None,next_cursor:Optional[str]=None):
+        if self._seen is not None:
+            batch_repos = self._seen.filter(batch_repos)
+        progress = ShardProgress(shard.key, next_cursor, len(batch_repos), done=next_cursor is None) if shard else None
+        self._pipeline.put(batch_repos, progress)
+        metrics.CRAWL_PAGES.inc(outcome='ok')
+        if batch_repos:
+            self._count_rows(batch_repos, start_time)
+
+    def _count_rows(self,batch_repos:List[RepositoryRecord],start_time:float):
+        with self._lock:
+            previous_total = self._total_crawled
+            self._total_crawled += len(batch_repos)
+            total_crawled = self._total_crawled
+
+        elapsed = time.time() - start_time
+        rate = total_crawled / elapsed if elapsed > 0 else 0
+        metrics.CRAWL_ROWS.inc(len(batch_repos))
+        metrics.CRAWL_ROWS_PER_SECOND.set(rate)
+
+        # Pages rarely land exactly on a multiple of 1000, so report on crossing one.
+        if total_crawled // 1000 > previous_total // 1000:
+            print(f"Progress: {total_crawled:,} repos | "
+                  f"Rate: {rate:.0f} repos/sec | "
+                  f"Write queue: {self._pipeline.queue_depth} batches")
+
+    def _crawl_shards(self, run: CrawlRun, start_time: float, coordinated: bool = False):
+
+        # Each shard is a serial cursor chain, so concurrency comes from keeping up to
+        # max_workers shards in flight at once. Coordinated workers take shards from the
+        # shared queue instead of the run's local list.
+        shard_queue = deque(run.pending_shards())
+        pending_futures = {}
+        target_count = run.target_count
+
+        def next_shard() -> Optional[Tuple[QueryShard, Optional[str]]]:
+            if coordinated:
+                return self._coordinator.claim(run)
+            if shard_queue:
+                shard = shard_queue.popleft()
+                return shard, run.cursors.get(shard.key)
+            return None
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+
+            def submit(shard: QueryShard, cursor: Optional[str]):
+                future = executor.submit(self._fetch_batch, cursor, run.batch_size, shard)
+                pending_futures[future] = shard
+
+            def submit_next_shard() -> bool:
+                claimed = next_shard()
+                if claimed:
+                    submit(*claimed)
+                return claimed is not None
+
+            def record(done_future) -> Tuple[QueryShard, Optional[str]]:
+                shard = pending_futures.pop(done_future)
+                next_cursor = None
+
                 try:
-                    if node and 'databaseId' in node:
-                        repo = RepositoryModel.from_api_response(node)
-                        repos.append(repo)
+                    batch_repos, next_cursor = done_future.result()
+                    self._record_batch(batch_repos, start_time, shard, next_cursor)
+
                 except Exception as e:
-                    print(f"Error parsing repository node: {e}")
-                    continue
-            
-            print(f"Fetched {len(repos)} repositories (cursor: {cursor[:20] if cursor else 'None'}...)")
-            return repos, next_cursor
-            
-        except Exception as e:
-            print(f"Fetch error: {e}")
-            import traceback
-            traceback.print_exc()
-            return [], None
-    
-    def _background_writer(self):
+                    self._failed_shards += 1
+                    metrics.CRAWL_PAGES.inc(outcome='error')
+                    print(f"Batch error in shard {shard.key}: {e}")
 
-        batch_buffer = []
-        
-        while True:
-            batch = self._write_queue.get()
-            
-            if batch is None:  
-                if batch_buffer:
-                    self._repository.upsert_batch(batch_buffer)
-                break
-            
-            batch_buffer.extend(batch)
-            
-            if len(batch_buffer) >= 500:
-                self._repository.upsert_batch(batch_buffer)
-                batch_buffer = []
+                return shard, next_cursor
+
+            while len(pending_futures) < self._max_workers and submit_next_shard():
+                pass
+
+            while self._total_crawled < target_count:
+                if not pending_futures:
+                    # A coordinated worker with nothing in flight waits for shards other
+                    # workers still hold, in case their leases lapse.
+                    claimed = self._coordinator.wait_for_shard(run) if coordinated else None
+                    if not claimed:
+                        break
+                    submit(*claimed)
+
+                done_futures, _ = wait(pending_futures, return_when=FIRST_COMPLETED)
 
+                for done_future in done_futures:
+                    shard, next_cursor = record(done_future)
 
+                    if self._total_crawled >= target_count:
+                        continue
 
+                    if next_cursor and (not coordinated or self._coordinator.holds(shard.key)):
+                        submit(shard, next_cursor)
+                    else:
+                        if coordinated:
+                            self._coordinator.finished(shard.key)
+                        submit_next_shard()
 
+            # Once the target is reached, pages not started yet are cancelled, and pages
+            # already fetched or in flight are still recorded so their cursors advance.
+            for future in [f for f in pending_futures if f.cancel()]:
+                del pending_futures[future]
+            for done_future in as_completed(list(pending_futures)):
+                record(done_future)
 
+            if not pending_futures and self._total_crawled < target_count:
+                print(f"All shards exhausted. Total crawled: {self._total_crawled}")
+    
+    def _fetch_batch(self, cursor: Optional[str], 
+                    batch_size: int, shard: Optional[QueryShard] = None) -> Tuple[List[RepositoryRecord], Optional[str]]:
+
+        # Errors propagate so a failed page never marks its shard as finished.
+        if shard:
+            result = self._search.fetch_repositories(cursor, batch_size, shard.search_query)
+        else:
+            result = self._search.fetch_repositories(cursor, batch_size)
 
+        return self._parse_search_page(result, cursor)
+    
+    def _parse_search_page(self, result: Optional[Dict],
+                           cursor: Optional[str]) -> Tuple[List[RepositoryRecord], Optional[str]]:
 
+        if not result:
+            raise Exception(f"No result returned for cursor: {cursor}")
+        
+        data = result.get('data', {})
+        if not data:
+            raise Exception(f"No data in response for cursor: {cursor}")
+            
+        search = data.get('search', {})
+        if not search:
+            raise Exception(f"No search data in response for cursor: {cursor}")
+            
+        nodes = search.get('nodes', [])
+        page_info = search.get('pageInfo', {})
+        next_cursor = page_info.get('endCursor') if page_info and page_info.get('hasNextPage') else None
+        
+        if not nodes:
+            print(f"Warning: No nodes returned for cursor: {cursor}")
+            return [], next_cursor
+ 
+        repos = self._parse_nodes(nodes)
+        
+        print(f"Fetched {len(repos)} repositories (cursor: {cursor[:20] if cursor else 'None'}...)")
+        return repos, next_cursor
+    
+    def _parse_nodes(self, nodes: List[Dict]) -> List[RepositoryRecord]:
+        return decode_nodes(nodes)
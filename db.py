@@ -1,12 +1,18 @@
 import os
+from typing import Optional
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
+import checkpoints
+import migrations
+import partitions
+import trends
+
 def get_connection():
     return psycopg2.connect(os.environ['DATABASE_URL'])
 
 
-def setup_schema():
+def setup_schema(partitioned:bool=False,partitions_ahead:int=3,schema_version:Optional[int]=None):
     conn=get_connection()
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     curr=conn.cursor()
@@ -20,11 +26,34 @@ def setup_schema():
                  created_at TIMESTAMPTZ,
                  updated_at TIMESTAMPTZ,
                  last_crawled_at TIMESTAMPTZ DEFAULT NOW(),
+                 node_id VARCHAR(64),
+                 rest_etag VARCHAR(255),
                  CONSTRAINT uniquue_owner_name UNIQUE(owner,name)
                  );
 """)
-    
     curr.execute("""
+    ALTER TABLE repositories ADD COLUMN IF NOT EXISTS node_id VARCHAR(64);
+""")
+    curr.execute("""
+    ALTER TABLE repositories ADD COLUMN IF NOT EXISTS rest_etag VARCHAR(255);
+""")
+    
+    curr.execute("SELECT to_regclass('repository_stars') IS NOT NULL")
+    stars_exists=curr.fetchone()[0]
+
+    if partitioned and not stars_exists:
+        # Partitioned by observed_at; the unique key has to include the partition
+        # column, so there is no surrogate id here.
+        curr.execute("""
+    CREATE TABLE IF NOT EXISTS repository_stars(
+                 repository_id BIGINT NOT NULL REFERENCES repositories(id) ON DELETE CASCADE,
+                 star_count INTEGER NOT NULL,
+                 observed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                 CONSTRAINT unique_repo_observation UNIQUE(repository_id,observed_at)
+                 ) PARTITION BY RANGE (observed_at);
+""")
+    else:
+        curr.execute("""
     CREATE TABLE IF NOT EXISTS repository_stars(
                  id BIGSERIAL PRIMARY KEY,
                  repository_id BIGINT NOT NULL REFERENCES repositories(id) ON DELETE CASCADE,
@@ -33,33 +62,56 @@ def setup_schema():
                  CONSTRAINT unique_repo_observation UNIQUE(repository_id,observed_at)
                  );
 """)
+
+    if partitions.is_partitioned(curr):
+        partitions.create_partitions(curr,partitions_ahead)
+        partitions.create_rollup_tables(curr)
+    elif partitioned:
+        print("repository_stars already exists as a regular table, leaving it unpartitioned")
     
     curr.execute("""
-    CREATE INDEX IF NOT EXISTS idx_repos_full_name ON repositories(full_name);
+    CREATE TABLE IF NOT EXISTS repository_latest_stars(
+                 repository_id BIGINT PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+                 star_count INTEGER NOT NULL,
+                 observed_at TIMESTAMPTZ NOT NULL
+                 );
 """)
+    
     curr.execute("""
-    CREATE INDEX IF NOT EXISTS idx_repos_last_crawled_at ON repositories(last_crawled_at);
+    CREATE INDEX IF NOT EXISTS idx_stars_observed_at ON repository_stars(observed_at DESC);
 """)
     curr.execute("""
-    CREATE INDEX IF NOT EXISTS idx_stars_repo_id ON repository_stars(repository_id);
+    CREATE INDEX IF NOT EXISTS idx_latest_stars_star_count
+    ON repository_latest_stars(star_count DESC) INCLUDE (repository_id, observed_at);
 """)
-    curr.execute("""
-    CREATE INDEX IF NOT EXISTS idx_stars_observed_at ON repository_stars(observed_at DESC);
+
+    # Backfill once for databases created before the latest-stars table existed,
+    # after that the upsert path keeps it current.
+    curr.execute("SELECT EXISTS (SELECT 1 FROM repository_latest_stars)")
+    if not curr.fetchone()[0]:
+        curr.execute("""
+    INSERT INTO repository_latest_stars(repository_id, star_count, observed_at)
+    SELECT DISTINCT ON (repository_id) repository_id, star_count, observed_at
+    FROM repository_stars
+    ORDER BY repository_id, observed_at DESC
+    ON CONFLICT (repository_id) DO NOTHING;
 """)
     
 
+    checkpoints.create_checkpoint_tables(curr)
+    trends.create_trend_tables(curr)
+
     curr.execute(
         """
     CREATE OR REPLACE VIEW latest_repository_stars AS 
-    SELECT DISTINCT ON (repository_id)
-        rs.repository_id,
+    SELECT
+        ls.repository_id,
         r.full_name,
-        rs.star_count,
-        rs.observed_at
+        ls.star_count,
+        ls.observed_at
     FROM repositories r
-    JOIN repository_stars rs
-    ON r.id = rs.repository_id
-    ORDER BY repository_id,observed_at DESC;
+    JOIN repository_latest_stars ls
+    ON r.id = ls.repository_id;
 """
     )
 
@@ -67,11 +119,20 @@ def setup_schema():
     curr.close()
     conn.close()
 
+    # Everything above is the version-0 baseline; later changes are migrations.
+    migrations.migrate(schema_version)
+
 
     print("Database schema successfully")
 
 
 if __name__=="__main__":
-    setup_schema()
+    # SCHEMA_VERSION pins the migration target; unset migrates to the latest version.
+    schema_version=os.environ.get('SCHEMA_VERSION')
+    setup_schema(
+        partitioned=os.environ.get('STARS_PARTITIONED','false').lower()=='true',
+        partitions_ahead=int(os.environ.get('STARS_PARTITIONS_AHEAD','3')),
+        schema_version=int(schema_version) if schema_version else None
+    )
 
 
@@ -0,0 +1,190 @@
+import csv
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+from psycopg2.extras import Json
+
+import db
+from storage import EXPORT_COLUMNS, EXPORT_QUERY, stream_rows
+from trends import WATERMARK_OVERLAP_SECONDS
+
+
+# Delta files carry an op column: 'upsert' rows have every export column, 'delete'
+# rows only the id and full_name of a repository that was removed.
+DELTA_COLUMNS = ['op'] + EXPORT_COLUMNS
+
+MANIFEST_NAME = 'delta_manifest.json'
+
+# changed_at moves only when a write sees a different star count or updated_at (see
+# repository.py), not on every crawl the way last_crawled_at does, so a delta is as
+# large as the churn. A row that was only re-crawled keeps the last_star_count_at it
+# had in the consumer's copy.
+DELTA_QUERY = """
+        SELECT
+            r.id,
+            r.full_name,
+            r.owner,
+            r.name,
+            rs.star_count,
+            r.created_at,
+            r.updated_at,
+            rs.observed_at as last_star_count_at,
+            r.changed_at
+        FROM repositories r
+        JOIN repository_latest_stars rs ON rs.repository_id = r.id
+        WHERE r.changed_at > %s
+"""
+
+# A repository deleted and then crawled again is an upsert, not a delete.
+TOMBSTONE_QUERY = """
+        SELECT t.repository_id, t.full_name, t.deleted_at
+        FROM repository_tombstones t
+        WHERE t.deleted_at > %s
+          AND NOT EXISTS (SELECT 1 FROM repositories r WHERE r.id = t.repository_id)
+"""
+
+
+def export_delta(output_dir: str = 'exports', compact_every: int = 7, timestamp: Optional[str] = None,
+                 snapshot: bool = False, overlap_seconds: float = WATERMARK_OVERLAP_SECONDS) -> Optional[Dict]:
+    # Writes the rows changed since the previous export, or a full snapshot on the
+    # first run, when asked, and after compact_every deltas. A snapshot starts a new
+    # chain: consumers load the newest snapshot and apply the deltas after it in
+    # sequence order, so older files can be dropped. The chain is kept in the database
+    # because export directories don't outlive a CI run. Returns the new chain entry,
+    # or None when nothing changed.
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # One snapshot for the rows, the tombstones and the watermark they advance to.
+    conn = db.get_connection()
+    conn.set_isolation_level(ISOLATION_LEVEL_REPEATABLE_READ)
+
+    try:
+        curr = conn.cursor()
+        curr.execute("""
+            SELECT sequence, snapshot_sequence, exported_through, tombstones_through, chain, NOW()
+            FROM export_watermarks WHERE name = 'repositories'
+            FOR UPDATE
+        """)
+        row = curr.fetchone()
+        if row is None:
+            curr.execute("SELECT NOW()")
+            sequence, snapshot_sequence, exported_through, tombstones_through, chain = 0, 0, None, None, []
+            now = curr.fetchone()[0]
+        else:
+            sequence, snapshot_sequence, exported_through, tombstones_through, chain, now = row
+
+        sequence += 1
+        if row is None or snapshot or sequence - snapshot_sequence > compact_every:
+            entry = _write_snapshot(curr, output_dir, sequence, timestamp)
+            # Rows committed late are picked up by the next delta's overlap.
+            exported_through = tombstones_through = now
+            snapshot_sequence = sequence
+            chain = [entry]
+            # Deleted repositories are already absent from the snapshot.
+            curr.execute("""
+                DELETE FROM repository_tombstones
+                WHERE deleted_at < %s::timestamptz - make_interval(secs => %s)
+            """, (now, overlap_seconds))
+        else:
+            overlap = timedelta(seconds=overlap_seconds)
+            entry, exported_through, tombstones_through = _write_delta(
+                conn, output_dir, sequence, timestamp,
+                exported_through - overlap, tombstones_through - overlap,
+                exported_through, tombstones_through)
+            if entry is None:
+                conn.rollback()
+                print("No changes since the last export")
+                write_manifest(output_dir, chain)
+                return None
+            chain = chain + [entry]
+
+        curr.execute("""
+            INSERT INTO export_watermarks(name, sequence, snapshot_sequence, exported_through,
+                                          tombstones_through, chain, updated_at)
+            VALUES ('repositories', %s, %s, %s, %s, %s, NOW())
+            ON CONFLICT (name) DO UPDATE SET
+                sequence = EXCLUDED.sequence,
+                snapshot_sequence = EXCLUDED.snapshot_sequence,
+                exported_through = EXCLUDED.exported_through,
+                tombstones_through = EXCLUDED.tombstones_through,
+                chain = EXCLUDED.chain,
+                updated_at = NOW()
+        """, (sequence, snapshot_sequence, exported_through, tombstones_through, Json(chain)))
+        conn.commit()
+        curr.close()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    write_manifest(output_dir, chain)
+    return entry
+
+
+def write_manifest(output_dir: str, chain: List[Dict]) -> str:
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump({'columns': DELTA_COLUMNS, 'chain': chain}, f, indent=2)
+    return manifest_path
+
+
+def _write_snapshot(curr, output_dir: str, sequence: int, timestamp: str) -> Dict:
+    path = os.path.join(output_dir, f'snapshot_{sequence:06d}_{timestamp}.csv')
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        curr.copy_expert(f"COPY ({EXPORT_QUERY}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+    rows = curr.rowcount
+
+    print(f"Exported snapshot {sequence} with {rows} repositories to {path}")
+    return {'sequence': sequence, 'kind': 'snapshot', 'file': os.path.basename(path),
+            'rows': rows, 'tombstones': 0, 'created_at': timestamp}
+
+
+def _write_delta(conn, output_dir: str, sequence: int, timestamp: str, since, tombstones_since,
+                 exported_through, tombstones_through):
+    # The overlap re-sends rows near the old watermark; consumers upsert, so that only
+    # costs bytes. A delta is only written if something is past the watermark.
+    path = os.path.join(output_dir, f'delta_{sequence:06d}_{timestamp}.csv')
+    rows = tombstones = fresh = 0
+    previous_through, previous_tombstones_through = exported_through, tombstones_through
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(DELTA_COLUMNS)
+        for chunk in stream_rows(conn, DELTA_QUERY, (since,)):
+            for row in chunk:
+                writer.writerow(('upsert',) + row[:-1])
+                if row[-1] > previous_through:
+                    fresh += 1
+                    exported_through = max(exported_through, row[-1])
+            rows += len(chunk)
+
+        curr = conn.cursor()
+        curr.execute(TOMBSTONE_QUERY, (tombstones_since,))
+        for repository_id, full_name, deleted_at in curr:
+            writer.writerow(('delete', repository_id, full_name) + ('',) * (len(EXPORT_COLUMNS) - 2))
+            if deleted_at > previous_tombstones_through:
+                fresh += 1
+                tombstones_through = max(tombstones_through, deleted_at)
+            tombstones += 1
+        curr.close()
+
+    if not fresh:
+        os.remove(path)
+        return None, exported_through, tombstones_through
+
+    print(f"Exported delta {sequence}: {rows} changed and {tombstones} deleted repositories to {path}")
+    entry = {'sequence': sequence, 'kind': 'delta', 'file': os.path.basename(path),
+             'rows': rows, 'tombstones': tombstones, 'created_at': timestamp}
+    return entry, exported_through, tombstones_through
+
+
+if __name__ == "__main__":
+    export_delta(compact_every=int(os.environ.get('EXPORT_COMPACT_EVERY', '7')),
+                 snapshot=os.environ.get('EXPORT_SNAPSHOT', 'false').lower() in ('1', 'true', 'yes'))
@@ -0,0 +1,234 @@
+import csv
+import heapq
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from crawler_export import pa, parquet_schema, pq
+from storage import EXPORT_COLUMNS, stream_rows
+
+
+SHARD_QUERY = """
+        SELECT
+            r.id,
+            r.full_name,
+            r.owner,
+            r.name,
+            rs.star_count,
+            r.created_at,
+            r.updated_at,
+            rs.observed_at as last_star_count_at
+        FROM repository_latest_stars rs
+        JOIN repositories r ON r.id = rs.repository_id
+        WHERE rs.repository_id >= %s AND rs.repository_id < %s
+        ORDER BY rs.star_count DESC
+"""
+
+SHARD_FORMATS = ('csv', 'ndjson', 'parquet')
+
+
+class ShardStats:
+
+    __slots__ = ('count', 'total_stars', 'max_stars', 'min_stars')
+
+    def __init__(self):
+        self.count = 0
+        self.total_stars = 0
+        self.max_stars = None
+        self.min_stars = None
+
+    def add(self, star_count: int):
+        self.count += 1
+        self.total_stars += star_count
+        if self.max_stars is None or star_count > self.max_stars:
+            self.max_stars = star_count
+        if self.min_stars is None or star_count < self.min_stars:
+            self.min_stars = star_count
+
+    def merge(self, other: 'ShardStats'):
+        self.count += other.count
+        self.total_stars += other.total_stars
+        if other.max_stars is not None and (self.max_stars is None or other.max_stars > self.max_stars):
+            self.max_stars = other.max_stars
+        if other.min_stars is not None and (self.min_stars is None or other.min_stars < self.min_stars):
+            self.min_stars = other.min_stars
+
+    def as_tuple(self) -> Tuple:
+        avg = self.total_stars / self.count if self.count else None
+        return self.count, self.total_stars, avg, self.max_stars, self.min_stars
+
+
+def plan_id_ranges(conn, shards: int) -> List[Tuple[int, int]]:
+    # Quantile boundaries give shards of roughly equal row counts, GitHub ids are far
+    # from uniformly distributed.
+    cur = conn.cursor()
+    fractions = [i / shards for i in range(1, shards)]
+    cur.execute("""
+        SELECT
+            MIN(repository_id),
+            MAX(repository_id),
+            PERCENTILE_DISC(%s::float8[]) WITHIN GROUP (ORDER BY repository_id)
+        FROM repository_latest_stars
+    """, (fractions,))
+    min_id, max_id, boundaries = cur.fetchone()
+    cur.close()
+
+    if min_id is None:
+        return []
+
+    edges = [min_id] + sorted(set(b for b in (boundaries or []) if min_id < b <= max_id)) + [max_id + 1]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+class ShardedExporter:
+
+    # The one export that reads Postgres directly instead of through RepositoryStore:
+    # each shard streams its id range over its own server-side cursor in parallel,
+    # which has no equivalent in the store interface or in SQLite. crawler_export
+    # exports a local store in one pass instead.
+
+    def __init__(self, db_url: str, shards: int = 4, formats: Tuple[str, ...] = ('csv',),
+                 output_dir: str = 'exports'):
+        unknown = [f for f in formats if f not in SHARD_FORMATS]
+        if unknown:
+            raise ValueError(f"Sharded export does not support: {', '.join(unknown)}")
+        if 'parquet' in formats and pa is None:
+            raise ImportError("Parquet export requires pyarrow (pip install pyarrow)")
+
+        self._db_url = db_url
+        self._shards = shards
+        self._formats = formats
+        self._output_dir = output_dir
+
+    def export(self, timestamp: str = None, merge: bool = False) -> Tuple[str, Tuple]:
+
+        timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+        os.makedirs(self._output_dir, exist_ok=True)
+
+        pool = ThreadedConnectionPool(1, self._shards, self._db_url)
+        try:
+            conn = pool.getconn()
+            try:
+                ranges = plan_id_ranges(conn, self._shards)
+            finally:
+                pool.putconn(conn)
+
+            with ThreadPoolExecutor(max_workers=self._shards) as executor:
+                results = list(executor.map(
+                    lambda args: self._export_shard(pool, timestamp, *args),
+                    [(index, lo, hi) for index, (lo, hi) in enumerate(ranges)]
+                ))
+        finally:
+            pool.closeall()
+
+        stats = ShardStats()
+        for shard_stats, _ in results:
+            stats.merge(shard_stats)
+
+        files = {fmt: [paths[fmt] for _, paths in results] for fmt in self._formats}
+        if merge:
+            files = self._merge_parts(files, timestamp)
+
+        manifest_path = os.path.join(self._output_dir, f'manifest_{timestamp}.json')
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': timestamp,
+                'columns': EXPORT_COLUMNS,
+                'shards': [
+                    {'id_from': lo, 'id_to': hi, 'rows': shard_stats.count, 'files': paths}
+                    for (lo, hi), (shard_stats, paths) in zip(ranges, results)
+                ],
+                'files': files,
+                'stats': dict(zip(['total_repos', 'total_stars', 'avg_stars', 'max_stars', 'min_stars'],
+                                  stats.as_tuple())),
+            }, f, indent=2)
+
+        print(f"Exported {stats.count} repositories in {len(ranges)} shards, manifest at {manifest_path}")
+        return manifest_path, stats.as_tuple()
+
+    def _export_shard(self, pool: ThreadedConnectionPool, timestamp: str,
+                      index: int, lo: int, hi: int) -> Tuple[ShardStats, Dict[str, str]]:
+
+        stats = ShardStats()
+        paths = {fmt: os.path.join(self._output_dir, f'repositories_{timestamp}_part{index:03d}.{fmt}')
+                 for fmt in self._formats}
+        files = {}
+        parquet_writer = None
+        schema = parquet_schema() if 'parquet' in paths else None
+
+        conn = pool.getconn()
+        try:
+            if 'csv' in paths:
+                files['csv'] = open(paths['csv'], 'w', newline='', encoding='utf-8')
+                csv_writer = csv.writer(files['csv'])
+                csv_writer.writerow(EXPORT_COLUMNS)
+            if 'ndjson' in paths:
+                files['ndjson'] = open(paths['ndjson'], 'w', encoding='utf-8')
+            if 'parquet' in paths:
+                parquet_writer = pq.ParquetWriter(paths['parquet'], schema,
+                                                  compression=os.environ.get('EXPORT_PARQUET_COMPRESSION', 'zstd'))
+
+            # Every format and the summary stats come out of the same pass over the shard.
+            for rows in stream_rows(conn, SHARD_QUERY, (lo, hi)):
+                for row in rows:
+                    stats.add(row[4])
+                if 'csv' in files:
+                    csv_writer.writerows(rows)
+                if 'ndjson' in files:
+                    for row in rows:
+                        files['ndjson'].write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=str))
+                        files['ndjson'].write('\n')
+                if parquet_writer:
+                    parquet_writer.write_table(pa.Table.from_arrays(
+                        [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+                        schema=schema
+                    ))
+
+            conn.commit()
+        finally:
+            for f in files.values():
+                f.close()
+            if parquet_writer:
+                parquet_writer.close()
+            pool.putconn(conn)
+
+        print(f"Shard {index}: exported {stats.count} repositories (ids {lo}..{hi - 1})")
+        return stats, paths
+
+    def _merge_parts(self, files: Dict[str, List[str]], timestamp: str) -> Dict[str, List[str]]:
+        # Every part is sorted by stars, so a k-way merge gives the same order as the
+        # unsharded export while holding one row per part.
+        merged = dict(files)
+        for fmt in ('csv', 'ndjson'):
+            if fmt not in files:
+                continue
+            merged_path = os.path.join(self._output_dir, f'repositories_{timestamp}.{fmt}')
+            with ExitStack() as stack, open(merged_path, 'w', newline='', encoding='utf-8') as out:
+                parts = [stack.enter_context(open(part, 'r', newline='', encoding='utf-8')) for part in files[fmt]]
+                if fmt == 'csv':
+                    readers = [csv.reader(f) for f in parts]
+                    for reader in readers:
+                        next(reader, None)
+                    writer = csv.writer(out)
+                    writer.writerow(EXPORT_COLUMNS)
+                    writer.writerows(heapq.merge(*readers, key=lambda row: -int(row[4])))
+                else:
+                    out.writelines(heapq.merge(*parts, key=lambda line: -json.loads(line)['star_count']))
+            for part in files[fmt]:
+                os.remove(part)
+            merged[fmt] = [merged_path]
+        return merged
+
+
+def run_sharded_export(shards: int, formats: List[str], merge: bool, timestamp: str = None) -> Tuple:
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+
+    sharded_formats = tuple(f for f in formats if f in SHARD_FORMATS)
+    exporter = ShardedExporter(os.environ['DATABASE_URL'], shards=shards, formats=sharded_formats)
+    _, stats = exporter.export(timestamp, merge=merge)
+    return stats
@@ -0,0 +1,425 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import random
+import re
+import time
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Tuple
+
+from shard_planner import GITHUB_EPOCH, SEARCH_RESULT_CAP
+
+
+# Synthetic ids sit in the same reserved range as bench_ingest so runs can be cleaned up.
+ID_OFFSET = 9_000_000_000
+
+STARS_RANGE = re.compile(r'stars:(\d+)\.\.(\d+)')
+STARS_MIN = re.compile(r'stars:>=?(\d+)')
+REST_REPOSITORY = re.compile(r'^/repositories/(\d+)$')
+CREATED_RANGE = re.compile(r'created:(\d{4}-\d{2}-\d{2})\.\.(\d{4}-\d{2}-\d{2})')
+# Aliased searches as GitHubClient's multi-search document writes them: alias, query
+# variable and cursor variable.
+MULTI_SEARCH = re.compile(r'(\w+): search\(query: \$(\w+), type: REPOSITORY, first: \$perPage, after: \$(\w+)\)')
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.b64encode(f"cursor:{offset}".encode()).decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    return int(base64.b64decode(cursor).decode().split(':', 1)[1])
+
+
+def node_id(index: int) -> str:
+    return f"R_bench{index:09d}"
+
+
+def is_deleted(index: int, deleted_rate: float) -> bool:
+    # Fixed per repository, so a check can work out which ones went away.
+    return (index * 2654435761) % 10_000 < deleted_rate * 10_000
+
+
+class SyntheticDataset:
+
+    # Heavy-tailed star counts and creation dates spread since GITHUB_EPOCH, held as
+    # parallel lists sorted by stars descending so a star range is a bisect away.
+
+    def __init__(self, repo_count: int = 200_000, seed: int = 1):
+        rng = random.Random(seed)
+        days = (date.today() - GITHUB_EPOCH).days
+        rows = sorted(
+            ((2 + int(rng.paretovariate(1.1)) - 1, rng.randint(0, days), i) for i in range(repo_count)),
+            reverse=True
+        )
+        self.stars = [row[0] for row in rows]
+        self.created_days = [row[1] for row in rows]
+        self.indexes = [row[2] for row in rows]
+        self._neg_stars = [-stars for stars in self.stars]
+        self._position = {index: position for position, index in enumerate(self.indexes)}
+        self._cache: Dict[str, List[int]] = {}
+        self._lock = Lock()
+
+    def search(self, query: str) -> List[int]:
+        with self._lock:
+            positions = self._cache.get(query)
+        if positions is not None:
+            return positions
+
+        stars_range = STARS_RANGE.search(query)
+        if stars_range:
+            low, high = int(stars_range[1]), int(stars_range[2])
+        else:
+            stars_min = STARS_MIN.search(query)
+            low, high = (int(stars_min[1]) if stars_min else 0), float('inf')
+
+        start = bisect_left(self._neg_stars, -high) if high != float('inf') else 0
+        end = bisect_right(self._neg_stars, -low)
+
+        created = CREATED_RANGE.search(query)
+        if created:
+            first_day = (date.fromisoformat(created[1]) - GITHUB_EPOCH).days
+            last_day = (date.fromisoformat(created[2]) - GITHUB_EPOCH).days
+            positions = [p for p in range(start, end) if first_day <= self.created_days[p] <= last_day]
+        else:
+            positions = range(start, end)
+
+        with self._lock:
+            self._cache[query] = positions
+        return positions
+
+    def node(self, position: int, star_bump: int = 0) -> Dict:
+        index = self.indexes[position]
+        created = (GITHUB_EPOCH + timedelta(days=self.created_days[position])).isoformat()
+        return {
+            'id': node_id(index),
+            'databaseId': ID_OFFSET + index,
+            'owner': {'login': f"bench-owner-{index % 5000}"},
+            'name': f"bench-repo-{index}",
+            'nameWithOwner': f"bench-owner-{index % 5000}/bench-repo-{index}",
+            'stargazerCount': self.stars[position] + star_bump,
+            'createdAt': f"{created}T00:00:00Z",
+            'updatedAt': "2024-01-01T00:00:00Z",
+        }
+
+    def position_of_database_id(self, database_id: int) -> Optional[int]:
+        return self._position.get(database_id - ID_OFFSET)
+
+    def position_of(self, graphql_id: str) -> Optional[int]:
+        if not graphql_id.startswith('R_bench'):
+            return None
+        return self._position.get(int(graphql_id[len('R_bench'):]))
+
+
+class FakeGitHubState:
+
+    def __init__(self, dataset: SyntheticDataset, latency: float = 0.0, jitter: float = 0.0,
+                 error_403_rate: float = 0.0, error_5xx_rate: float = 0.0, retry_after: float = 1.0,
+                 rate_limit: int = 5000, window_seconds: float = 3600, corpus: Optional[Dict[str, Dict]] = None,
+                 seed: int = 1, node_latency: float = 0.0, timeout_page_size: Optional[int] = None,
+                 alias_error_rate: float = 0.0, deleted_rate: float = 0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        # Search cost grows with the page: each node adds node_latency, and pages larger
+        # than timeout_page_size fail the way GitHub reports a query timeout.
+        self.node_latency = node_latency
+        self.timeout_page_size = timeout_page_size
+        # Each search in a multi-search fails on its own with this probability.
+        self.alias_error_rate = alias_error_rate
+        # Repositories deleted since they were crawled: search still lists them, but
+        # nodes() and REST lookups report them gone, the way GitHub does.
+        self.deleted_rate = deleted_rate
+        self.error_403_rate = error_403_rate
+        self.error_5xx_rate = error_5xx_rate
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.window_seconds = window_seconds
+        self.corpus = corpus or {}
+        self.requests = 0
+        self._budgets: Dict[str, Tuple[int, float]] = {}
+        self._rng = random.Random(seed)
+        self._lock = Lock()
+
+    def roll(self) -> Tuple[float, Optional[int]]:
+        with self._lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            draw = self._rng.random()
+        if draw < self.error_403_rate:
+            return delay, 403
+        if draw < self.error_403_rate + self.error_5xx_rate:
+            return delay, 502
+        return delay, None
+
+    def is_deleted(self, position: int) -> bool:
+        return is_deleted(self.dataset.indexes[position], self.deleted_rate)
+
+    def alias_fails(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.alias_error_rate
+
+    def spend(self, token: str, cost: int) -> Tuple[int, float]:
+        with self._lock:
+            now = time.time()
+            remaining, reset_at = self._budgets.get(token, (self.rate_limit, now + self.window_seconds))
+            if reset_at <= now:
+                remaining, reset_at = self.rate_limit, now + self.window_seconds
+            remaining = max(0, remaining - cost)
+            self._budgets[token] = (remaining, reset_at)
+            return remaining, reset_at
+
+
+class FakeGraphQLHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without TCP_NODELAY delayed ACKs add
+    # ~40ms to every keep-alive response.
+    disable_nagle_algorithm = True
+    state: FakeGitHubState = None
+
+    def do_GET(self):
+        if self.path.startswith('/stats'):
+            self._send(200, {'requests': self.state.requests})
+            return
+
+        rest_match = REST_REPOSITORY.match(self.path)
+        if not rest_match:
+            self._send(404, {'message': "Not Found"})
+            return
+
+        dataset = self.state.dataset
+        position = dataset.position_of_database_id(int(rest_match[1]))
+        if position is None or self.state.is_deleted(position):
+            self._send(404, {'message': "Not Found"})
+            return
+
+        node = dataset.node(position)
+        etag = f'W/"{node["stargazerCount"]}-{node["updatedAt"]}"'
+        if self.headers.get('If-None-Match') == etag:
+            # Conditional hits are free on the real API as well.
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        remaining, reset_at = self.state.spend('rest:' + self.headers.get('Authorization', ''), 1)
+        self._send(200, {
+            'id': node['databaseId'],
+            'node_id': node['id'],
+            'name': node['name'],
+            'full_name': node['nameWithOwner'],
+            'owner': {'login': node['owner']['login']},
+            'stargazers_count': node['stargazerCount'],
+            'created_at': node['createdAt'],
+            'updated_at': node['updatedAt'],
+        }, dict(self._rate_headers(remaining, reset_at), ETag=etag))
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        query = body.get('query', '')
+        variables = body.get('variables') or {}
+        token = self.headers.get('Authorization', '')
+
+        delay, error_status = self.state.roll()
+        if delay:
+            time.sleep(delay)
+
+        if error_status == 403:
+            self._send(403, {'message': "You have exceeded a secondary rate limit."},
+                       {'Retry-After': str(self.state.retry_after)})
+            return
+        if error_status:
+            self._send(error_status, {'message': "Server Error"})
+            return
+
+        remaining, reset_at = self.state.spend(token, 1)
+        if remaining <= 0:
+            self._send(403, {'message': "API rate limit exceeded"}, self._rate_headers(0, reset_at))
+            return
+
+        per_page = variables.get('perPage')
+        aliases = MULTI_SEARCH.findall(query)
+        if per_page and 'search(' in query:
+            if self.state.node_latency:
+                time.sleep(per_page * max(1, len(aliases)) * self.state.node_latency)
+            if self.state.timeout_page_size and per_page > self.state.timeout_page_size:
+                self._send(200, {'data': None, 'errors': [{'message': "Something went wrong while executing your "
+                                                           "query. This may be the result of a timeout, or it "
+                                                           "could be a GitHub bug."}]})
+                return
+
+        data = self.state.corpus.get(corpus_key(variables))
+        if data is None:
+            data = self._resolve(query, variables)
+        data = dict(data, rateLimit={
+            'cost': 1,
+            'remaining': remaining,
+            'resetAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(reset_at)),
+        })
+
+        payload = {'data': data}
+        if 'nodes(ids' in query:
+            missing = [(index, graphql_id) for index, (graphql_id, node)
+                       in enumerate(zip(variables.get('ids') or [], data.get('nodes') or [])) if node is None]
+            if missing:
+                payload['errors'] = [{'type': 'NOT_FOUND', 'path': ['nodes', index],
+                                      'message': f"Could not resolve to a node with the global id of '{graphql_id}'"}
+                                     for index, graphql_id in missing]
+        failed = [alias for alias, _, _ in aliases if self.state.alias_error_rate and self.state.alias_fails()]
+        if failed:
+            for alias in failed:
+                data[alias] = None
+            payload['errors'] = [{'message': "Something went wrong while executing your query. This may be the "
+                                             "result of a timeout, or it could be a GitHub bug.",
+                                  'path': [alias]} for alias in failed]
+        self._send(200, payload, self._rate_headers(remaining, reset_at))
+
+    def _resolve(self, query: str, variables: Dict) -> Dict:
+        dataset = self.state.dataset
+
+        if 'nodes(ids' in query:
+            positions = [dataset.position_of(graphql_id) for graphql_id in variables.get('ids') or []]
+            positions = [p if p is not None and not self.state.is_deleted(p) else None for p in positions]
+            # Refreshes see every repo one star up, so change-only writes have work to do.
+            return {'nodes': [dataset.node(p, star_bump=1) if p is not None else None for p in positions]}
+
+        per_page = variables.get('perPage') or 100
+        aliases = MULTI_SEARCH.findall(query)
+        if aliases:
+            return {alias: self._search_page(variables.get(query_name, ''), variables.get(cursor_name), per_page)
+                    for alias, query_name, cursor_name in aliases}
+
+        if 'repositoryCount' in query:
+            positions = dataset.search(variables.get('searchQuery', ''))
+            return {'search': {
+                'repositoryCount': len(positions),
+                'nodes': [{'stargazerCount': dataset.stars[positions[0]]}] if len(positions) else [],
+            }}
+
+        return {'search': self._search_page(variables.get('searchQuery', ''), variables.get('cursor'), per_page)}
+
+    def _search_page(self, search_query: str, cursor: Optional[str], per_page: int) -> Dict:
+        dataset = self.state.dataset
+        positions = dataset.search(search_query)
+        offset = decode_cursor(cursor)
+        reachable = min(len(positions), SEARCH_RESULT_CAP)
+        page = positions[offset:min(offset + per_page, reachable)]
+        end = offset + len(page)
+        return {
+            'pageInfo': {'hasNextPage': end < reachable, 'endCursor': encode_cursor(end) if page else None},
+            'nodes': [dataset.node(p) for p in page],
+        }
+
+    def _rate_headers(self, remaining: int, reset_at: float) -> Dict[str, str]:
+        return {
+            'X-RateLimit-Limit': str(self.state.rate_limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(reset_at)),
+        }
+
+    def _send(self, status: int, payload: Dict, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def corpus_key(variables: Dict) -> str:
+    return json.dumps(variables, sort_keys=True)
+
+
+def load_corpus(path: str) -> Dict[str, Dict]:
+    # One recorded exchange per line: {"variables": {...}, "data": {...}}.
+    corpus = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                corpus[corpus_key(entry['variables'])] = entry['data']
+    return corpus
+
+
+def start_server(state: FakeGitHubState, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    handler = type('BoundFakeGraphQLHandler', (FakeGraphQLHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}/graphql"
+
+
+def _serve_forever(ready, repo_count: int, state_options: Dict):
+    server = start_server(FakeGitHubState(SyntheticDataset(repo_count), **state_options))
+    ready.put(server_url(server))
+    while True:
+        time.sleep(3600)
+
+
+def start_server_process(repo_count: int = 200_000, **state_options) -> Tuple[multiprocessing.Process, str]:
+    # A separate process keeps the server's JSON work off the crawler's GIL, so
+    # benchmark numbers reflect the client side only.
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve_forever, args=(ready, repo_count, state_options), daemon=True)
+    process.start()
+    return process, ready.get(timeout=120)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the GitHub GraphQL API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--repos', type=int, default=200_000, help="size of the synthetic dataset")
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-403', type=float, default=0.0, help="fraction of requests answered with 403")
+    parser.add_argument('--error-5xx', type=float, default=0.0, help="fraction of requests answered with 502")
+    parser.add_argument('--rate-limit', type=int, default=5000, help="points per token per window")
+    parser.add_argument('--node-latency-ms', type=float, default=0.0, help="extra latency per search result")
+    parser.add_argument('--timeout-page-size', type=int, help="search pages larger than this time out")
+    parser.add_argument('--alias-error', type=float, default=0.0, help="fraction of aliased searches that fail")
+    parser.add_argument('--deleted', type=float, default=0.0, help="fraction of repositories lookups report deleted")
+    parser.add_argument('--corpus', help="JSONL of recorded responses to serve before synthetic data")
+    args = parser.parse_args()
+
+    state = FakeGitHubState(
+        SyntheticDataset(args.repos),
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_403_rate=args.error_403,
+        error_5xx_rate=args.error_5xx,
+        rate_limit=args.rate_limit,
+        node_latency=args.node_latency_ms / 1000,
+        timeout_page_size=args.timeout_page_size,
+        alias_error_rate=args.alias_error,
+        deleted_rate=args.deleted,
+        corpus=load_corpus(args.corpus) if args.corpus else None
+    )
+    server = start_server(state, args.host, args.port)
+    print(f"Fake GitHub GraphQL API on {server_url(server)} ({args.repos:,} repositories)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,26 @@
 import time
-from typing import Dict,Optional
+from functools import lru_cache
+from typing import Callable,Dict,List,Optional,Tuple,Union
 from threading import Lock
 import requests
+from requests.adapters import HTTPAdapter
 
+import metrics
+from rate_limiter import RateLimiter,TokenBudget,parse_reset_at
+from page_size import PageSizeController
+from response_cache import ResponseCache
 
 
-class GitHubClient:
-
-    BASE_URL="https://api.github.com/graphql"
+DEFAULT_SEARCH_QUERY="stars:>1 sort:stars-desc"
 
-    def __init__(self,token:str):
-        self._token=token
-        self._headers={
-            "Authorization":f"Bearer {token}",
-            "Content-Type":"application/json"
-        }
-        self._rate_limit_remaining=5000
-        self._rate_limit_reset_at=None
-        self._lock=Lock()
-
-    def fetch_repositories(self,cursor:Optional[str]=None,per_page:int=100)->Optional[Dict]:
-        query="""
-        query($cursor:String,$perPage:Int!){
+SEARCH_REPOSITORIES_QUERY="""
+        query($cursor:String,$perPage:Int!,$searchQuery:String!){
+            rateLimit{
+            cost
+            remaining
+            resetAt}
             search(
-            query: "stars:>1 sort:stars-desc"
+            query: $searchQuery
             type: REPOSITORY
             first: $perPage
             after: $cursor){
@@ -32,6 +29,7 @@ class GitHubClient:
             endCursor}
             nodes{
                 ... on Repository {
+                id
                 databaseId
                 owner{
                 login}
@@ -45,85 +43,514 @@ class GitHubClient:
          }
         }
         """
-        variables = {
-            "cursor": cursor,
-            "perPage": per_page
+
+NODES_QUERY="""
+        query($ids:[ID!]!){
+            rateLimit{
+            cost
+            remaining
+            resetAt}
+            nodes(ids: $ids){
+                ... on Repository {
+                id
+                databaseId
+                owner{
+                login}
+                name
+                nameWithOwner
+                stargazerCount
+                createdAt
+                updatedAt
+                }
+            }
+        }
+        """
+
+# Refresh passes only track stars, so they can skip the metadata fields.
+NODES_STARS_QUERY="""
+        query($ids:[ID!]!){
+            rateLimit{
+            cost
+            remaining
+            resetAt}
+            nodes(ids: $ids){
+                ... on Repository {
+                id
+                databaseId
+                stargazerCount
+                }
+            }
+        }
+        """
+
+REFRESH_FIELDS={'full':NODES_QUERY,'stars':NODES_STARS_QUERY}
+
+SEARCH_STATS_QUERY="""
+        query($searchQuery:String!){
+            rateLimit{
+            cost
+            remaining
+            resetAt}
+            search(query: $searchQuery, type: REPOSITORY, first: 1){
+            repositoryCount
+            nodes{
+                ... on Repository {
+                stargazerCount
+                }
+            }
+         }
+        }
+        """
+
+SEARCH_PAGE_FRAGMENT="""
+        fragment SearchPage on SearchResultItemConnection{
+            pageInfo{
+            hasNextPage
+            endCursor}
+            nodes{
+                ... on Repository {
+                id
+                databaseId
+                owner{
+                login}
+                name
+                nameWithOwner
+                stargazerCount
+                createdAt
+                updatedAt
+                }
+            }
+        }
+        """
+
+
+QUERY_NAMES={
+    SEARCH_REPOSITORIES_QUERY:'search',
+    NODES_QUERY:'nodes',
+    NODES_STARS_QUERY:'nodes_stars',
+    SEARCH_STATS_QUERY:'search_stats',
+}
+
+
+@lru_cache(maxsize=None)
+def multi_search_query(count:int)->str:
+    # Several search pages in one document, aliased s0..sN with variables $qN/$cN.
+    # Points are charged per page requested, so this costs no more than separate
+    # searches but pays for one round trip.
+    arguments=''.join(f",$q{i}:String!,$c{i}:String" for i in range(count))
+    searches=''.join(f"""
+            s{i}: search(query: $q{i}, type: REPOSITORY, first: $perPage, after: $c{i}){{
+            ...SearchPage}}""" for i in range(count))
+    query=f"""
+        query($perPage:Int!{arguments}){{
+            rateLimit{{
+            cost
+            remaining
+            resetAt}}{searches}
+        }}
+        {SEARCH_PAGE_FRAGMENT}"""
+    QUERY_NAMES[query]='search_batch'
+    return query
+
+
+class GraphQLExchange:
+
+    # One GraphQL request through its retries, minus the transport. It decides the
+    # token, the pacing and the page size of each attempt, what a response means, how
+    # long to back off, and keeps the rate limiter, page sizer, cache and metrics up to
+    # date. GitHubClient drives it over requests and AsyncGitHubClient over httpx; they
+    # only send and sleep.
+
+    def __init__(self,client:'GitHubClient',query:str,variables:Dict,max_retries:int=3,
+                 allow_partial:bool=False,resizable:bool=False):
+        self._client=client
+        self._query=query
+        self._variables=variables
+        self._request_variables=variables
+        self._max_retries=max_retries
+        self._allow_partial=allow_partial
+        self._resizable=resizable
+        self._attempt=-1
+        self._budget=None
+        # Set while a request is out, so a transport error can tell whether it got a response.
+        self._start=None
+        self.cached=client._cached_response(query,variables)
+
+    def next_attempt(self)->bool:
+        self._attempt+=1
+        self._start=None
+        return self._attempt<self._max_retries
+
+    def acquire(self)->float:
+        # Sizes the page and takes a token; returns how long to wait before sending.
+        if self._resizable:
+            self._request_variables=self._client._sized_variables(self._variables)
+        self._budget,wait_time=self._client._rate_limiter.acquire(self._client._query_costs.get(self._query,1))
+        metrics.API_PACING_SECONDS.observe(max(0.0,wait_time))
+        if wait_time>5:
+            print(f"Rate limit pacing, waiting {wait_time:.0f}s...")
+        return wait_time
+
+    def request(self)->Tuple[Dict,Dict]:
+        # JSON body and headers for the attempt.
+        self._start=time.perf_counter()
+        return {"query":self._query,"variables":self._request_variables},self._client._auth_headers(self._budget)
+
+    def response(self,status_code:int,headers,json_body:Callable[[],Dict])->Tuple[Optional[Dict],Optional[float]]:
+        # (result, None) when done, (None, delay) to retry after delay, and (None, None)
+        # for a status the caller should raise.
+        client,query=self._client,self._query
+        elapsed=time.perf_counter()-self._start
+        client._observe_request(query,status_code,self._start)
+        self._start=None
+
+        if status_code==200:
+            json_response=json_body()
+            client._record_rate_limit(self._budget,query,headers,json_response)
+            if self._resizable and client._is_query_timeout(json_response) and self._attempt<self._max_retries-1:
+                client._page_sizer.failure()
+                client._observe_retry(query,504,{})
+                return None,0
+            client._check_graphql_errors(json_response,self._allow_partial)
+            if self._resizable:
+                client._page_sizer.success(elapsed)
+            client._store_response(query,self._variables,json_response)
+            return json_response,None
+
+        client._record_rate_limit(self._budget,query,headers)
+        retry_delay=client._retry_delay(self._budget,status_code,headers,self._attempt)
+        if retry_delay is not None:
+            client._observe_retry(query,status_code,headers)
+            if self._resizable and status_code>=500:
+                client._page_sizer.failure()
+        return None,retry_delay
+
+    def transport_error(self)->Optional[float]:
+        # After a network error or a raised status: the delay before the next attempt,
+        # or None when this was the last one and the error should propagate.
+        client,query=self._client,self._query
+        # _start is only still set if the request itself never got a response.
+        client._observe_request(query,'error',self._start)
+        if self._attempt==self._max_retries-1:
+            return None
+        metrics.API_RETRIES.inc(query=QUERY_NAMES.get(query,'other'),
+                                cause='network' if self._start is not None else 'http_error')
+        if self._resizable and self._start is not None:
+            client._page_sizer.failure()
+        return 2**self._attempt
+
+
+class GitHubClient:
+
+    BASE_URL="https://api.github.com/graphql"
+    REST_BASE_URL="https://api.github.com"
+
+    def __init__(self,tokens:Union[str,List[str]],max_connections:int=20,
+                 rate_limiter:Optional[RateLimiter]=None,base_url:Optional[str]=None,
+                 response_cache:Optional[ResponseCache]=None,page_sizer:Optional[PageSizeController]=None):
+        if isinstance(tokens,str):
+            tokens=[tokens]
+        self._rate_limiter=rate_limiter or RateLimiter(tokens)
+        # REST has its own per-token budget, separate from GraphQL points.
+        self._rest_rate_limiter=RateLimiter(tokens)
+        self._base_url=base_url or self.BASE_URL
+        self._rest_base_url=base_url.rsplit('/graphql',1)[0] if base_url else self.REST_BASE_URL
+        self._response_cache=response_cache
+        self._page_sizer=page_sizer or PageSizeController()
+        self._headers={
+            "Content-Type":"application/json"
         }
+        self._query_costs={}
+        self._lock=Lock()
+        self._max_connections=max_connections
+        self._session=None
+
+    def fetch_repositories(self,cursor:Optional[str]=None,per_page:int=100,
+                           search_query:str=DEFAULT_SEARCH_QUERY)->Optional[Dict]:
+        variables = self._repositories_variables(cursor, per_page, search_query)
         try:
-            result = self._execute_with_retry(query, variables)
-            if result and 'data' in result and result.get('data'):
-                return result
-            elif result and 'errors' in result:
-                error_messages = [err.get('message', 'Unknown error') for err in result.get('errors', [])]
-                print(f"GraphQL API errors: {', '.join(error_messages)}")
-                return None
-            else:
-                print(f"Unexpected API response format: {result}")
-                return None
+            result = self._execute_with_retry(SEARCH_REPOSITORIES_QUERY, variables, resizable=True)
+            return self._validate_result(result)
         except Exception as e:
             print(f"Error fetching repositories: {e}")
             import traceback
             traceback.print_exc()
             return None
-    
 
-    def _execute_with_retry(self,query:str,variables:Dict, max_retries:int=3)->Dict:
+    def fetch_repositories_batch(self,searches:List[Tuple[str,Optional[str]]],
+                                 per_page:int=100)->List[Optional[Dict]]:
+        # One request for several (search_query, cursor) pages. Each result has the shape
+        # fetch_repositories returns, or is None where that search failed. Searches that
+        # fail on their own are sent once more together.
+        results:List[Optional[Dict]]=[None]*len(searches)
+        indexes=list(range(len(searches)))
+        for attempt in range(2):
+            query=multi_search_query(len(indexes))
+            variables=self._multi_search_variables([searches[i] for i in indexes],per_page)
+            try:
+                result=self._execute_with_retry(query,variables,allow_partial=True,resizable=True)
+            except Exception as e:
+                print(f"Error fetching {len(indexes)} search pages: {e}")
+                return results
+            indexes=self._split_search_batch(result,indexes,results)
+            if not indexes:
+                break
+        return results
+
+    def fetch_nodes(self,node_ids:List[str],fields:str='full')->Optional[Dict]:
+        # Deleted or renamed-away repositories come back as null nodes with NOT_FOUND
+        # errors, so partial data is accepted here.
+        try:
+            result = self._execute_with_retry(REFRESH_FIELDS[fields], {"ids": node_ids}, allow_partial=True)
+            return self._validate_result(result)
+        except Exception as e:
+            print(f"Error fetching {len(node_ids)} nodes: {e}")
+            return None
+
+    def search_stats(self,search_query:str)->Optional[Tuple[int,Optional[int]]]:
+        try:
+            result = self._execute_with_retry(SEARCH_STATS_QUERY, {"searchQuery": search_query})
+            return self._parse_search_stats(result)
+        except Exception as e:
+            print(f"Error counting repositories for '{search_query}': {e}")
+            return None
+
+    def fetch_repository_rest(self,repository_id:int,etag:Optional[str]=None)->Tuple[Optional[Dict],Optional[str]]:
+        # Fallback for rows stored before node ids were kept. With an ETag the request is
+        # conditional, and a 304 does not count against the rate limit; (None, etag)
+        # means unchanged. A repository that no longer exists returns (None, None).
+        headers={"Accept":"application/vnd.github+json"}
+        if etag:
+            headers["If-None-Match"]=etag
+
+        for attempt in range(3):
+            budget,wait_time=self._rest_rate_limiter.acquire(0 if etag else 1)
+            if wait_time>0:
+                time.sleep(wait_time)
+
+            headers.update(self._auth_headers(budget))
+            response=self._get_session().get(f"{self._rest_base_url}/repositories/{repository_id}",
+                                             headers=headers,timeout=30)
+            if response.status_code==304:
+                metrics.REST_CONDITIONAL.inc(result='not_modified')
+                return None,etag
 
-        for attempt in range(max_retries):
+            remaining=response.headers.get("X-RateLimit-Remaining")
+            reset_at=response.headers.get("X-RateLimit-Reset")
+            self._rest_rate_limiter.record(budget,int(remaining) if remaining is not None else None,
+                                           int(reset_at) if reset_at is not None else None)
+
+            if response.status_code==200:
+                metrics.REST_CONDITIONAL.inc(result='modified')
+                return response.json(),response.headers.get("ETag")
+            if response.status_code in (404,451):
+                metrics.REST_CONDITIONAL.inc(result='not_found')
+                return None,None
+
+            if response.status_code in (403,429):
+                if "Retry-After" in response.headers:
+                    self._rest_rate_limiter.penalize(budget,float(response.headers["Retry-After"]))
+                elif remaining=="0":
+                    self._rest_rate_limiter.exhaust(budget)
+                continue
+            if response.status_code>=500:
+                time.sleep(2**attempt)
+                continue
+            response.raise_for_status()
+
+        raise Exception(f"Max retries exceeded fetching repository {repository_id}")
+
+    def close(self):
+        if self._session:
+            self._session.close()
+            self._session=None
+
+    def _repositories_variables(self,cursor:Optional[str],per_page:int,search_query:str)->Dict:
+        return {
+            "cursor": cursor,
+            "perPage": per_page,
+            "searchQuery": search_query
+        }
+
+    def _multi_search_variables(self,searches:List[Tuple[str,Optional[str]]],per_page:int)->Dict:
+        variables={"perPage":per_page}
+        for i,(search_query,cursor) in enumerate(searches):
+            variables[f"q{i}"]=search_query
+            variables[f"c{i}"]=cursor
+        return variables
+
+    def _split_search_batch(self,result:Dict,indexes:List[int],results:List[Optional[Dict]])->List[int]:
+        # Hands each alias back to its caller's slot and returns the slots that failed.
+        # Errors name their alias as the first path element; an alias without data
+        # counts as failed whether or not an error mentions it.
+        data=result.get('data') or {}
+        errors={}
+        for err in result.get('errors') or []:
+            path=err.get('path') or []
+            if path:
+                errors.setdefault(path[0],err.get('message','Unknown error'))
+
+        failed=[]
+        timed_out=False
+        for position,index in enumerate(indexes):
+            alias=f"s{position}"
+            search=data.get(alias)
+            if search is None:
+                message=errors.get(alias,'no data returned')
+                print(f"Search {alias} failed: {message}")
+                timed_out=timed_out or 'timeout' in message.lower()
+                failed.append(index)
+                continue
+            results[index]={'data':{'search':search,'rateLimit':data.get('rateLimit')}}
+        # One request timing out is one signal to the page sizer, however many aliases it took down.
+        if timed_out:
+            self._page_sizer.failure()
+        return failed
+
+    def _validate_result(self,result:Optional[Dict])->Optional[Dict]:
+        if result and 'data' in result and result.get('data'):
+            return result
+        elif result and 'errors' in result:
+            error_messages = [err.get('message', 'Unknown error') for err in result.get('errors', [])]
+            print(f"GraphQL API errors: {', '.join(error_messages)}")
+            return None
+        else:
+            print(f"Unexpected API response format: {result}")
+            return None
+
+    def _parse_search_stats(self,result:Optional[Dict])->Optional[Tuple[int,Optional[int]]]:
+        search = (result or {}).get('data', {}).get('search')
+        if not search:
+            print(f"Unexpected API response format: {result}")
+            return None
+        nodes = search.get('nodes') or []
+        top_stars = nodes[0].get('stargazerCount') if nodes and nodes[0] else None
+        return search.get('repositoryCount', 0), top_stars
+
+    def _get_session(self)->requests.Session:
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session=requests.Session()
+                    adapter=HTTPAdapter(pool_connections=1,pool_maxsize=self._max_connections)
+                    session.mount("https://",adapter)
+                    session.mount("http://",adapter)
+                    session.headers.update(self._headers)
+                    self._session=session
+        return self._session
+
+    def _cached_response(self,query:str,variables:Dict)->Optional[Dict]:
+        if not self._response_cache:
+            return None
+        cached=self._response_cache.get(query,variables)
+        metrics.RESPONSE_CACHE_REQUESTS.inc(query=QUERY_NAMES.get(query,'other'),result='hit' if cached else 'miss')
+        return cached
+
+    def _store_response(self,query:str,variables:Dict,json_response:Dict):
+        if self._response_cache:
+            self._response_cache.put(query,variables,json_response)
+
+    def _execute_with_retry(self,query:str,variables:Dict, max_retries:int=3,allow_partial:bool=False,
+                            resizable:bool=False)->Dict:
+
+        exchange=GraphQLExchange(self,query,variables,max_retries,allow_partial,resizable)
+        if exchange.cached:
+            return exchange.cached
+
+        while exchange.next_attempt():
             try:
-                with self._lock:
-                    self._check_rate_limit()
-                
-                response= requests.post(
-                    self.BASE_URL,
-                    json={"query":query,"variables":variables},
-                    headers=self._headers,
-                    timeout=30
-                )
-
-                with self._lock:
-                    self._update_rate_limit(response.headers)
-
-                if response.status_code==200:
-                    json_response = response.json()
-                    # Check for GraphQL errors in response
-                    if 'errors' in json_response:
-                        error_messages = [err.get('message', 'Unknown error') for err in json_response.get('errors', [])]
-                        raise Exception(f"GraphQL errors: {', '.join(error_messages)}")
-                    return json_response
-                if response.status_code==403:
-                    self._wait_for_rate_limit_reset()
-                    continue
-                if response.status_code>=500:
-                    wait=2**attempt
-                    time.sleep(wait)
+                wait_time=exchange.acquire()
+                if wait_time>0:
+                    time.sleep(wait_time)
+
+                body,headers=exchange.request()
+                response=self._get_session().post(self._base_url,json=body,headers=headers,timeout=30)
+                result,retry_delay=exchange.response(response.status_code,response.headers,response.json)
+                if result is not None:
+                    return result
+                if retry_delay is not None:
+                    time.sleep(retry_delay)
                     continue
 
                 response.raise_for_status()
 
-            except requests.exceptions.RequestException as e:
-                if attempt ==max_retries-1:
+            except requests.exceptions.RequestException:
+                retry_delay=exchange.transport_error()
+                if retry_delay is None:
                     raise
-                time.sleep(2**attempt)
-        
+                time.sleep(retry_delay)
+
         raise Exception("Max retries exceeded")
-    
-    def _check_rate_limit(self):
-        if self._rate_limit_remaining < 50:
-            self._wait_for_rate_limit_reset()
 
-    def _update_rate_limit(self,headers:Dict):
-        if "X-RateLimit-Remaining" in headers:
-            self._rate_limit_remaining=int(headers["X-RateLimit-Remaining"])
+    def _sized_variables(self,variables:Dict)->Dict:
+        per_page=self._page_sizer.page_size(variables["perPage"])
+        metrics.API_PAGE_SIZE.set(per_page)
+        return dict(variables,perPage=per_page)
+
+    def _is_query_timeout(self,json_response:Dict)->bool:
+        # GitHub reports server-side query timeouts as a 200 with an error and no data.
+        # In a multi-search any alias with results means the query as a whole ran.
+        data=json_response.get('data') or {}
+        if any(isinstance(value,dict) and value.get('nodes') is not None
+               for key,value in data.items() if key!='rateLimit'):
+            return False
+        return any('timeout' in (err.get('message') or '').lower() for err in json_response.get('errors') or [])
+
+    def _check_graphql_errors(self,json_response:Dict,allow_partial:bool=False)->Dict:
+        if 'errors' in json_response and not (allow_partial and json_response.get('data')):
+            error_messages = [err.get('message', 'Unknown error') for err in json_response.get('errors', [])]
+            raise Exception(f"GraphQL errors: {', '.join(error_messages)}")
+        return json_response
+
+    def _auth_headers(self,budget:TokenBudget)->Dict:
+        return {"Authorization":f"Bearer {budget.token}"}
+
+    def _retry_delay(self,budget:TokenBudget,status_code:int,headers:Dict,attempt:int)->Optional[float]:
+        if status_code in (403,429):
+            # Secondary limits say how long to back off; primary exhaustion blocks the
+            # token until its reset. Either way the next attempt may use another token.
+            if "Retry-After" in headers:
+                self._rate_limiter.penalize(budget,float(headers["Retry-After"]))
+            elif headers.get("X-RateLimit-Remaining")=="0":
+                self._rate_limiter.exhaust(budget)
+            else:
+                self._rate_limiter.penalize(budget,60)
+            return 0
+        if status_code>=500:
+            return 2**attempt
+        return None
 
-        if "X-RateLimit-Reset" in headers:
-            self._rate_limit_reset_at = int(headers["X-RateLimit-Reset"])
+    def _observe_request(self,query:str,status,start:Optional[float]):
+        if start is not None:
+            metrics.API_REQUEST_SECONDS.observe(time.perf_counter()-start,query=QUERY_NAMES.get(query,'other'),status=status)
 
-    def _wait_for_rate_limit_reset(self):
-        if self._rate_limit_reset_at:
-            wait_time = max(0, self._rate_limit_reset_at - time.time())
-            if wait_time > 0:
-                print(f"Rate limit reached, waiting {wait_time:.0f}s...")
-                time.sleep(wait_time + 1)
+    def _observe_retry(self,query:str,status_code:int,headers:Dict):
+        if status_code>=500:
+            cause='server_error'
+        elif "Retry-After" in headers:
+            cause='secondary_rate_limit'
+        elif headers.get("X-RateLimit-Remaining")=="0":
+            cause='rate_limit'
+        else:
+            cause='forbidden'
+        metrics.API_RETRIES.inc(query=QUERY_NAMES.get(query,'other'),cause=cause)
 
+    def _record_rate_limit(self,budget:TokenBudget,query:str,headers:Dict,json_response:Optional[Dict]=None):
+        rate_limit=((json_response or {}).get('data') or {}).get('rateLimit')
+        if rate_limit:
+            self._query_costs[query]=max(1,rate_limit.get('cost') or 1)
+            metrics.API_COST.inc(rate_limit.get('cost') or 0,query=QUERY_NAMES.get(query,'other'))
+            if rate_limit.get('remaining') is not None:
+                metrics.API_RATE_LIMIT_REMAINING.set(rate_limit['remaining'],token=budget.index)
+            self._rate_limiter.record(budget,rate_limit.get('remaining'),parse_reset_at(rate_limit.get('resetAt')))
+            return
 
+        remaining=headers.get("X-RateLimit-Remaining")
+        reset_at=headers.get("X-RateLimit-Reset")
+        limit=headers.get("X-RateLimit-Limit")
+        self._rate_limiter.record(
+            budget,
+            int(remaining) if remaining is not None else None,
+            int(reset_at) if reset_at is not None else None,
+            int(limit) if limit is not None else None
+        )
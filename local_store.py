@@ -0,0 +1,398 @@
+import csv
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Iterator, List, Optional, Tuple
+
+import psycopg2
+
+import metrics
+from checkpoints import ShardProgress
+from models import DB_ID, STAR_COUNT, RepositoryRecord
+from repository import CHANGED_AT_UPDATE
+from storage import RepositoryStore
+
+
+DEFAULT_STORE_PATH = 'data/crawl.sqlite'
+
+# Timestamps are ISO 8601 text: the API's own strings for created/updated, UTC with
+# microseconds for crawl times, so they sort as text and load into TIMESTAMPTZ as-is.
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS repositories(
+        id INTEGER PRIMARY KEY,
+        owner TEXT NOT NULL,
+        name TEXT NOT NULL,
+        full_name TEXT NOT NULL,
+        created_at TEXT,
+        updated_at TEXT,
+        last_crawled_at TEXT NOT NULL,
+        node_id TEXT,
+        rest_etag TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS repository_stars(
+        repository_id INTEGER NOT NULL,
+        star_count INTEGER NOT NULL,
+        observed_at TEXT NOT NULL
+    )
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_stars_repo_observed ON repository_stars(repository_id, observed_at)",
+    """
+    CREATE TABLE IF NOT EXISTS repository_latest_stars(
+        repository_id INTEGER PRIMARY KEY,
+        star_count INTEGER NOT NULL,
+        observed_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_latest_stars_star_count ON repository_latest_stars(star_count DESC)",
+    # How far each table has been copied to Postgres. Star rows are append-only, so
+    # their rowid is the watermark; repositories are re-sent once crawled again.
+    """
+    CREATE TABLE IF NOT EXISTS sync_watermarks(
+        target TEXT PRIMARY KEY,
+        stars_rowid INTEGER NOT NULL,
+        crawled_at TEXT NOT NULL
+    )
+    """,
+)
+
+EXPORT_SQL = """
+    SELECT r.id, r.full_name, r.owner, r.name, rs.star_count, r.created_at, r.updated_at, rs.observed_at
+    FROM repository_latest_stars rs
+    JOIN repositories r ON r.id = rs.repository_id
+    ORDER BY rs.star_count DESC
+"""
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='microseconds')
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+class SQLiteRepositoryStore(RepositoryStore):
+
+    # Embedded store for single-node crawls: every commit goes to a local WAL file
+    # instead of over the network. SQLite takes one writer at a time, so writes share
+    # one connection behind a lock and the write pipeline runs a single writer, while
+    # exports read from their own connections alongside it. Crawl checkpoints, the
+    # refresh scheduler and trends stay in Postgres; sync_to_postgres() bulk-loads
+    # everything written since the previous sync.
+
+    def __init__(self, path: str = DEFAULT_STORE_PATH, star_write_mode: str = 'all',
+                 star_heartbeat_seconds: float = 24 * 3600):
+        super().__init__(star_write_mode, star_heartbeat_seconds)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._path = path
+        self._write_lock = Lock()
+        self._conn = self._connect()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        for statement in SCHEMA:
+            self._conn.execute(statement)
+
+    @property
+    def max_connections(self) -> int:
+        return 1
+
+    def upsert_batch(self, repositories: List[RepositoryRecord], run_id: Optional[int] = None,
+                     progress: Optional[List[ShardProgress]] = None) -> int:
+        self._check_no_checkpoints(run_id, progress)
+        if not repositories:
+            return 0
+
+        star_repositories = self._select_star_observations(repositories)
+        now = _now()
+
+        with self._write_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("""
+                    INSERT INTO repositories(id, owner, name, full_name, created_at, updated_at, node_id, last_crawled_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        updated_at = excluded.updated_at,
+                        node_id = COALESCE(excluded.node_id, repositories.node_id),
+                        last_crawled_at = excluded.last_crawled_at
+                """, [r[:STAR_COUNT] + r[STAR_COUNT + 1:] + (now,) for r in repositories])
+                self._write_stars([(r[DB_ID], r[STAR_COUNT]) for r in star_repositories], now)
+                self._conn.execute("COMMIT")
+
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        self._mark_recorded(star_repositories)
+        metrics.DB_ROWS_WRITTEN.inc(len(repositories))
+        return len(repositories)
+
+    def refresh_stars(self, repositories: List[RepositoryRecord], run_id: Optional[int] = None,
+                      progress: Optional[List[ShardProgress]] = None) -> int:
+        self._check_no_checkpoints(run_id, progress)
+        if not repositories:
+            return 0
+
+        star_repositories = self._select_star_observations(repositories)
+        stars = {r[DB_ID]: r[STAR_COUNT] for r in star_repositories}
+        now = _now()
+
+        with self._write_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("UPDATE repositories SET last_crawled_at = ? WHERE id = ?",
+                                       [(now, r[DB_ID]) for r in repositories])
+                self._write_stars(list(stars.items()), now)
+                self._conn.execute("COMMIT")
+
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        self._mark_recorded(star_repositories)
+        metrics.DB_ROWS_WRITTEN.inc(len(repositories))
+        return len(repositories)
+
+    def record_rest_validation(self, etags: List[Tuple[int, str]], unchanged_ids: List[int]):
+        if not etags and not unchanged_ids:
+            return
+
+        now = _now()
+        with self._write_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("UPDATE repositories SET rest_etag = ? WHERE id = ?",
+                                       [(etag, repository_id) for repository_id, etag in etags])
+                self._conn.executemany("UPDATE repositories SET last_crawled_at = ? WHERE id = ?",
+                                       [(now, repository_id) for repository_id in unchanged_ids])
+                self._conn.execute("COMMIT")
+
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete_repositories(self, repository_ids: List[int]) -> int:
+        # Only the local copy; sync_to_postgres() carries upserts, not deletions.
+        if not repository_ids:
+            return 0
+
+        rows = [(repository_id,) for repository_id in repository_ids]
+        with self._write_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("DELETE FROM repository_stars WHERE repository_id = ?", rows)
+                self._conn.executemany("DELETE FROM repository_latest_stars WHERE repository_id = ?", rows)
+                deleted = self._conn.executemany("DELETE FROM repositories WHERE id = ?", rows).rowcount
+                self._conn.execute("COMMIT")
+
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return deleted
+
+    def latest_stars(self, chunk_size: int = 10_000, limit: Optional[int] = None) -> Iterator[List[Tuple]]:
+        conn = self._connect()
+        try:
+            cursor = conn.execute(EXPORT_SQL) if limit is None else conn.execute(EXPORT_SQL + " LIMIT ?", (limit,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [row[:5] + (_parse_time(row[5]), _parse_time(row[6]), _parse_time(row[7])) for row in rows]
+        finally:
+            conn.close()
+
+    def export_stats(self) -> Tuple:
+        conn = self._connect()
+        try:
+            return conn.execute("""
+                SELECT COUNT(*), SUM(star_count), AVG(star_count), MAX(star_count), MIN(star_count)
+                FROM repository_latest_stars
+            """).fetchone()
+        finally:
+            conn.close()
+
+    def get_count(self) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM repositories").fetchone()[0]
+        finally:
+            conn.close()
+
+    def sync_to_postgres(self, db_url: str) -> Tuple[int, int]:
+        # Copies repositories crawled and star rows written since the last sync into
+        # Postgres in one transaction: COPY into staging tables, then one merge per
+        # table. Writes wait while it runs so the watermarks match what was sent.
+        with self._write_lock:
+            row = self._conn.execute(
+                "SELECT stars_rowid, crawled_at FROM sync_watermarks WHERE target = 'postgres'").fetchone()
+            stars_rowid, crawled_at = row or (0, '')
+
+            with tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as repositories_file, \
+                    tempfile.TemporaryFile('w+', newline='', encoding='utf-8') as stars_file:
+                repository_count, last_crawled_at = 0, crawled_at
+                writer = csv.writer(repositories_file)
+                for repository in self._conn.execute("""
+                    SELECT id, owner, name, full_name, created_at, updated_at, last_crawled_at, node_id, rest_etag
+                    FROM repositories WHERE last_crawled_at > ?
+                """, (crawled_at,)):
+                    writer.writerow(repository)
+                    repository_count += 1
+                    last_crawled_at = max(last_crawled_at, repository[6])
+
+                star_count, last_rowid = 0, stars_rowid
+                writer = csv.writer(stars_file)
+                for star in self._conn.execute("""
+                    SELECT rowid, repository_id, star_count, observed_at
+                    FROM repository_stars WHERE rowid > ? ORDER BY rowid
+                """, (stars_rowid,)):
+                    writer.writerow(star[1:])
+                    star_count += 1
+                    last_rowid = star[0]
+
+                repositories_file.seek(0)
+                stars_file.seek(0)
+                _merge_into_postgres(db_url, repositories_file, stars_file)
+
+            self._conn.execute("""
+                INSERT INTO sync_watermarks(target, stars_rowid, crawled_at) VALUES ('postgres', ?, ?)
+                ON CONFLICT(target) DO UPDATE SET stars_rowid = excluded.stars_rowid, crawled_at = excluded.crawled_at
+            """, (last_rowid, last_crawled_at))
+
+        print(f"Synced {repository_count:,} repositories and {star_count:,} star observations to Postgres")
+        return repository_count, star_count
+
+    def close(self):
+        self._conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode: the write paths open their own IMMEDIATE transactions.
+        conn = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _check_no_checkpoints(self, run_id: Optional[int], progress: Optional[List[ShardProgress]]):
+        if run_id is not None and progress:
+            raise ValueError("Crawl checkpoints are kept in Postgres, run local crawls without them")
+
+    def _write_stars(self, stars: List[Tuple[int, int]], now: str):
+        if not stars:
+            return
+        rows = [(repository_id, star_count, now) for repository_id, star_count in stars]
+        self._conn.executemany("""
+            INSERT INTO repository_stars(repository_id, star_count, observed_at) VALUES (?, ?, ?)
+            ON CONFLICT(repository_id, observed_at) DO UPDATE SET star_count = excluded.star_count
+        """, rows)
+        self._conn.executemany("""
+            INSERT INTO repository_latest_stars(repository_id, star_count, observed_at) VALUES (?, ?, ?)
+            ON CONFLICT(repository_id) DO UPDATE SET
+                star_count = excluded.star_count,
+                observed_at = excluded.observed_at
+            WHERE repository_latest_stars.observed_at <= excluded.observed_at
+        """, rows)
+
+    def _fetch_last_recorded_stars(self) -> List[Tuple[int, int, float]]:
+        conn = self._connect()
+        try:
+            return [(repository_id, star_count, _parse_time(observed_at).timestamp())
+                    for repository_id, star_count, observed_at
+                    in conn.execute("SELECT repository_id, star_count, observed_at FROM repository_latest_stars")]
+        finally:
+            conn.close()
+
+
+def _merge_into_postgres(db_url: str, repositories_file, stars_file):
+    conn = psycopg2.connect(db_url)
+
+    try:
+        curr = conn.cursor()
+        curr.execute("""
+            CREATE TEMP TABLE staging_local_repositories(
+                id BIGINT NOT NULL,
+                owner VARCHAR(255) NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                full_name VARCHAR(512) NOT NULL,
+                created_at TIMESTAMPTZ,
+                updated_at TIMESTAMPTZ,
+                last_crawled_at TIMESTAMPTZ NOT NULL,
+                node_id VARCHAR(64),
+                rest_etag VARCHAR(255)
+            ) ON COMMIT DROP
+        """)
+        curr.execute("""
+            CREATE TEMP TABLE staging_local_stars(
+                repository_id BIGINT NOT NULL,
+                star_count INTEGER NOT NULL,
+                observed_at TIMESTAMPTZ NOT NULL
+            ) ON COMMIT DROP
+        """)
+        curr.copy_expert("COPY staging_local_repositories FROM STDIN WITH (FORMAT csv)", repositories_file)
+        curr.copy_expert("COPY staging_local_stars FROM STDIN WITH (FORMAT csv)", stars_file)
+
+        # changed_at is the sync time rather than the local crawl time: delta exports
+        # compare it with their own Postgres-side watermark.
+        curr.execute(f"""
+            INSERT INTO repositories(id, owner, name, full_name, created_at, updated_at, last_crawled_at,
+                                     node_id, rest_etag, changed_at)
+            SELECT id, owner, name, full_name, created_at, updated_at, last_crawled_at, node_id, rest_etag, NOW()
+            FROM staging_local_repositories
+            ON CONFLICT (id)
+            DO UPDATE SET
+                          updated_at = EXCLUDED.updated_at,
+                          node_id = COALESCE(EXCLUDED.node_id, repositories.node_id),
+                          rest_etag = COALESCE(EXCLUDED.rest_etag, repositories.rest_etag),
+                          last_crawled_at = GREATEST(repositories.last_crawled_at, EXCLUDED.last_crawled_at),
+                          {CHANGED_AT_UPDATE}
+        """)
+        curr.execute("""
+            UPDATE repositories r SET changed_at = NOW()
+            FROM (
+                SELECT DISTINCT ON (repository_id) repository_id, star_count
+                FROM staging_local_stars
+                ORDER BY repository_id, observed_at DESC
+            ) s
+            JOIN repository_latest_stars ls ON ls.repository_id = s.repository_id
+            WHERE r.id = s.repository_id
+              AND ls.star_count <> s.star_count
+              AND r.changed_at IS DISTINCT FROM NOW()
+        """)
+        curr.execute("""
+            INSERT INTO repository_stars (repository_id, star_count, observed_at)
+            SELECT repository_id, star_count, observed_at
+            FROM staging_local_stars
+            ON CONFLICT (repository_id, observed_at) DO NOTHING
+        """)
+        curr.execute("""
+            INSERT INTO repository_latest_stars (repository_id, star_count, observed_at)
+            SELECT DISTINCT ON (repository_id) repository_id, star_count, observed_at
+            FROM staging_local_stars
+            ORDER BY repository_id, observed_at DESC
+            ON CONFLICT (repository_id)
+            DO UPDATE SET star_count = EXCLUDED.star_count, observed_at = EXCLUDED.observed_at
+            WHERE repository_latest_stars.observed_at <= EXCLUDED.observed_at
+        """)
+        conn.commit()
+        curr.close()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    store = SQLiteRepositoryStore(os.environ.get('LOCAL_STORE_PATH', DEFAULT_STORE_PATH))
+    try:
+        store.sync_to_postgres(os.environ['DATABASE_URL'])
+    finally:
+        store.close()
@@ -1,38 +1,207 @@
+import argparse
+import hashlib
 import os
+from checkpoints import CheckpointStore
+from coordinator import CrawlCoordinator
 from crawler_service import CrawlerService
 from github_client import GitHubClient
+from local_store import DEFAULT_STORE_PATH, SQLiteRepositoryStore
+from metrics import SnapshotWriter, start_http_server
+from page_size import PageSizeController
+from partitions import ensure_upcoming_partitions
+from refresh_scheduler import RefreshScheduler
 from repository import RepositoryRepository
+from response_cache import ResponseCache
+from storage import STORAGE_BACKENDS
 
 
 def main():
+
+    parser = argparse.ArgumentParser(description="Crawl GitHub repository star counts")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true',
+                      help="continue the most recent interrupted crawl from its checkpoints")
+    mode.add_argument('--refresh', action='store_true',
+                      help="re-fetch only the most stale known repositories within REFRESH_BUDGET points")
+    mode.add_argument('--worker', action='store_true',
+                      help="join the crawl run named by CRAWL_RUN_KEY and take shards from the shared queue "
+                           "alongside other workers")
+    args = parser.parse_args()
     
-    github_token = os.environ.get('GITHUB_TOKEN')
-    if not github_token:
+    # GITHUB_TOKENS (or GITHUB_TOKEN) may hold several comma-separated tokens, each
+    # gets its own rate-limit budget.
+    github_tokens = [
+        token.strip()
+        for token in (os.environ.get('GITHUB_TOKENS') or os.environ.get('GITHUB_TOKEN') or '').split(',')
+        if token.strip()
+    ]
+    if not github_tokens:
         raise ValueError("GITHUB_TOKEN environment variable is required")
     
+    # STORAGE_BACKEND=sqlite crawls into an embedded SQLite file at LOCAL_STORE_PATH at
+    # local disk speed, without checkpoints; `python local_store.py` bulk-loads it into
+    # DATABASE_URL afterwards. Refresh passes and worker mode need Postgres.
+    storage_backend = os.environ.get('STORAGE_BACKEND', 'postgres')
+    if storage_backend not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{storage_backend}', expected one of {', '.join(STORAGE_BACKENDS)}")
+    local = storage_backend == 'sqlite'
+    if local and (args.refresh or args.worker or args.resume):
+        raise ValueError("--refresh, --worker and --resume need STORAGE_BACKEND=postgres")
+
     db_url = os.environ.get('DATABASE_URL')
-    if not db_url:
+    if not db_url and not local:
         raise ValueError("DATABASE_URL environment variable is required")
   
+    star_options = {
+        'star_write_mode': os.environ.get('STAR_WRITE_MODE', 'all'),
+        'star_heartbeat_seconds': float(os.environ.get('STAR_HEARTBEAT_HOURS', '24')) * 3600,
+    }
+    if local:
+        repository = SQLiteRepositoryStore(os.environ.get('LOCAL_STORE_PATH', DEFAULT_STORE_PATH), **star_options)
+    else:
+        repository = RepositoryRepository(
+            db_url,
+            min_conn=10,
+            max_conn=20,
+            ingest_mode=os.environ.get('INGEST_MODE', 'execute_batch'),
+            **star_options
+        )
+
+    refresh_scheduler = None if local else RefreshScheduler(
+        db_url,
+        velocity_window_days=int(os.environ.get('REFRESH_VELOCITY_DAYS', '14')),
+        min_age_hours=float(os.environ.get('REFRESH_MIN_AGE_HOURS', '6'))
+    )
+    checkpoints = None if local else CheckpointStore(db_url)
 
-    api_client = GitHubClient(github_token)
-    repository = RepositoryRepository(db_url, min_conn=10, max_conn=20)
- 
+    # Parallel writers each hold a pooled connection while they commit. Repositories
+    # already queued this run are dropped before the writers; DEDUP_MODE=bloom bounds
+    # the memory for very large runs at the cost of DEDUP_FALSE_POSITIVE_RATE misses.
+    writer_options = {
+        'writers': int(os.environ.get('WRITER_COUNT', '4')),
+        'flush_interval': float(os.environ.get('WRITER_FLUSH_SECONDS', '2')),
+        'dedup_mode': os.environ.get('DEDUP_MODE', 'exact'),
+        'dedup_false_positive_rate': float(os.environ.get('DEDUP_FALSE_POSITIVE_RATE', '0.001')),
+    }
 
-    crawler = CrawlerService(
-        api_client=api_client,
-        repository=repository,
-        max_workers=10  
+    # GITHUB_GRAPHQL_URL points the crawler at another endpoint, e.g. fake_graphql_server.py.
+    api_url = os.environ.get('GITHUB_GRAPHQL_URL')
+
+    # RESPONSE_CACHE_DIR keeps successful GraphQL responses on disk; with
+    # RESPONSE_CACHE_REPLAY=true a crawl is served from it alone. Entries are scoped to
+    # the token set unless RESPONSE_CACHE_SCOPE names a shared scope.
+    response_cache = None
+    if os.environ.get('RESPONSE_CACHE_DIR'):
+        response_cache = ResponseCache(
+            os.environ['RESPONSE_CACHE_DIR'],
+            ttl_seconds=float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600')),
+            max_bytes=int(float(os.environ.get('RESPONSE_CACHE_MAX_MB', '512')) * 1024 * 1024),
+            replay=os.environ.get('RESPONSE_CACHE_REPLAY', 'false').lower() in ('1', 'true', 'yes'),
+            scope=os.environ.get('RESPONSE_CACHE_SCOPE')
+                  or hashlib.sha256(','.join(sorted(github_tokens)).encode()).hexdigest()[:16]
+        )
+
+    # Search pages shrink after timeouts and 5xx responses and grow back while page
+    # latency stays under PAGE_TARGET_SECONDS. REFRESH_FIELDS=full makes refresh passes
+    # re-fetch metadata as well as stars.
+    page_sizer = PageSizeController(
+        min_size=int(os.environ.get('PAGE_SIZE_MIN', '10')),
+        target_latency=float(os.environ.get('PAGE_TARGET_SECONDS', '3'))
     )
+    refresh_fields = os.environ.get('REFRESH_FIELDS', 'stars')
+
+    # SEARCH_BATCH > 1 sends that many concurrent shard pages as one aliased multi-search
+    # request, waiting up to SEARCH_BATCH_LINGER_MS for a batch to fill. It saves round
+    # trips on high-latency links.
+    search_options = {
+        'search_batch': int(os.environ.get('SEARCH_BATCH', '1')),
+        'search_linger': float(os.environ.get('SEARCH_BATCH_LINGER_MS', '25')) / 1000,
+    }
+
+    # Workers lease shards for LEASE_SECONDS and renew every HEARTBEAT_SECONDS; a shard
+    # whose worker disappears is retried elsewhere up to SHARD_MAX_ATTEMPTS times.
+    coordinator = None
+    if args.worker:
+        coordinator = CrawlCoordinator(
+            db_url,
+            worker_id=os.environ.get('WORKER_ID'),
+            lease_seconds=float(os.environ.get('LEASE_SECONDS', '120')),
+            heartbeat_seconds=float(os.environ.get('HEARTBEAT_SECONDS', '30')),
+            max_attempts=int(os.environ.get('SHARD_MAX_ATTEMPTS', '5'))
+        )
+
+    crawl_engine = os.environ.get('CRAWL_ENGINE', 'threads')
+    if crawl_engine == 'async':
+        from async_crawler_service import AsyncCrawlerService
+        from async_github_client import AsyncGitHubClient
+
+        crawler = AsyncCrawlerService(
+            api_client=AsyncGitHubClient(github_tokens, base_url=api_url, response_cache=response_cache,
+                                         page_sizer=page_sizer),
+            repository=repository,
+            max_workers=int(os.environ.get('MAX_CONCURRENCY', '20')),
+            checkpoints=checkpoints,
+            refresh_scheduler=refresh_scheduler,
+            refresh_fields=refresh_fields,
+            coordinator=coordinator,
+            **search_options,
+            **writer_options
+        )
+    elif crawl_engine == 'threads':
+        crawler = CrawlerService(
+            api_client=GitHubClient(github_tokens, base_url=api_url, response_cache=response_cache,
+                                    page_sizer=page_sizer),
+            repository=repository,
+            # Shard threads block while their batch is in flight, so keep ~10 requests going.
+            max_workers=10 * search_options['search_batch'],
+            checkpoints=checkpoints,
+            refresh_scheduler=refresh_scheduler,
+            refresh_fields=refresh_fields,
+            coordinator=coordinator,
+            **search_options,
+            **writer_options
+        )
+    else:
+        raise ValueError(f"Unknown CRAWL_ENGINE '{crawl_engine}', expected 'threads' or 'async'")
+
+    # METRICS_PORT serves /metrics (Prometheus text) and /metrics.json while the crawl
+    # runs; METRICS_SNAPSHOT_PATH keeps a periodically rewritten JSON snapshot.
+    if os.environ.get('METRICS_PORT'):
+        start_http_server(int(os.environ['METRICS_PORT']))
+    snapshot_writer = None
+    if os.environ.get('METRICS_SNAPSHOT_PATH'):
+        snapshot_writer = SnapshotWriter(
+            os.environ['METRICS_SNAPSHOT_PATH'],
+            interval=float(os.environ.get('METRICS_SNAPSHOT_SECONDS', '15'))
+        ).start()
     
     try:
+        if not local:
+            ensure_upcoming_partitions(int(os.environ.get('STARS_PARTITIONS_AHEAD', '3')))
+
+        if args.refresh:
+            crawler.refresh(budget_points=int(os.environ.get('REFRESH_BUDGET', '500')),
+                            rest_limit=int(os.environ.get('REST_REFRESH_LIMIT', '100')))
+            return
+
         target_count = int(os.environ.get('TARGET_COUNT', '100000'))
+
+        if args.worker:
+            # Workers of one dispatch share a run through CRAWL_RUN_KEY, by default the
+            # GitHub Actions run id; the first worker with a new key plans the run.
+            run_key = os.environ.get('CRAWL_RUN_KEY') or os.environ.get('GITHUB_RUN_ID')
+            if not run_key:
+                raise ValueError("--worker needs CRAWL_RUN_KEY (or GITHUB_RUN_ID) to name the shared crawl run")
+            crawler.work(run_key, target_count=target_count)
+            return
     
-        crawler.crawl(target_count=target_count)
+        crawler.crawl(target_count=target_count, resume=args.resume)
         # crawler.crawl(target_count=100_000, batch_size=100)
         
     finally:
         repository.close()
+        if snapshot_writer:
+            snapshot_writer.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,269 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Metric:
+
+    # Values are keyed by a tuple of label values, in the order of `labels`.
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: Dict[Tuple, object] = {}
+        self._lock = Lock()
+
+    def _key(self, label_values: Dict[str, object]) -> Tuple:
+        return tuple(str(label_values.get(label, '')) for label in self.labels)
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        with self._lock:
+            return [(self.name, dict(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+    def snapshot(self):
+        samples = self.samples()
+        if not self.labels:
+            return samples[0][2] if samples else 0
+        return [dict(labels, value=value) for _, labels, value in samples]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._callback: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, callback: Optional[Callable[[], float]]):
+        # Sampled on read, for values like queue depth that live elsewhere.
+        self._callback = callback
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        callback = self._callback
+        if callback is not None:
+            return [(self.name, {}, callback())]
+        return super().samples()
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **label_values):
+        key = self._key(label_values)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket', dict(labels, le=le), cumulative))
+                samples.append((self.name + '_sum', labels, total))
+                samples.append((self.name + '_count', labels, count))
+        return samples
+
+    def snapshot(self):
+        series = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                series.append(dict(zip(self.labels, key), count=count, sum=total,
+                                   p50=self._quantile(counts, count, 0.5),
+                                   p99=self._quantile(counts, count, 0.99)))
+        return series
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the quantile, good enough to compare runs.
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound if bound != float('inf') else self.buckets[-1]
+        return self.buckets[-1]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict:
+        return {
+            'timestamp': time.time(),
+            'metrics': {metric.name: metric.snapshot() for metric in list(self._metrics.values())},
+        }
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, help_text, labels))
+
+
+def gauge(name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, help_text, labels))
+
+
+def histogram(name: str, help_text: str, labels: Tuple[str, ...] = (),
+              buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help_text, labels, buckets))
+
+
+# GitHub API
+API_REQUEST_SECONDS = histogram('github_request_seconds', "GraphQL request latency", ('query', 'status'))
+API_RETRIES = counter('github_retries_total', "GraphQL request retries by cause", ('query', 'cause'))
+API_COST = counter('github_graphql_cost_total', "GraphQL rate limit points spent", ('query',))
+API_RATE_LIMIT_REMAINING = gauge('github_rate_limit_remaining', "Points left in the current window", ('token',))
+API_PACING_SECONDS = histogram('github_pacing_wait_seconds', "Time spent waiting on the rate limiter")
+API_PAGE_SIZE = gauge('github_page_size', "Current adaptive search page size")
+RESPONSE_CACHE_REQUESTS = counter('github_response_cache_total', "Response cache lookups", ('query', 'result'))
+REST_CONDITIONAL = counter('github_rest_conditional_total', "REST fallback fetches by outcome", ('result',))
+
+# Crawl
+CRAWL_ROWS = counter('crawler_rows_total', "Repositories fetched")
+CRAWL_DUPLICATES = counter('crawler_duplicates_total', "Repositories dropped as already seen this run")
+CRAWL_PAGES = counter('crawler_pages_total', "Result pages fetched", ('outcome',))
+CRAWL_ROWS_PER_SECOND = gauge('crawler_rows_per_second', "Average repositories fetched per second")
+WRITE_QUEUE_DEPTH = gauge('crawler_write_queue_depth', "Batches waiting for a writer")
+
+# Writers and database
+WRITER_FLUSH_SECONDS = histogram('writer_flush_seconds', "Writer upsert and commit latency", ('writer',))
+WRITER_FLUSH_ROWS = histogram('writer_flush_rows', "Rows per writer flush", ('writer',), SIZE_BUCKETS)
+WRITER_BATCH_SIZE = gauge('writer_batch_size', "Current adaptive flush size", ('writer',))
+DB_ROWS_WRITTEN = counter('db_rows_written_total', "Repositories upserted")
+DB_POOL_WAIT_SECONDS = histogram('db_pool_wait_seconds', "Time to check a connection out of the pool")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.startswith('/metrics.json'):
+            body = json.dumps(REGISTRY.snapshot()).encode()
+            content_type = 'application/json'
+        elif self.path.startswith('/metrics'):
+            body = REGISTRY.render_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+class SnapshotWriter:
+
+    # Rewrites a JSON snapshot every `interval` seconds, for runs where nothing scrapes
+    # the endpoint (CI uploads the file as an artifact).
+
+    def __init__(self, path: str, interval: float = 15):
+        self._path = path
+        self._interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self) -> 'SnapshotWriter':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def write(self):
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(REGISTRY.snapshot(), f, indent=2)
+        os.replace(tmp_path, self._path)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.write()
@@ -0,0 +1,233 @@
+import os
+from typing import Callable, List, Optional, Tuple
+
+import db
+import partitions
+
+
+# Serialises migrations between workers that run setup at the same time.
+MIGRATION_LOCK_KEY = 0x63726177_6d696772
+
+
+def create_migrations_table(curr):
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+                 version INTEGER PRIMARY KEY,
+                 name VARCHAR(255) NOT NULL,
+                 applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                 );
+""")
+
+
+def current_version(curr) -> int:
+    curr.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return curr.fetchone()[0]
+
+
+def _has_column(curr, table: str, column: str) -> bool:
+    curr.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+        )
+    """, (table, column))
+    return curr.fetchone()[0]
+
+
+def _primary_key_columns(curr, table: str) -> List[str]:
+    curr.execute("""
+        SELECT a.attname
+        FROM pg_constraint c
+        JOIN unnest(c.conkey) WITH ORDINALITY AS k(attnum, ord) ON TRUE
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+        WHERE c.conrelid = %s::regclass AND c.contype = 'p'
+        ORDER BY k.ord
+    """, (table,))
+    return [name for (name,) in curr.fetchall()]
+
+
+def drop_redundant_indexes(curr):
+    # idx_repos_full_name repeats the UNIQUE(full_name) index and idx_stars_repo_id
+    # the leading column of UNIQUE(repository_id, observed_at). The owner/name
+    # constraint is implied by full_name being unique.
+    curr.execute("DROP INDEX IF EXISTS idx_repos_full_name")
+    curr.execute("DROP INDEX IF EXISTS idx_stars_repo_id")
+    curr.execute("ALTER TABLE repositories DROP CONSTRAINT IF EXISTS uniquue_owner_name")
+
+
+def stars_composite_primary_key(curr):
+    # Star rows are only ever addressed by (repository_id, observed_at), so the
+    # surrogate id and its index go and the natural key becomes the primary key.
+    # Newest-per-repo lookups scan this key backwards. Dropping the column is
+    # metadata-only; VACUUM FULL reclaims its 8 bytes per existing row.
+    if _has_column(curr, 'repository_stars', 'id'):
+        curr.execute("ALTER TABLE repository_stars DROP COLUMN id")
+
+    if _primary_key_columns(curr, 'repository_stars') != ['repository_id', 'observed_at']:
+        curr.execute("""
+            ALTER TABLE repository_stars
+                DROP CONSTRAINT IF EXISTS unique_repo_observation,
+                ADD CONSTRAINT repository_stars_pkey PRIMARY KEY (repository_id, observed_at)
+        """)
+
+
+def hot_repository_updates(curr):
+    # Every crawl rewrites updated_at, node_id and last_crawled_at on repositories.
+    # With last_crawled_at indexed none of those updates could be HOT, so each one
+    # also inserted into every index on the table. Nothing may range-scan
+    # last_crawled_at after this: the legacy REST scan gets a small partial index on
+    # rows without node ids, and delta exports read changed_at (migration 6), which
+    # only moves when a row really changes. Free space per page lets the new row
+    # version stay on its page.
+    curr.execute("DROP INDEX IF EXISTS idx_repos_last_crawled_at")
+    curr.execute("""
+        CREATE INDEX IF NOT EXISTS idx_repos_missing_node_id ON repositories(id) WHERE node_id IS NULL
+    """)
+    curr.execute("ALTER TABLE repositories SET (fillfactor = 80)")
+
+
+def repository_tombstones(curr):
+    # Delta exports need to tell consumers about repositories that are gone. A
+    # statement-level trigger records every deleted row in one insert per DELETE, so
+    # bulk deletes don't pay a trigger call per row.
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS repository_tombstones(
+            repository_id BIGINT PRIMARY KEY,
+            full_name VARCHAR(512),
+            deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    curr.execute("CREATE INDEX IF NOT EXISTS idx_tombstones_deleted_at ON repository_tombstones(deleted_at)")
+    curr.execute("""
+        CREATE OR REPLACE FUNCTION record_repository_tombstones() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO repository_tombstones(repository_id, full_name, deleted_at)
+            SELECT id, full_name, NOW() FROM deleted_repositories
+            ON CONFLICT (repository_id) DO UPDATE SET
+                full_name = EXCLUDED.full_name,
+                deleted_at = EXCLUDED.deleted_at;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    curr.execute("DROP TRIGGER IF EXISTS repositories_tombstones ON repositories")
+    curr.execute("""
+        CREATE TRIGGER repositories_tombstones
+        AFTER DELETE ON repositories
+        REFERENCING OLD TABLE AS deleted_repositories
+        FOR EACH STATEMENT EXECUTE FUNCTION record_repository_tombstones()
+    """)
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS export_watermarks(
+            name VARCHAR(64) PRIMARY KEY,
+            sequence INTEGER NOT NULL,
+            snapshot_sequence INTEGER NOT NULL,
+            exported_through TIMESTAMPTZ,
+            tombstones_through TIMESTAMPTZ,
+            chain JSONB NOT NULL DEFAULT '[]',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+def rank_snapshots(curr):
+    # One packed rank vector per completed crawl, see rank_snapshots.py. A few MB per
+    # snapshot even at a million repositories, and TOAST keeps it out of the row.
+    curr.execute("""
+        CREATE TABLE IF NOT EXISTS rank_snapshots(
+            id BIGSERIAL PRIMARY KEY,
+            run_id BIGINT UNIQUE,
+            top INTEGER NOT NULL DEFAULT 0,
+            repository_count INTEGER NOT NULL,
+            ranks BYTEA NOT NULL,
+            taken_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+def repository_changed_at(curr):
+    # Delta exports read rows by changed_at, which writers only move when stars or
+    # metadata differ. Rows from before the column are dated by their last crawl, the
+    # latest time they could have changed.
+    curr.execute("ALTER TABLE repositories ADD COLUMN IF NOT EXISTS changed_at TIMESTAMPTZ")
+    curr.execute("UPDATE repositories SET changed_at = last_crawled_at WHERE changed_at IS NULL")
+    curr.execute("CREATE INDEX IF NOT EXISTS idx_repos_changed_at ON repositories(changed_at)")
+
+
+def fold_star_days_into_daily_rollup(curr):
+    # trends.py kept its own daily closes in repository_star_days; it now reads and
+    # writes repository_stars_daily. Days the rollup already has are left alone.
+    curr.execute("SELECT to_regclass('repository_star_days') IS NOT NULL")
+    if not curr.fetchone()[0]:
+        return
+    partitions.create_rollup_tables(curr)
+    curr.execute("""
+        INSERT INTO repository_stars_daily(
+            repository_id, day, min_star_count, max_star_count, last_star_count, observation_count)
+        SELECT repository_id, day, star_count, star_count, star_count, 1
+        FROM repository_star_days
+        ON CONFLICT (repository_id, day) DO NOTHING
+    """)
+    curr.execute("DROP TABLE repository_star_days")
+
+
+def crawl_run_keys(curr):
+    # Workers join the run of their own dispatch by key rather than whichever run is
+    # still open, which may be a failed or cancelled crawl with another target.
+    curr.execute("ALTER TABLE crawl_runs ADD COLUMN IF NOT EXISTS run_key VARCHAR(255)")
+    curr.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_crawl_runs_run_key ON crawl_runs(run_key)")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, 'drop_redundant_indexes', drop_redundant_indexes),
+    (2, 'stars_composite_primary_key', stars_composite_primary_key),
+    (3, 'hot_repository_updates', hot_repository_updates),
+    (4, 'repository_tombstones', repository_tombstones),
+    (5, 'rank_snapshots', rank_snapshots),
+    (6, 'repository_changed_at', repository_changed_at),
+    (7, 'fold_star_days_into_daily_rollup', fold_star_days_into_daily_rollup),
+    (8, 'crawl_run_keys', crawl_run_keys),
+]
+
+
+def migrate(target_version: Optional[int] = None) -> List[int]:
+    # Applies pending migrations in order, each in its own transaction together with
+    # its schema_migrations row.
+    target_version = MIGRATIONS[-1][0] if target_version is None else target_version
+    applied = []
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        create_migrations_table(curr)
+        conn.commit()
+
+        for version, name, apply in MIGRATIONS:
+            if version > target_version:
+                break
+
+            curr.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+            if current_version(curr) >= version:
+                conn.commit()
+                continue
+
+            apply(curr)
+            curr.execute("INSERT INTO schema_migrations(version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            applied.append(version)
+            print(f"Applied migration {version:03d} {name}")
+
+        curr.close()
+        return applied
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    target = os.environ.get('SCHEMA_VERSION')
+    migrate(int(target) if target else None)
@@ -1,6 +1,6 @@
 import os,time
 from datetime import datetime
-from typing import List,Dict,Optional,Iterator
+from typing import List,Dict,Optional,Iterator,Tuple
 from concurrent.futures import ThreadPoolExecutor,as_completed
 from queue import Queue
 from threading import Lock
@@ -10,12 +10,61 @@ from psycopg2.extras import execute_batch
 from psycopg2.pool import ThreadedConnectionPool
 
 
+# The hot path carries repositories as plain tuples in COPY column order, so pages go
+# from decoded JSON to the writer without building an object per node. Timestamps stay
+# as the API's ISO strings and are parsed once, by Postgres, on ingest.
+RepositoryRecord=Tuple[int,str,str,str,int,str,str,Optional[str]]
+
+RECORD_FIELDS=('db_id','owner','name','full_name','star_count','created_at','updated_at','node_id')
+DB_ID,OWNER,NAME,FULL_NAME,STAR_COUNT,CREATED_AT,UPDATED_AT,NODE_ID=range(len(RECORD_FIELDS))
+
+
+def decode_node(node:Dict)->RepositoryRecord:
+    return (node['databaseId'],node['owner']['login'],node['name'],node['nameWithOwner'],
+            node['stargazerCount'],node['createdAt'],node['updatedAt'],node.get('id'))
+
+
+def decode_nodes(nodes:List[Dict])->List[RepositoryRecord]:
+    try:
+        return [
+            (n['databaseId'],n['owner']['login'],n['name'],n['nameWithOwner'],
+             n['stargazerCount'],n['createdAt'],n['updatedAt'],n.get('id'))
+            for n in nodes if n and 'databaseId' in n
+        ]
+    except (KeyError,TypeError):
+        pass
+
+    # Only a page with a malformed node pays for per-node error handling.
+    records=[]
+    for node in nodes:
+        try:
+            if node and 'databaseId' in node:
+                records.append(decode_node(node))
+        except Exception as e:
+            print(f"Error parsing repository node: {e}")
+    return records
+
+
+def decode_star_nodes(nodes:List[Dict])->List[RepositoryRecord]:
+    # Trimmed refresh nodes carry no metadata; those slots stay None and the record is
+    # only good for a star write.
+    return [(n['databaseId'],None,None,None,n['stargazerCount'],None,None,n.get('id'))
+            for n in nodes if n and n.get('databaseId') is not None]
+
+
+def decode_rest_repository(data:Dict)->RepositoryRecord:
+    # GET /repositories/{id} payload, same record layout as a GraphQL node.
+    return (data['id'],data['owner']['login'],data['name'],data['full_name'],
+            data['stargazers_count'],data['created_at'],data['updated_at'],data.get('node_id'))
+
+
 class RepositoryModel:
 
     __slots__= ('_db_id', '_owner', '_name', '_full_name', '_star_count', 
-                 '_created_at', '_updated_at')
+                 '_created_at', '_updated_at', '_node_id')
     
-    def __init__(self,db_id:int, owner:str,name:str, full_name:str,star_count:int,created_at:str,updated_at:str):
+    def __init__(self,db_id:int, owner:str,name:str, full_name:str,star_count:int,created_at:str,updated_at:str,
+                 node_id:Optional[str]=None):
         object.__setattr__(self,'_db_id',db_id)
         object.__setattr__(self, '_owner', owner)
         object.__setattr__(self, '_name', name)
@@ -23,6 +72,7 @@ class RepositoryModel:
         object.__setattr__(self, '_star_count', star_count)
         object.__setattr__(self, '_created_at', created_at)
         object.__setattr__(self, '_updated_at', updated_at)
+        object.__setattr__(self, '_node_id', node_id)
 
 
     def __setattr__(self, name, value):
@@ -55,6 +105,10 @@ class RepositoryModel:
     @property
     def updated_at(self) -> str:
         return self._updated_at
+
+    @property
+    def node_id(self) -> Optional[str]:
+        return self._node_id
     
     @classmethod
     def from_api_response(cls,node:Dict)->'RepositoryModel':
@@ -65,5 +119,14 @@ class RepositoryModel:
             full_name=node['nameWithOwner'],
             star_count=node['stargazerCount'],
             created_at=node['createdAt'],
-            updated_at=node['updatedAt']
+            updated_at=node['updatedAt'],
+            node_id=node.get('id')
         )
+
+    @classmethod
+    def from_record(cls,record:RepositoryRecord)->'RepositoryModel':
+        return cls(*record)
+
+    def to_record(self)->RepositoryRecord:
+        return (self._db_id,self._owner,self._name,self._full_name,self._star_count,
+                self._created_at,self._updated_at,self._node_id)
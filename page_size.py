@@ -0,0 +1,35 @@
+from threading import Lock
+
+
+class PageSizeController:
+
+    # Search pages get slower with size, and an oversized page that times out or 502s
+    # costs a full retry. Failures halve the page size; healthy pages grow it back in
+    # small steps, and a page slower than target backs off by a quarter.
+
+    def __init__(self, max_size: int = 100, min_size: int = 10, target_latency: float = 3.0, step: int = 10):
+        self._max_size = max_size
+        self._min_size = min(min_size, max_size)
+        self._target_latency = target_latency
+        self._step = step
+        self._size = max_size
+        self._lock = Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def page_size(self, requested: int) -> int:
+        return max(1, min(requested, self._size))
+
+    def success(self, latency: float):
+        with self._lock:
+            if latency > self._target_latency:
+                self._size = max(self._min_size, self._size * 3 // 4)
+            else:
+                self._size = min(self._max_size, self._size + self._step)
+
+    def failure(self) -> int:
+        with self._lock:
+            self._size = max(self._min_size, self._size // 2)
+            return self._size
@@ -0,0 +1,198 @@
+import os
+from datetime import date, datetime, timezone
+from typing import List, Tuple
+
+import db
+
+
+PARTITION_PREFIX = 'repository_stars_p'
+DEFAULT_PARTITION = 'repository_stars_default'
+
+
+def month_start(day: date, months: int = 0) -> date:
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(start: date) -> str:
+    return f"{PARTITION_PREFIX}{start.year:04d}{start.month:02d}"
+
+
+def is_partitioned(curr) -> bool:
+    curr.execute("""
+        SELECT EXISTS (
+            SELECT 1
+            FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = 'repository_stars'
+              AND c.relnamespace = current_schema()::regnamespace
+        )
+    """)
+    return curr.fetchone()[0]
+
+
+def create_rollup_tables(curr):
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS repository_stars_daily(
+                 repository_id BIGINT NOT NULL REFERENCES repositories(id) ON DELETE CASCADE,
+                 day DATE NOT NULL,
+                 min_star_count INTEGER NOT NULL,
+                 max_star_count INTEGER NOT NULL,
+                 last_star_count INTEGER NOT NULL,
+                 observation_count INTEGER NOT NULL,
+                 PRIMARY KEY (repository_id, day)
+                 );
+""")
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS repository_stars_weekly(
+                 repository_id BIGINT NOT NULL REFERENCES repositories(id) ON DELETE CASCADE,
+                 week DATE NOT NULL,
+                 min_star_count INTEGER NOT NULL,
+                 max_star_count INTEGER NOT NULL,
+                 last_star_count INTEGER NOT NULL,
+                 observation_count INTEGER NOT NULL,
+                 PRIMARY KEY (repository_id, week)
+                 );
+""")
+
+
+def create_partitions(curr, months_ahead: int = 3, months_back: int = 0):
+    # Monthly partitions in UTC, plus a default partition so an observation outside
+    # the created range is never rejected.
+    today = datetime.now(timezone.utc).date()
+    for offset in range(-months_back, months_ahead + 1):
+        start = month_start(today, offset)
+        end = month_start(start, 1)
+        curr.execute(f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(start)}
+            PARTITION OF repository_stars
+            FOR VALUES FROM ('{start.isoformat()} 00:00:00+00') TO ('{end.isoformat()} 00:00:00+00')
+        """)
+
+    curr.execute(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF repository_stars DEFAULT")
+
+
+def list_partitions(curr) -> List[Tuple[str, date]]:
+    curr.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'repository_stars'
+          AND p.relnamespace = current_schema()::regnamespace
+          AND c.relname LIKE %s
+        ORDER BY c.relname
+    """, (PARTITION_PREFIX + '%',))
+
+    partitions = []
+    for (name,) in curr.fetchall():
+        suffix = name[len(PARTITION_PREFIX):]
+        if len(suffix) == 6 and suffix.isdigit():
+            partitions.append((name, date(int(suffix[:4]), int(suffix[4:]), 1)))
+    return partitions
+
+
+def ensure_upcoming_partitions(months_ahead: int = 3) -> bool:
+    conn = db.get_connection()
+    try:
+        curr = conn.cursor()
+        if not is_partitioned(curr):
+            return False
+        create_partitions(curr, months_ahead)
+        conn.commit()
+        curr.close()
+        return True
+    finally:
+        conn.close()
+
+
+def apply_retention(raw_retention_months: int = 3, daily_retention_weeks: int = 52):
+    # Trend windows (trends.py) read the last 30 days of repository_stars_daily, so
+    # daily_retention_weeks should stay above five.
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        create_rollup_tables(curr)
+        conn.commit()
+
+        today = datetime.now(timezone.utc).date()
+        raw_cutoff = month_start(today, -raw_retention_months)
+
+        # Each expired partition is rolled up and dropped in its own transaction, so a
+        # failure never loses raw rows that were not yet summarised. A partition holds
+        # whole UTC days, so its rollup replaces the rows trends.py wrote for them.
+        monthly = list_partitions(curr) if is_partitioned(curr) else []
+        for name, start in monthly:
+            if month_start(start, 1) > raw_cutoff:
+                continue
+
+            curr.execute(f"""
+                INSERT INTO repository_stars_daily(
+                    repository_id, day, min_star_count, max_star_count, last_star_count, observation_count)
+                SELECT
+                    repository_id,
+                    (observed_at AT TIME ZONE 'UTC')::date,
+                    MIN(star_count),
+                    MAX(star_count),
+                    (ARRAY_AGG(star_count ORDER BY observed_at DESC))[1],
+                    COUNT(*)
+                FROM {name}
+                GROUP BY 1, 2
+                ON CONFLICT (repository_id, day) DO UPDATE SET
+                    min_star_count = EXCLUDED.min_star_count,
+                    max_star_count = EXCLUDED.max_star_count,
+                    last_star_count = EXCLUDED.last_star_count,
+                    observation_count = EXCLUDED.observation_count
+            """)
+            rolled_up = curr.rowcount
+            curr.execute(f"ALTER TABLE repository_stars DETACH PARTITION {name}")
+            curr.execute(f"DROP TABLE {name}")
+            conn.commit()
+            print(f"Rolled up {name} into {rolled_up:,} daily rows and dropped it")
+
+        daily_cutoff = today.toordinal() - daily_retention_weeks * 7
+        daily_cutoff = date.fromordinal(daily_cutoff - date.fromordinal(daily_cutoff).weekday())
+
+        curr.execute("""
+            INSERT INTO repository_stars_weekly(
+                repository_id, week, min_star_count, max_star_count, last_star_count, observation_count)
+            SELECT
+                repository_id,
+                DATE_TRUNC('week', day)::date,
+                MIN(min_star_count),
+                MAX(max_star_count),
+                (ARRAY_AGG(last_star_count ORDER BY day DESC))[1],
+                SUM(observation_count)
+            FROM repository_stars_daily
+            WHERE day < %s
+            GROUP BY 1, 2
+            ON CONFLICT (repository_id, week) DO UPDATE SET
+                min_star_count = LEAST(repository_stars_weekly.min_star_count, EXCLUDED.min_star_count),
+                max_star_count = GREATEST(repository_stars_weekly.max_star_count, EXCLUDED.max_star_count),
+                last_star_count = EXCLUDED.last_star_count,
+                observation_count = repository_stars_weekly.observation_count + EXCLUDED.observation_count
+        """, (daily_cutoff,))
+        curr.execute("DELETE FROM repository_stars_daily WHERE day < %s", (daily_cutoff,))
+        downsampled = curr.rowcount
+        conn.commit()
+
+        if downsampled:
+            print(f"Downsampled {downsampled:,} daily rows older than {daily_cutoff} into weekly rollups")
+
+        curr.close()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    ensure_upcoming_partitions(int(os.environ.get('STARS_PARTITIONS_AHEAD', '3')))
+    apply_retention(
+        raw_retention_months=int(os.environ.get('STARS_RAW_RETENTION_MONTHS', '3')),
+        daily_retention_weeks=int(os.environ.get('STARS_DAILY_RETENTION_WEEKS', '52'))
+    )
@@ -0,0 +1,271 @@
+import csv
+import mmap
+import os
+import struct
+from array import array
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+import db
+from storage import stream_rows
+
+
+DEFAULT_SNAPSHOT_DIR = os.path.join('data', 'ranks')
+
+# File and column layout of a packed snapshot: a header, then repository ids ascending
+# (int64), then each repository's rank and star count (int32) in the same order. The
+# columns are native-endian so they can be cast straight out of an mmap.
+MAGIC = b'ghranks1'
+HEADER = struct.Struct('<8sq')
+
+RANK_CHANGE_COLUMNS = ['change', 'id', 'full_name', 'old_rank', 'new_rank', 'rank_change', 'old_stars', 'new_stars']
+
+# Ties keep a stable order by id, so an unchanged star count never shows up as a move.
+RANK_QUERY = """
+        SELECT repository_id, rank, star_count
+        FROM (
+            SELECT repository_id, star_count,
+                   ROW_NUMBER() OVER (ORDER BY star_count DESC, repository_id) AS rank
+            FROM repository_latest_stars
+        ) ranked
+        WHERE %(top)s = 0 OR rank <= %(top)s
+        ORDER BY repository_id
+"""
+
+NAMES_QUERY = """
+        SELECT ids.id, COALESCE(r.full_name, t.full_name)
+        FROM unnest(%s::bigint[]) AS ids(id)
+        LEFT JOIN repositories r ON r.id = ids.id
+        LEFT JOIN repository_tombstones t ON t.repository_id = ids.id
+"""
+
+
+class RankVector:
+
+    # Read-only view of a packed snapshot. Over an mmap'd file the columns are paged in
+    # as the diff walks them instead of being parsed up front.
+
+    def __init__(self, buffer, mapped: Optional[mmap.mmap] = None):
+        magic, count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a rank snapshot")
+
+        view = memoryview(buffer)
+        ranks_at = HEADER.size + 8 * count
+        stars_at = ranks_at + 4 * count
+        self.ids = view[HEADER.size:ranks_at].cast('q')
+        self.ranks = view[ranks_at:stars_at].cast('i')
+        self.stars = view[stars_at:stars_at + 4 * count].cast('i')
+        self._views = (view, self.ids, self.ranks, self.stars)
+        self._mapped = mapped
+
+    @classmethod
+    def open(cls, path: str) -> 'RankVector':
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, mapped)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def close(self):
+        # An mmap can't close while memoryviews into it are alive.
+        for view in reversed(self._views):
+            view.release()
+        if self._mapped:
+            self._mapped.close()
+
+
+def pack_ranks(chunks) -> bytes:
+    # chunks yield lists of (repository_id, rank, star_count) in ascending id order.
+    ids, ranks, stars = array('q'), array('i'), array('i')
+    for chunk in chunks:
+        for repository_id, rank, star_count in chunk:
+            ids.append(repository_id)
+            ranks.append(rank)
+            stars.append(star_count)
+    return HEADER.pack(MAGIC, len(ids)) + ids.tobytes() + ranks.tobytes() + stars.tobytes()
+
+
+def diff_ranks(old: RankVector, new: RankVector) -> Iterator[Tuple]:
+    # One merge pass over both id columns. Yields (change, id, old_rank, new_rank,
+    # old_stars, new_stars) for every repository that moved, entered or dropped out;
+    # the missing side of an entrant or dropout is None.
+    old_ids, new_ids = old.ids, new.ids
+    i = j = 0
+    old_count, new_count = len(old_ids), len(new_ids)
+
+    while i < old_count or j < new_count:
+        if j == new_count or (i < old_count and old_ids[i] < new_ids[j]):
+            yield 'dropped', old_ids[i], old.ranks[i], None, old.stars[i], None
+            i += 1
+        elif i == old_count or new_ids[j] < old_ids[i]:
+            yield 'new', new_ids[j], None, new.ranks[j], None, new.stars[j]
+            j += 1
+        else:
+            old_rank, new_rank = old.ranks[i], new.ranks[j]
+            if old_rank != new_rank:
+                yield ('up' if new_rank < old_rank else 'down'), new_ids[j], old_rank, new_rank, old.stars[i], new.stars[j]
+            i += 1
+            j += 1
+
+
+def snapshot_path(snapshot_id: int, directory: str = DEFAULT_SNAPSHOT_DIR) -> str:
+    return os.path.join(directory, f'ranks_{snapshot_id:06d}.bin')
+
+
+def capture_ranks(top: int = 0, keep: int = 30, directory: str = DEFAULT_SNAPSHOT_DIR) -> Optional[int]:
+    # Packs the current ranking (the top `top` repositories, or all of them) into a
+    # snapshot tagged with the most recent completed crawl run, unless that run already
+    # has one. Keeps the newest `keep` snapshots. Returns the new snapshot id.
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        curr.execute("SELECT id FROM crawl_runs WHERE status = 'completed' ORDER BY id DESC LIMIT 1")
+        row = curr.fetchone()
+        run_id = row[0] if row else None
+        if run_id is not None:
+            curr.execute("SELECT id FROM rank_snapshots WHERE run_id = %s", (run_id,))
+            if curr.fetchone():
+                conn.rollback()
+                print(f"Crawl run {run_id} already has a rank snapshot")
+                return None
+
+        packed = pack_ranks(stream_rows(conn, RANK_QUERY, {'top': top}))
+        count = HEADER.unpack_from(packed, 0)[1]
+        curr.execute("""
+            INSERT INTO rank_snapshots(run_id, top, repository_count, ranks)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        """, (run_id, top, count, packed))
+        snapshot_id = curr.fetchone()[0]
+
+        curr.execute("""
+            DELETE FROM rank_snapshots
+            WHERE id NOT IN (SELECT id FROM rank_snapshots ORDER BY id DESC LIMIT %s)
+            RETURNING id
+        """, (max(keep, 2),))
+        expired = [row[0] for row in curr.fetchall()]
+        conn.commit()
+        curr.close()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    _write_snapshot_file(snapshot_path(snapshot_id, directory), packed)
+    for expired_id in expired:
+        if os.path.exists(snapshot_path(expired_id, directory)):
+            os.remove(snapshot_path(expired_id, directory))
+
+    print(f"Captured rank snapshot {snapshot_id} of {count:,} repositories"
+          + (f" for crawl run {run_id}" if run_id is not None else ""))
+    return snapshot_id
+
+
+def open_snapshot(conn, snapshot_id: int, directory: str = DEFAULT_SNAPSHOT_DIR) -> RankVector:
+    # Snapshot files are a local cache of the database copy, which is the one that
+    # outlives a CI runner.
+    path = snapshot_path(snapshot_id, directory)
+    if not os.path.exists(path):
+        curr = conn.cursor()
+        curr.execute("SELECT ranks FROM rank_snapshots WHERE id = %s", (snapshot_id,))
+        row = curr.fetchone()
+        curr.close()
+        if row is None:
+            raise ValueError(f"No rank snapshot {snapshot_id}")
+        _write_snapshot_file(path, row[0])
+    return RankVector.open(path)
+
+
+def rank_changes(old_id: Optional[int] = None, new_id: Optional[int] = None,
+                 directory: str = DEFAULT_SNAPSHOT_DIR) -> Optional[Tuple[int, int, List[Tuple]]]:
+    # Diffs two snapshots, by default the two newest. Returns (old id, new id, rows)
+    # with rows shaped like RANK_CHANGE_COLUMNS, ordered by new rank with dropouts last,
+    # or None when there is nothing to compare against yet.
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        if new_id is None:
+            curr.execute("SELECT id FROM rank_snapshots ORDER BY id DESC LIMIT 1")
+            row = curr.fetchone()
+            new_id = row[0] if row else None
+        if old_id is None and new_id is not None:
+            curr.execute("SELECT id FROM rank_snapshots WHERE id < %s ORDER BY id DESC LIMIT 1", (new_id,))
+            row = curr.fetchone()
+            old_id = row[0] if row else None
+        if old_id is None or new_id is None:
+            return None
+
+        old, new = open_snapshot(conn, old_id, directory), open_snapshot(conn, new_id, directory)
+        try:
+            changes = list(diff_ranks(old, new))
+        finally:
+            old.close()
+            new.close()
+
+        names = {}
+        for start in range(0, len(changes), 10_000):
+            curr.execute(NAMES_QUERY, ([change[1] for change in changes[start:start + 10_000]],))
+            names.update(curr.fetchall())
+        curr.close()
+
+    finally:
+        conn.close()
+
+    rows = [
+        (change, repository_id, names.get(repository_id), old_rank, new_rank,
+         old_rank - new_rank if old_rank is not None and new_rank is not None else None,
+         old_stars, new_stars)
+        for change, repository_id, old_rank, new_rank, old_stars, new_stars in changes
+    ]
+    rows.sort(key=lambda row: (row[4] is None, row[4] if row[4] is not None else row[3]))
+    return old_id, new_id, rows
+
+
+def export_rank_changes(output_dir: str = 'exports', timestamp: Optional[str] = None,
+                        directory: str = DEFAULT_SNAPSHOT_DIR) -> Optional[str]:
+    result = rank_changes(directory=directory)
+    if result is None:
+        print("Fewer than two rank snapshots, no rank changes to export")
+        return None
+
+    old_id, new_id, rows = result
+    timestamp = timestamp or datetime.now().strftime('%Y%m%d_%H%M%S')
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f'rank_changes_{timestamp}.csv')
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(RANK_CHANGE_COLUMNS)
+        writer.writerows(rows)
+
+    counts = {change: 0 for change in ('up', 'down', 'new', 'dropped')}
+    for row in rows:
+        counts[row[0]] += 1
+    print(f"Exported rank changes from snapshot {old_id} to {new_id} to {path}: "
+          f"{counts['up']:,} up, {counts['down']:,} down, {counts['new']:,} new, {counts['dropped']:,} dropped")
+    return path
+
+
+def _write_snapshot_file(path: str, packed):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(packed)
+    os.replace(temp_path, path)
+
+
+if __name__ == "__main__":
+    capture_ranks(top=int(os.environ.get('RANK_SNAPSHOT_TOP', '0')),
+                  keep=int(os.environ.get('RANK_SNAPSHOT_KEEP', '30')),
+                  directory=os.environ.get('RANK_SNAPSHOT_DIR', DEFAULT_SNAPSHOT_DIR))
+    result = rank_changes(directory=os.environ.get('RANK_SNAPSHOT_DIR', DEFAULT_SNAPSHOT_DIR))
+    if result:
+        movers = sorted((row for row in result[2] if row[5]), key=lambda row: -abs(row[5]))
+        for row in movers[:int(os.environ.get('RANK_CHANGES_TOP', '20'))]:
+            print(f"{row[2] or row[1]:<60}{row[3]:>10,}{row[4]:>10,}{row[5]:>+10,}")
@@ -0,0 +1,109 @@
+import time
+from datetime import datetime
+from threading import Lock
+from typing import List, Optional, Tuple
+
+
+class TokenBudget:
+
+    __slots__ = ('token', 'index', 'limit', 'remaining', 'reset_at', 'paced_until', 'blocked_until')
+
+    def __init__(self, token: str, limit: int = 5000, index: int = 0):
+        self.token = token
+        self.index = index
+        self.limit = limit
+        self.remaining = limit
+        self.reset_at: Optional[float] = None
+        self.paced_until = 0.0
+        self.blocked_until = 0.0
+
+    def point_interval(self, reserve: int, now: float) -> float:
+        # Seconds per point that spends the usable budget exactly by the reset.
+        if not self.reset_at or self.reset_at <= now:
+            return 0.0
+        window = self.reset_at - now
+        usable = self.remaining - reserve
+        if usable <= 0:
+            return window
+        return window / usable
+
+    def ready_at(self, cost: int, reserve: int, burst: int, now: float) -> float:
+        burst_allowance = burst * self.point_interval(reserve, now)
+        ready_at = max(now, self.paced_until - burst_allowance, self.blocked_until)
+        if self.remaining - cost < reserve and self.reset_at and self.reset_at > now:
+            ready_at = max(ready_at, self.reset_at + 1)
+        return ready_at
+
+
+class RateLimiter:
+
+    # Proactive limiter over GraphQL cost points. Each token is a token bucket refilled
+    # at the rate that makes its remaining points last until the window resets, with
+    # up to `burst` points spendable ahead of that pace. Callers get back how long to
+    # wait and sleep outside the lock, so one exhausted token never stalls workers
+    # that can be served by another.
+
+    def __init__(self, tokens: List[str], reserve: int = 50, burst: int = 250):
+        if not tokens:
+            raise ValueError("At least one GitHub token is required")
+        self._budgets = [TokenBudget(token, index=index) for index, token in enumerate(tokens)]
+        self._reserve = reserve
+        self._burst = burst
+        self._next_index = 0
+        self._lock = Lock()
+
+    @property
+    def token_count(self) -> int:
+        return len(self._budgets)
+
+    def acquire(self, cost: int = 1) -> Tuple[TokenBudget, float]:
+        with self._lock:
+            now = time.time()
+            count = len(self._budgets)
+
+            budget = None
+            ready_at = None
+            for offset in range(count):
+                candidate = self._budgets[(self._next_index + offset) % count]
+                candidate_ready_at = candidate.ready_at(cost, self._reserve, self._burst, now)
+                if ready_at is None or candidate_ready_at < ready_at:
+                    budget, ready_at = candidate, candidate_ready_at
+
+            self._next_index = (self._budgets.index(budget) + 1) % count
+
+            if budget.reset_at and ready_at > budget.reset_at:
+                # The window will have rolled over by the time this request goes out.
+                budget.remaining = budget.limit
+                budget.reset_at = None
+
+            interval = budget.point_interval(self._reserve, ready_at)
+            budget.paced_until = max(budget.paced_until, ready_at) + cost * interval
+            budget.remaining -= cost
+
+            return budget, ready_at - now
+
+    def record(self, budget: TokenBudget, remaining: Optional[int], reset_at: Optional[float],
+               limit: Optional[int] = None):
+        with self._lock:
+            if limit is not None:
+                budget.limit = limit
+            if remaining is not None:
+                budget.remaining = remaining
+            if reset_at is not None:
+                budget.reset_at = reset_at
+
+    def penalize(self, budget: TokenBudget, retry_after: float):
+        with self._lock:
+            budget.blocked_until = max(budget.blocked_until, time.time() + retry_after)
+
+    def exhaust(self, budget: TokenBudget):
+        with self._lock:
+            budget.remaining = 0
+            if not budget.reset_at:
+                budget.blocked_until = max(budget.blocked_until, time.time() + 60)
+
+
+def parse_reset_at(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
@@ -0,0 +1,91 @@
+from typing import List, Optional, Tuple
+
+import psycopg2
+
+
+NODES_PER_REQUEST = 100
+
+
+class RefreshScheduler:
+
+    # Ranks known repositories by expected staleness: the star change we expect since
+    # the last crawl (recent star velocity times hours since last_crawled_at), with a
+    # popularity-tier floor so repos without recent history still age into the set.
+
+    def __init__(self, db_url: str, velocity_window_days: int = 14, min_age_hours: float = 6):
+        self._db_url = db_url
+        self._velocity_window_days = velocity_window_days
+        self._min_age_hours = min_age_hours
+
+    def select_stale(self, budget_points: int) -> List[Tuple[int, str]]:
+        # A nodes(ids:) query of up to 100 ids costs one point.
+        limit = budget_points * NODES_PER_REQUEST
+        if limit <= 0:
+            return []
+
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                WITH velocity AS (
+                    SELECT
+                        repository_id,
+                        (MAX(star_count) - MIN(star_count))::float8
+                            / GREATEST(EXTRACT(EPOCH FROM MAX(observed_at) - MIN(observed_at)) / 86400, 1)
+                            AS stars_per_day
+                    FROM repository_stars
+                    WHERE observed_at >= NOW() - make_interval(days => %(window_days)s)
+                    GROUP BY repository_id
+                )
+                SELECT r.id, r.node_id
+                FROM repositories r
+                JOIN repository_latest_stars ls ON ls.repository_id = r.id
+                LEFT JOIN velocity v ON v.repository_id = r.id
+                WHERE r.node_id IS NOT NULL
+                  AND r.last_crawled_at < NOW() - make_interval(secs => %(min_age_seconds)s)
+                ORDER BY
+                    EXTRACT(EPOCH FROM NOW() - r.last_crawled_at) / 3600
+                    * (COALESCE(v.stars_per_day, 0)
+                       + CASE
+                             WHEN ls.star_count >= 10000 THEN 1.0
+                             WHEN ls.star_count >= 1000 THEN 0.3
+                             ELSE 0.1
+                         END) DESC
+                LIMIT %(limit)s
+            """, {
+                'window_days': self._velocity_window_days,
+                'min_age_seconds': self._min_age_hours * 3600,
+                'limit': limit,
+            })
+            candidates = curr.fetchall()
+            curr.close()
+            return candidates
+
+        finally:
+            conn.close()
+
+    def select_legacy(self, limit: int) -> List[Tuple[int, Optional[str]]]:
+        # Rows stored before node ids were kept can only be refreshed one at a time over
+        # REST, oldest first. Each REST fetch backfills node_id, so this set drains.
+        if limit <= 0:
+            return []
+
+        conn = psycopg2.connect(self._db_url)
+
+        try:
+            curr = conn.cursor()
+            curr.execute("""
+                SELECT id, rest_etag
+                FROM repositories
+                WHERE node_id IS NULL
+                  AND last_crawled_at < NOW() - make_interval(secs => %s)
+                ORDER BY last_crawled_at
+                LIMIT %s
+            """, (self._min_age_hours * 3600, limit))
+            candidates = curr.fetchall()
+            curr.close()
+            return candidates
+
+        finally:
+            conn.close()
@@ -1,6 +1,8 @@
 import os,time
+import csv
+import io
 from datetime import datetime
-from typing import List,Dict,Optional,Iterator
+from typing import IO,List,Dict,Optional,Iterator,Tuple
 from concurrent.futures import ThreadPoolExecutor,as_completed
 from queue import Queue
 from threading import Lock
@@ -9,62 +11,343 @@ import psycopg2
 from psycopg2.extras import execute_batch
 from psycopg2.pool import ThreadedConnectionPool
 
-from models import RepositoryModel
+import metrics
+from checkpoints import ShardProgress,write_progress
+from models import DB_ID,STAR_COUNT,RepositoryRecord
+from storage import EXPORT_QUERY,RepositoryStore,fetch_stats,stream_rows
 
 
-class RepositoryRepository:
+INGEST_MODES=('execute_batch','copy')
 
-    def __init__(self,db_url:str,min_conn:int=5,max_conn:int=20):
+# last_crawled_at moves on every crawl; changed_at only when the metadata differs (stars
+# are compared in _mark_star_changes), so delta exports skip rows that were only re-seen.
+CHANGED_AT_UPDATE="""changed_at = CASE WHEN repositories.updated_at IS DISTINCT FROM EXCLUDED.updated_at
+                                         THEN NOW() ELSE repositories.changed_at END"""
+
+
+class RepositoryRepository(RepositoryStore):
+
+    def __init__(self,db_url:str,min_conn:int=5,max_conn:int=20,ingest_mode:str='execute_batch',
+                 star_write_mode:str='all',star_heartbeat_seconds:float=24*3600):
+        if ingest_mode not in INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode '{ingest_mode}', expected one of {', '.join(INGEST_MODES)}")
+        super().__init__(star_write_mode,star_heartbeat_seconds)
         self._pool=ThreadedConnectionPool(min_conn,max_conn,db_url)
+        self._max_conn=max_conn
+        self._ingest_mode=ingest_mode
 
-    def upsert_batch(self,repositories:List['RepositoryModel']):
+    @property
+    def max_connections(self)->int:
+        return self._max_conn
 
-        if not repositories:
+    def upsert_batch(self,repositories:List[RepositoryRecord],run_id:Optional[int]=None,
+                     progress:Optional[List[ShardProgress]]=None):
+
+        if not repositories and not progress:
             return 0
+
+        star_repositories=self._select_star_observations(repositories) if repositories else []
+        
+        conn=self._getconn()
+
+        try:
+            curr=conn.cursor()
+
+            if not repositories:
+                pass
+            elif self._ingest_mode=='copy':
+                self._copy_batch(curr,repositories,star_repositories)
+            else:
+                self._execute_batch(curr,repositories,star_repositories)
+
+            if run_id is not None and progress:
+                write_progress(curr,run_id,progress)
+
+            conn.commit()
+            self._mark_recorded(star_repositories)
+
+            metrics.DB_ROWS_WRITTEN.inc(len(repositories))
+            return len(repositories)
+        
+
+        except Exception as e:
+            conn.rollback()
+            raise e
         
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
+
+    def _getconn(self):
+        start=time.perf_counter()
         conn=self._pool.getconn()
+        metrics.DB_POOL_WAIT_SECONDS.observe(time.perf_counter()-start)
+        return conn
+
+    def _fetch_last_recorded_stars(self)->List[Tuple[int,int,float]]:
+        # One bulk read at startup primes the filter for the whole run.
+        conn=self._getconn()
 
         try:
             curr=conn.cursor()
+            curr.execute("""
+                SELECT repository_id, star_count, EXTRACT(EPOCH FROM observed_at)::float8
+                FROM repository_latest_stars
+            """)
+            return curr.fetchall()
+
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
 
-            repo_data=[
-                 (r.db_id, r.owner, r.name, r.full_name, r.created_at, r.updated_at)
-                 for r in repositories
-            ]
+    def _execute_batch(self,curr,repositories:List[RepositoryRecord],star_repositories:List[RepositoryRecord]):
+        repo_data=[r[:STAR_COUNT]+r[STAR_COUNT+1:] for r in repositories]
         
-            execute_batch(curr,"""
-            INSERT INTO repositories(id, owner, name, full_name, created_at, updated_at, last_crawled_at)
-            VALUES (%s,%s, %s, %s, %s, %s, NOW())
+        execute_batch(curr,f"""
+        INSERT INTO repositories(id, owner, name, full_name, created_at, updated_at, node_id, last_crawled_at, changed_at)
+        VALUES (%s,%s, %s, %s, %s, %s, %s, NOW(), NOW())
+        ON CONFLICT (id)
+        DO UPDATE SET
+                      updated_at = EXCLUDED.updated_at,
+                      node_id = COALESCE(EXCLUDED.node_id, repositories.node_id),
+                      last_crawled_at=NOW(),
+                      {CHANGED_AT_UPDATE}
+        """,repo_data,page_size=1000
+        )
+        star_data = [(r[DB_ID], r[STAR_COUNT]) for r in star_repositories]
+        self._mark_star_changes(curr,[r[DB_ID] for r in star_repositories],[r[STAR_COUNT] for r in star_repositories])
+        execute_batch(curr, """
+            INSERT INTO repository_stars (repository_id, star_count, observed_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (repository_id, observed_at) 
+            DO UPDATE SET star_count = EXCLUDED.star_count
+        """, star_data, page_size=1000)
+        execute_batch(curr, """
+            INSERT INTO repository_latest_stars (repository_id, star_count, observed_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (repository_id)
+            DO UPDATE SET star_count = EXCLUDED.star_count, observed_at = EXCLUDED.observed_at
+            WHERE repository_latest_stars.observed_at <= EXCLUDED.observed_at
+        """, star_data, page_size=1000)
+
+    def _mark_star_changes(self,curr,star_ids:List[int],star_counts:List[int]):
+        # Runs before repository_latest_stars takes the new counts, so the comparison is
+        # against the previous observation. New repositories got changed_at on insert.
+        if not star_ids:
+            return
+        curr.execute("""
+            UPDATE repositories r SET changed_at = NOW()
+            FROM unnest(%s::bigint[], %s::int[]) AS s(repository_id, star_count)
+            JOIN repository_latest_stars ls ON ls.repository_id = s.repository_id
+            WHERE r.id = s.repository_id
+              AND ls.star_count <> s.star_count
+              AND r.changed_at IS DISTINCT FROM NOW()
+        """,(star_ids,star_counts))
+
+    def _copy_batch(self,curr,repositories:List[RepositoryRecord],star_repositories:List[RepositoryRecord]):
+        # Stream the batch into a session-local staging table and merge it with one
+        # set-based statement per target table. DISTINCT ON keeps a repo that shows
+        # up twice in a batch from hitting the same row twice in ON CONFLICT.
+        curr.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS staging_repositories(
+                id BIGINT NOT NULL,
+                owner VARCHAR(255) NOT NULL,
+                name VARCHAR(255) NOT NULL,
+                full_name VARCHAR(512) NOT NULL,
+                star_count INTEGER NOT NULL,
+                created_at TIMESTAMPTZ,
+                updated_at TIMESTAMPTZ,
+                node_id VARCHAR(64),
+                record_star BOOLEAN NOT NULL DEFAULT TRUE
+            ) ON COMMIT DELETE ROWS
+        """)
+
+        # Records are already in staging column order, so when every star is recorded
+        # they go to csv as they are.
+        buffer=io.StringIO()
+        writer=csv.writer(buffer)
+        columns="id, owner, name, full_name, star_count, created_at, updated_at, node_id"
+        if star_repositories is repositories:
+            writer.writerows(repositories)
+        else:
+            record_ids={r[DB_ID] for r in star_repositories}
+            writer.writerows(r+('t' if r[DB_ID] in record_ids else 'f',) for r in repositories)
+            columns+=", record_star"
+        buffer.seek(0)
+        curr.copy_expert(f"""
+            COPY staging_repositories({columns})
+            FROM STDIN WITH (FORMAT csv)
+        """,buffer)
+
+        curr.execute(f"""
+            INSERT INTO repositories(id, owner, name, full_name, created_at, updated_at, node_id, last_crawled_at, changed_at)
+            SELECT DISTINCT ON (id) id, owner, name, full_name, created_at, updated_at, node_id, NOW(), NOW()
+            FROM staging_repositories
+            ORDER BY id
             ON CONFLICT (id)
             DO UPDATE SET
                           updated_at = EXCLUDED.updated_at,
-                          last_crawled_at=NOW()
-            """,repo_data,page_size=1000
-            )
-            star_data = [(r.db_id, r.star_count) for r in repositories]
-            execute_batch(curr, """
-                INSERT INTO repository_stars (repository_id, star_count, observed_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (repository_id, observed_at) 
-                DO UPDATE SET star_count = EXCLUDED.star_count
-            """, star_data, page_size=1000)
+                          node_id = COALESCE(EXCLUDED.node_id, repositories.node_id),
+                          last_crawled_at=NOW(),
+                          {CHANGED_AT_UPDATE}
+        """)
+        self._mark_star_changes(curr,[r[DB_ID] for r in star_repositories],[r[STAR_COUNT] for r in star_repositories])
+        curr.execute("""
+            INSERT INTO repository_stars (repository_id, star_count, observed_at)
+            SELECT DISTINCT ON (id) id, star_count, NOW()
+            FROM staging_repositories
+            WHERE record_star
+            ORDER BY id
+            ON CONFLICT (repository_id, observed_at)
+            DO UPDATE SET star_count = EXCLUDED.star_count
+        """)
+        curr.execute("""
+            INSERT INTO repository_latest_stars (repository_id, star_count, observed_at)
+            SELECT DISTINCT ON (id) id, star_count, NOW()
+            FROM staging_repositories
+            WHERE record_star
+            ORDER BY id
+            ON CONFLICT (repository_id)
+            DO UPDATE SET star_count = EXCLUDED.star_count, observed_at = EXCLUDED.observed_at
+            WHERE repository_latest_stars.observed_at <= EXCLUDED.observed_at
+        """)
+
+    def refresh_stars(self,repositories:List[RepositoryRecord],run_id:Optional[int]=None,
+                      progress:Optional[List[ShardProgress]]=None):
+        # Write path for trimmed refresh records: no metadata to merge, so the
+        # repositories row only has last_crawled_at moved and stars go in from arrays.
+        if not repositories:
+            return 0
+
+        star_repositories=self._select_star_observations(repositories)
+        stars={r[DB_ID]:r[STAR_COUNT] for r in star_repositories}
+        star_ids,star_counts=list(stars),list(stars.values())
+
+        conn=self._getconn()
 
+        try:
+            curr=conn.cursor()
+            curr.execute("""
+                UPDATE repositories SET last_crawled_at = NOW() WHERE id = ANY(%s)
+            """,([r[DB_ID] for r in repositories],))
+            if star_ids:
+                self._mark_star_changes(curr,star_ids,star_counts)
+                curr.execute("""
+                    INSERT INTO repository_stars (repository_id, star_count, observed_at)
+                    SELECT repository_id, star_count, NOW()
+                    FROM unnest(%s::bigint[], %s::int[]) AS s(repository_id, star_count)
+                    ON CONFLICT (repository_id, observed_at)
+                    DO UPDATE SET star_count = EXCLUDED.star_count
+                """,(star_ids,star_counts))
+                curr.execute("""
+                    INSERT INTO repository_latest_stars (repository_id, star_count, observed_at)
+                    SELECT repository_id, star_count, NOW()
+                    FROM unnest(%s::bigint[], %s::int[]) AS s(repository_id, star_count)
+                    ON CONFLICT (repository_id)
+                    DO UPDATE SET star_count = EXCLUDED.star_count, observed_at = EXCLUDED.observed_at
+                    WHERE repository_latest_stars.observed_at <= EXCLUDED.observed_at
+                """,(star_ids,star_counts))
             conn.commit()
+            self._mark_recorded(star_repositories)
 
+            metrics.DB_ROWS_WRITTEN.inc(len(repositories))
             return len(repositories)
-        
 
         except Exception as e:
             conn.rollback()
             raise e
-        
+
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
+
+    def record_rest_validation(self,etags:List[Tuple[int,str]],unchanged_ids:List[int]):
+        # A 304 only moves last_crawled_at, so the scheduler stops picking the row without
+        # any star or metadata write.
+        if not etags and not unchanged_ids:
+            return
+
+        conn=self._getconn()
+
+        try:
+            curr=conn.cursor()
+            if etags:
+                execute_batch(curr,"""
+                    UPDATE repositories SET rest_etag = %s WHERE id = %s
+                """,[(etag,repository_id) for repository_id,etag in etags],page_size=1000)
+            if unchanged_ids:
+                curr.execute("""
+                    UPDATE repositories SET last_crawled_at = NOW() WHERE id = ANY(%s)
+                """,(sorted(unchanged_ids),))
+            conn.commit()
+
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
+
+    def delete_repositories(self,repository_ids:List[int])->int:
+        # Star history goes with the row (ON DELETE CASCADE) and the tombstone trigger
+        # keeps the id for the next delta export.
+        if not repository_ids:
+            return 0
+
+        conn=self._getconn()
+
+        try:
+            curr=conn.cursor()
+            curr.execute("DELETE FROM repositories WHERE id = ANY(%s)",(sorted(repository_ids),))
+            deleted=curr.rowcount
+            conn.commit()
+            return deleted
+
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
+
+    def latest_stars(self,chunk_size:int=10_000,limit:Optional[int]=None)->Iterator[List[Tuple]]:
+        conn=self._getconn()
+
+        try:
+            query=EXPORT_QUERY if limit is None else EXPORT_QUERY+" LIMIT %s"
+            yield from stream_rows(conn,query,None if limit is None else (limit,),chunk_size=chunk_size)
+
+        finally:
+            self._pool.putconn(conn)
+
+    def write_csv(self,f:IO[str])->int:
+        # COPY formats the rows on the server, far cheaper than csv.writer per row.
+        conn=self._getconn()
+
+        try:
+            curr=conn.cursor()
+            curr.copy_expert(f"COPY ({EXPORT_QUERY}) TO STDOUT WITH (FORMAT csv, HEADER)",f)
+            return curr.rowcount
+
+        finally:
+            curr.close()
+            self._pool.putconn(conn)
+
+    def export_stats(self)->Tuple:
+        conn=self._getconn()
+
+        try:
+            curr=conn.cursor()
+            return fetch_stats(curr)
+
         finally:
             curr.close()
             self._pool.putconn(conn)
 
-    
     def get_count(self)->int:
-        conn=self._pool.getconn()
+        conn=self._getconn()
 
         try:
             curr=conn.cursor()
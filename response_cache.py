@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+
+class ReplayCacheMiss(Exception):
+    pass
+
+
+class ResponseCache:
+
+    # On-disk GraphQL response cache, one JSON file per (query, variables, scope) key.
+    # Entries expire after ttl_seconds and the least recently used ones are evicted
+    # once the directory grows past max_bytes. In replay mode entries never expire
+    # and a miss raises instead of going to the network, so a recorded crawl can be
+    # re-run offline.
+
+    def __init__(self, directory: str, ttl_seconds: float = 3600, max_bytes: int = 512 * 1024 * 1024,
+                 replay: bool = False, scope: str = ''):
+        self._directory = directory
+        self._ttl_seconds = ttl_seconds
+        self._max_bytes = max_bytes
+        self._replay = replay
+        self._scope = scope
+        self._entries: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+        self._total_bytes = 0
+        self._lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @property
+    def replay(self) -> bool:
+        return self._replay
+
+    def key(self, query: str, variables: Dict) -> str:
+        query_hash = hashlib.sha256(query.encode()).hexdigest()
+        payload = json.dumps([self._scope, query_hash, variables], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, query: str, variables: Dict) -> Optional[Dict]:
+        key = self.key(query, variables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._replay and time.time() - entry[1] > self._ttl_seconds:
+                    self._remove(key)
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+
+        if entry is None:
+            if self._replay:
+                raise ReplayCacheMiss(f"No recorded response for variables {variables}")
+            return None
+
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self._remove(key)
+            return None
+
+    def put(self, query: str, variables: Dict, response: Dict):
+        if self._replay:
+            return
+
+        key = self.key(query, variables)
+        body = json.dumps(response, separators=(',', ':'))
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries[key][0]
+            self._entries[key] = (len(body), time.time())
+            self._entries.move_to_end(key)
+            self._total_bytes += len(body)
+
+            while self._total_bytes > self._max_bytes and len(self._entries) > 1:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, f"{key}.json")
+
+    def _remove(self, key: str):
+        size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _load_index(self):
+        # Modification time stands in for last use across restarts.
+        entries = []
+        for name in os.listdir(self._directory):
+            if not name.endswith('.json'):
+                continue
+            stat = os.stat(os.path.join(self._directory, name))
+            entries.append((stat.st_mtime, name[:-len('.json')], stat.st_size))
+
+        for stored_at, key, size in sorted(entries):
+            self._entries[key] = (size, stored_at)
+            self._total_bytes += size
@@ -0,0 +1,138 @@
+import asyncio
+import time
+from threading import Condition, Event
+from typing import Dict, List, Optional
+
+from github_client import DEFAULT_SEARCH_QUERY
+
+
+class _PendingSearch:
+
+    def __init__(self, search_query: str, cursor: Optional[str], per_page: int):
+        self.search_query = search_query
+        self.cursor = cursor
+        self.per_page = per_page
+        self.queued_at = time.monotonic()
+        self.taken = False
+        self.result: Optional[Dict] = None
+        self.done = Event()
+
+
+def _take(waiting: List, max_batch: int, per_page) -> List:
+    batch = [search for search in waiting if search.per_page == per_page][:max_batch]
+    for search in batch:
+        waiting.remove(search)
+    return batch
+
+
+class SearchBatcher:
+
+    # Drop-in for the client's fetch_repositories. Each shard still fetches its pages
+    # one at a time, but concurrent fetches are gathered into one multi-search request
+    # of up to max_batch pages. A partial batch goes out once its oldest search has
+    # waited `linger` seconds. The thread that completes a batch sends it and the
+    # others wait for their slot of the response.
+
+    def __init__(self, client, max_batch: int = 4, linger: float = 0.025):
+        self._client = client
+        self._max_batch = max_batch
+        self._linger = linger
+        self._waiting: List[_PendingSearch] = []
+        self._cond = Condition()
+
+    def fetch_repositories(self, cursor: Optional[str] = None, per_page: int = 100,
+                           search_query: str = DEFAULT_SEARCH_QUERY) -> Optional[Dict]:
+        search = _PendingSearch(search_query, cursor, per_page)
+        with self._cond:
+            self._waiting.append(search)
+            self._cond.notify_all()
+
+        while True:
+            batch = self._next_batch(search)
+            if not batch:
+                break
+            self._send(batch)
+
+        search.done.wait()
+        return search.result
+
+    def _next_batch(self, search: _PendingSearch) -> List[_PendingSearch]:
+        # Returns a batch for this thread to send, or nothing once its own search has
+        # been taken by another thread.
+        with self._cond:
+            while not search.taken:
+                oldest = self._waiting[0]
+                wait_time = oldest.queued_at + self._linger - time.monotonic()
+                if len(self._waiting) >= self._max_batch or wait_time <= 0:
+                    batch = _take(self._waiting, self._max_batch, oldest.per_page)
+                    for taken in batch:
+                        taken.taken = True
+                    self._cond.notify_all()
+                    return batch
+                self._cond.wait(wait_time)
+            return []
+
+    def _send(self, batch: List[_PendingSearch]):
+        try:
+            results = self._client.fetch_repositories_batch(
+                [(search.search_query, search.cursor) for search in batch], batch[0].per_page)
+        except Exception as e:
+            print(f"Error fetching {len(batch)} search pages: {e}")
+            results = [None] * len(batch)
+
+        for search, result in zip(batch, results):
+            search.result = result
+            search.done.set()
+
+
+class AsyncSearchBatcher:
+
+    # The same gathering for the async engine: fetches queue up until max_batch are
+    # waiting or the oldest has waited `linger` seconds, then go out as one task.
+
+    def __init__(self, client, max_batch: int = 4, linger: float = 0.025):
+        self._client = client
+        self._max_batch = max_batch
+        self._linger = linger
+        self._waiting: List[_PendingSearch] = []
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def fetch_repositories(self, cursor: Optional[str] = None, per_page: int = 100,
+                                 search_query: str = DEFAULT_SEARCH_QUERY) -> Optional[Dict]:
+        loop = asyncio.get_running_loop()
+        search = _PendingSearch(search_query, cursor, per_page)
+        future = loop.create_future()
+        self._futures[id(search)] = future
+        self._waiting.append(search)
+
+        if len(self._waiting) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._waiting:
+            batch = _take(self._waiting, self._max_batch, self._waiting[0].per_page)
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[_PendingSearch]):
+        try:
+            results = await self._client.fetch_repositories_batch(
+                [(search.search_query, search.cursor) for search in batch], batch[0].per_page)
+        except Exception as e:
+            print(f"Error fetching {len(batch)} search pages: {e}")
+            results = [None] * len(batch)
+
+        for search, result in zip(batch, results):
+            future = self._futures.pop(id(search))
+            if not future.done():
+                future.set_result(result)
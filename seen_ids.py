@@ -0,0 +1,152 @@
+import math
+from abc import ABC, abstractmethod
+from array import array
+from threading import Lock
+from typing import List, Optional
+
+import metrics
+from models import DB_ID, RepositoryRecord
+
+
+SEEN_MODES = ('exact', 'bloom', 'off')
+
+_MASK64 = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _mix(value: int) -> int:
+    # splitmix64 finalizer; database ids are dense, so they need scrambling before
+    # their bits are used as table positions.
+    value = (value + _GOLDEN) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+class SeenIds(ABC):
+
+    # Per-run record of which repositories were already queued for writing. Pages from
+    # overlapping shards, or repos that move between shards while the crawl runs,
+    # are dropped here so they never reach the writers or the crawl totals.
+
+    def __init__(self):
+        self._lock = Lock()
+        self.duplicates = 0
+
+    def filter(self, repositories: List[RepositoryRecord]) -> List[RepositoryRecord]:
+        with self._lock:
+            fresh = [r for r in repositories if self._add(r[DB_ID])]
+            dropped = len(repositories) - len(fresh)
+            self.duplicates += dropped
+        if dropped:
+            metrics.CRAWL_DUPLICATES.inc(dropped)
+        return fresh
+
+    @abstractmethod
+    def _add(self, repository_id: int) -> bool:
+        # True when the id was not seen before.
+        ...
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        ...
+
+
+class ExactSeenIds(SeenIds):
+
+    # Open-addressing hash set over an int64 array with linear probing. A slot is 8
+    # bytes and the table stays at most half full, so ~16 bytes per id against ~60 for
+    # a Python set of ints.
+
+    _EMPTY = -1
+
+    def __init__(self, expected_items: int = 100_000):
+        super().__init__()
+        capacity = 1 << max(10, (2 * max(expected_items, 1) - 1).bit_length())
+        self._slots = array('q', [self._EMPTY]) * capacity
+        self._shift = 64 - (capacity.bit_length() - 1)
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._slots) * self._slots.itemsize
+
+    def _add(self, repository_id: int) -> bool:
+        slots = self._slots
+        mask = len(slots) - 1
+        index = _mix(repository_id) >> self._shift
+        while True:
+            current = slots[index]
+            if current == repository_id:
+                return False
+            if current == self._EMPTY:
+                break
+            index = (index + 1) & mask
+
+        slots[index] = repository_id
+        self._count += 1
+        if self._count * 2 > len(slots):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array('q', [self._EMPTY]) * (len(old) * 2)
+        self._shift -= 1
+        mask = len(self._slots) - 1
+        for repository_id in old:
+            if repository_id == self._EMPTY:
+                continue
+            index = _mix(repository_id) >> self._shift
+            while self._slots[index] != self._EMPTY:
+                index = (index + 1) & mask
+            self._slots[index] = repository_id
+
+
+class BloomSeenIds(SeenIds):
+
+    # Fixed-size Bloom filter for runs too large for the exact set: ~1.8 bytes per
+    # expected id at a 0.1% false-positive rate. A false positive drops a repository
+    # that was not actually seen, so that fraction of distinct repos is skipped for the
+    # run; the rate climbs once more than expected_items ids have been added.
+
+    def __init__(self, expected_items: int = 1_000_000, false_positive_rate: float = 0.001):
+        super().__init__()
+        expected_items = max(expected_items, 1)
+        bit_count = max(64, int(math.ceil(-expected_items * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self._bit_count = bit_count
+        self._hash_count = max(1, round(bit_count / expected_items * math.log(2)))
+        self._bits = bytearray((bit_count + 7) // 8)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def _add(self, repository_id: int) -> bool:
+        # Double hashing: k positions from the two halves of one 64-bit mix.
+        mixed = _mix(repository_id)
+        first, second = mixed & 0xFFFFFFFF, (mixed >> 32) | 1
+        bits = self._bits
+        new = False
+        for i in range(self._hash_count):
+            position = (first + i * second) % self._bit_count
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+        return new
+
+
+def make_seen_ids(mode: str = 'exact', expected_items: int = 100_000,
+                  false_positive_rate: float = 0.001) -> Optional[SeenIds]:
+    if mode not in SEEN_MODES:
+        raise ValueError(f"Unknown dedup mode '{mode}', expected one of {', '.join(SEEN_MODES)}")
+    if mode == 'exact':
+        return ExactSeenIds(expected_items)
+    if mode == 'bloom':
+        return BloomSeenIds(expected_items, false_positive_rate)
+    return None
@@ -0,0 +1,128 @@
+from datetime import date, timedelta
+from typing import Generator, List, Optional, Tuple
+
+
+SEARCH_RESULT_CAP = 1000
+GITHUB_EPOCH = date(2007, 10, 1)
+
+
+class QueryShard:
+
+    __slots__ = ('min_stars', 'max_stars', 'created_from', 'created_to', 'expected_count')
+
+    def __init__(self, min_stars: int, max_stars: int,
+                 created_from: Optional[date] = None, created_to: Optional[date] = None,
+                 expected_count: int = 0):
+        self.min_stars = min_stars
+        self.max_stars = max_stars
+        self.created_from = created_from
+        self.created_to = created_to
+        self.expected_count = expected_count
+
+    @property
+    def key(self) -> str:
+        key = f"stars:{self.min_stars}..{self.max_stars}"
+        if self.created_from or self.created_to:
+            created_from = (self.created_from or GITHUB_EPOCH).isoformat()
+            created_to = (self.created_to or date.today()).isoformat()
+            key += f" created:{created_from}..{created_to}"
+        return key
+
+    @property
+    def search_query(self) -> str:
+        return f"{self.key} sort:stars-desc"
+
+    def split(self) -> List['QueryShard']:
+        # Star ranges are split geometrically since the distribution is heavy-tailed,
+        # children are returned highest-stars first.
+        if self.min_stars < self.max_stars:
+            mid = max(self.min_stars, min(int((self.min_stars * self.max_stars) ** 0.5), self.max_stars - 1))
+            return [
+                QueryShard(mid + 1, self.max_stars, self.created_from, self.created_to),
+                QueryShard(self.min_stars, mid, self.created_from, self.created_to),
+            ]
+
+        created_from = self.created_from or GITHUB_EPOCH
+        created_to = self.created_to or date.today()
+        if created_from >= created_to:
+            return []
+
+        mid = created_from + (created_to - created_from) // 2
+        return [
+            QueryShard(self.min_stars, self.max_stars, mid + timedelta(days=1), created_to),
+            QueryShard(self.min_stars, self.max_stars, created_from, mid),
+        ]
+
+    def __repr__(self) -> str:
+        return f"QueryShard({self.key!r}, expected={self.expected_count})"
+
+
+class ShardPlanner:
+
+    def __init__(self, api_client, min_stars: int = 2, result_cap: int = SEARCH_RESULT_CAP):
+        self._api_client = api_client
+        self._min_stars = min_stars
+        self._result_cap = result_cap
+
+    def plan(self, target_count: int) -> List[QueryShard]:
+        steps = self._plan_steps(target_count)
+        search_query = next(steps)
+        try:
+            while True:
+                search_query = steps.send(self._api_client.search_stats(search_query))
+        except StopIteration as done:
+            return done.value
+
+    async def plan_async(self, target_count: int) -> List[QueryShard]:
+        steps = self._plan_steps(target_count)
+        search_query = next(steps)
+        try:
+            while True:
+                search_query = steps.send(await self._api_client.search_stats(search_query))
+        except StopIteration as done:
+            return done.value
+
+    def _plan_steps(self, target_count: int) -> Generator[str, Optional[Tuple[int, Optional[int]]], List[QueryShard]]:
+        # Yields search queries and receives their (repositoryCount, top stars) so the
+        # same planning loop can be driven by the sync and async clients.
+
+        stats = yield f"stars:>={self._min_stars} sort:stars-desc"
+        if not stats:
+            raise Exception("Unable to determine star range for shard planning")
+
+        _, top_stars = stats
+        if not top_stars or top_stars < self._min_stars:
+            return []
+
+        pending = [QueryShard(self._min_stars, top_stars)]
+        planned = []
+        total = 0
+
+        # Depth-first from the highest star range down, so planning stops as soon as
+        # the accepted shards cover the target.
+        while pending and total < target_count:
+            shard = pending.pop()
+
+            stats = yield shard.search_query
+            if not stats:
+                print(f"Warning: Could not count shard {shard.key}, skipping")
+                continue
+
+            count, _ = stats
+            if count == 0:
+                continue
+
+            if count > self._result_cap:
+                children = shard.split()
+                if children:
+                    pending.extend(reversed(children))
+                    continue
+                print(f"Warning: Shard {shard.key} has {count:,} results and cannot be split further, "
+                      f"only the first {self._result_cap:,} are reachable")
+
+            shard.expected_count = min(count, self._result_cap)
+            planned.append(shard)
+            total += shard.expected_count
+
+        print(f"Planned {len(planned)} shards covering ~{total:,} repositories")
+        return planned
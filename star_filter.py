@@ -0,0 +1,44 @@
+import time
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from models import DB_ID, STAR_COUNT, RepositoryRecord
+
+
+class StarObservationFilter:
+
+    # Remembers the last recorded star count per repository so unchanged counts can be
+    # skipped without a read per write. Observations are still recorded once the
+    # heartbeat interval has passed, so every repo keeps a recent data point.
+
+    def __init__(self, heartbeat_seconds: float = 24 * 3600):
+        self._heartbeat_seconds = heartbeat_seconds
+        self._last_recorded: Dict[int, Tuple[int, float]] = {}
+        self._loaded = False
+        self._lock = Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self, observations: Iterable[Tuple[int, int, float]]):
+        with self._lock:
+            for repository_id, star_count, observed_at in observations:
+                self._last_recorded[repository_id] = (star_count, observed_at)
+            self._loaded = True
+
+    def select(self, repositories: List[RepositoryRecord], now: Optional[float] = None) -> List[RepositoryRecord]:
+        now = now or time.time()
+        changed = []
+        with self._lock:
+            for repo in repositories:
+                last = self._last_recorded.get(repo[DB_ID])
+                if last is None or last[0] != repo[STAR_COUNT] or now - last[1] >= self._heartbeat_seconds:
+                    changed.append(repo)
+        return changed
+
+    def mark_recorded(self, repositories: List[RepositoryRecord], now: Optional[float] = None):
+        now = now or time.time()
+        with self._lock:
+            for repo in repositories:
+                self._last_recorded[repo[DB_ID]] = (repo[STAR_COUNT], now)
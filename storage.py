@@ -0,0 +1,148 @@
+import csv
+import os
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import IO, Iterator, List, Optional, Tuple
+
+from checkpoints import ShardProgress
+from models import RepositoryRecord
+from star_filter import StarObservationFilter
+
+
+STAR_WRITE_MODES = ('all', 'changed')
+STORAGE_BACKENDS = ('postgres', 'sqlite')
+
+EXPORT_COLUMNS = ['id', 'full_name', 'owner', 'name', 'star_count',
+                  'created_at', 'updated_at', 'last_star_count_at']
+
+EXPORT_QUERY = """
+        SELECT
+            r.id,
+            r.full_name,
+            r.owner,
+            r.name,
+            rs.star_count,
+            r.created_at,
+            r.updated_at,
+            rs.observed_at as last_star_count_at
+        FROM repository_latest_stars rs
+        JOIN repositories r ON r.id = rs.repository_id
+        ORDER BY rs.star_count DESC
+"""
+
+CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', '10000'))
+
+
+def stream_rows(conn, query, params=None, chunk_size=CHUNK_SIZE):
+    # Named cursors stay on the server, so only one chunk is ever held in memory.
+    cur = conn.cursor(name='export_stream')
+    cur.itersize = chunk_size
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+
+
+def fetch_stats(cur):
+    cur.execute("""
+        SELECT
+            COUNT(*) as total_repos,
+            SUM(star_count) as total_stars,
+            AVG(star_count) as avg_stars,
+            MAX(star_count) as max_stars,
+            MIN(star_count) as min_stars
+        FROM repository_latest_stars
+    """)
+    return cur.fetchone()
+
+
+class RepositoryStore(ABC):
+
+    # What the crawler, refresher and exporter need from storage. RepositoryRepository
+    # is the Postgres implementation; SQLiteRepositoryStore (local_store.py) keeps a
+    # single-node crawl in a local file that is synced to Postgres afterwards.
+    #
+    # Export rows are EXPORT_COLUMNS ordered by star_count descending, as EXPORT_QUERY
+    # reads them from Postgres.
+
+    def __init__(self, star_write_mode: str = 'all', star_heartbeat_seconds: float = 24 * 3600):
+        if star_write_mode not in STAR_WRITE_MODES:
+            raise ValueError(f"Unknown star write mode '{star_write_mode}', expected one of {', '.join(STAR_WRITE_MODES)}")
+        self._star_filter = StarObservationFilter(star_heartbeat_seconds) if star_write_mode == 'changed' else None
+        self._star_filter_lock = Lock()
+
+    @property
+    @abstractmethod
+    def max_connections(self) -> int:
+        ...
+
+    @abstractmethod
+    def upsert_batch(self, repositories: List[RepositoryRecord], run_id: Optional[int] = None,
+                     progress: Optional[List[ShardProgress]] = None) -> int:
+        ...
+
+    @abstractmethod
+    def refresh_stars(self, repositories: List[RepositoryRecord], run_id: Optional[int] = None,
+                      progress: Optional[List[ShardProgress]] = None) -> int:
+        ...
+
+    @abstractmethod
+    def record_rest_validation(self, etags: List[Tuple[int, str]], unchanged_ids: List[int]):
+        ...
+
+    @abstractmethod
+    def delete_repositories(self, repository_ids: List[int]) -> int:
+        # Repositories GitHub no longer serves. Returns how many rows were removed.
+        ...
+
+    @abstractmethod
+    def latest_stars(self, chunk_size: int = 10_000, limit: Optional[int] = None) -> Iterator[List[Tuple]]:
+        ...
+
+    def write_csv(self, f: IO[str]) -> int:
+        # Writes the export rows with a header line and returns how many were written.
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        count = 0
+        for rows in self.latest_stars():
+            writer.writerows(rows)
+            count += len(rows)
+        return count
+
+    @abstractmethod
+    def export_stats(self) -> Tuple:
+        # (total repos, total stars, average, max, min) over the latest counts.
+        ...
+
+    @abstractmethod
+    def get_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    def _select_star_observations(self, repositories: List[RepositoryRecord]) -> List[RepositoryRecord]:
+        if not self._star_filter:
+            return repositories
+
+        if not self._star_filter.loaded:
+            with self._star_filter_lock:
+                if not self._star_filter.loaded:
+                    self._star_filter.load(self._fetch_last_recorded_stars())
+
+        return self._star_filter.select(repositories)
+
+    def _mark_recorded(self, star_repositories: List[RepositoryRecord]):
+        if self._star_filter:
+            self._star_filter.mark_recorded(star_repositories)
+
+    @abstractmethod
+    def _fetch_last_recorded_stars(self) -> List[Tuple[int, int, float]]:
+        # (repository_id, star_count, observed_at epoch seconds) per repository.
+        ...
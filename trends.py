@@ -0,0 +1,246 @@
+import os
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import db
+import partitions
+
+
+TREND_ORDERS = {
+    'stars': 'stars_7d',
+    'growth': 'growth_7d',
+    'score': 'trend_score',
+}
+
+# Writers stamp observations with their transaction start time, so a batch can commit
+# a little after rows with later timestamps. Each update re-reads this much history
+# before the watermark; daily rows are recomputed, not added to, so the overlap is harmless.
+WATERMARK_OVERLAP_SECONDS = 600
+
+
+def create_trend_tables(curr):
+    # Trend windows read the daily rollup that partition retention also keeps (see
+    # partitions.py), so a question about the last month reads at most ~30 rows per
+    # repository however often it is crawled.
+    partitions.create_rollup_tables(curr)
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS repository_trends(
+                 repository_id BIGINT PRIMARY KEY REFERENCES repositories(id) ON DELETE CASCADE,
+                 day DATE NOT NULL,
+                 star_count INTEGER NOT NULL,
+                 stars_1d INTEGER NOT NULL,
+                 stars_7d INTEGER NOT NULL,
+                 stars_30d INTEGER NOT NULL,
+                 growth_7d DOUBLE PRECISION NOT NULL,
+                 trend_score DOUBLE PRECISION NOT NULL,
+                 tracked_days INTEGER NOT NULL,
+                 computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                 );
+""")
+    for column in ('stars_1d', 'stars_7d', 'stars_30d', 'growth_7d', 'trend_score'):
+        curr.execute(f"""
+    CREATE INDEX IF NOT EXISTS idx_trends_{column} ON repository_trends({column} DESC) INCLUDE (repository_id);
+""")
+    curr.execute("""
+    CREATE TABLE IF NOT EXISTS trend_watermarks(
+                 name VARCHAR(64) PRIMARY KEY,
+                 processed_through TIMESTAMPTZ NOT NULL,
+                 updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                 );
+""")
+
+
+def update_trends() -> Tuple[int, int]:
+    # Recomputes the daily rollup rows that star observations newer than the watermark
+    # fall on, then the summary row of every repository that got a new observation.
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        create_trend_tables(curr)
+
+        curr.execute("SELECT processed_through FROM trend_watermarks WHERE name = 'repository_stars'")
+        row = curr.fetchone()
+        since = "-infinity" if row is None else row[0]
+
+        curr.execute("""
+            CREATE TEMP TABLE trend_observations ON COMMIT DROP AS
+            SELECT repository_id, star_count, observed_at
+            FROM repository_stars
+            WHERE observed_at > %s::timestamptz - make_interval(secs => %s)
+        """, (since, WATERMARK_OVERLAP_SECONDS if row else 0))
+        curr.execute("SELECT MAX(observed_at) FROM trend_observations")
+        processed_through = curr.fetchone()[0]
+        if processed_through is None:
+            conn.rollback()
+            print("No new star observations for trends")
+            return 0, 0
+
+        curr.execute("""
+            INSERT INTO repository_stars_daily(
+                repository_id, day, min_star_count, max_star_count, last_star_count, observation_count)
+            SELECT
+                s.repository_id,
+                t.day,
+                MIN(s.star_count),
+                MAX(s.star_count),
+                (ARRAY_AGG(s.star_count ORDER BY s.observed_at DESC))[1],
+                COUNT(*)
+            FROM (
+                SELECT DISTINCT repository_id, (observed_at AT TIME ZONE 'UTC')::date AS day
+                FROM trend_observations
+            ) t
+            JOIN repository_stars s
+              ON s.repository_id = t.repository_id
+             AND s.observed_at >= t.day::timestamp AT TIME ZONE 'UTC'
+             AND s.observed_at < (t.day + 1)::timestamp AT TIME ZONE 'UTC'
+            GROUP BY s.repository_id, t.day
+            ON CONFLICT (repository_id, day) DO UPDATE SET
+                min_star_count = EXCLUDED.min_star_count,
+                max_star_count = EXCLUDED.max_star_count,
+                last_star_count = EXCLUDED.last_star_count,
+                observation_count = EXCLUDED.observation_count
+        """)
+        days_written = curr.rowcount
+
+        # Each window compares the latest close with the last close at least that many
+        # days older. A repository tracked for less than the window is measured from
+        # its first close instead, and tracked_days says how much history that was.
+        curr.execute("""
+            INSERT INTO repository_trends(
+                repository_id, day, star_count, stars_1d, stars_7d, stars_30d,
+                growth_7d, trend_score, tracked_days, computed_at)
+            SELECT
+                a.repository_id,
+                cur.day,
+                cur.star_count,
+                cur.star_count - COALESCE(b1.star_count, first.star_count),
+                cur.star_count - COALESCE(b7.star_count, first.star_count),
+                cur.star_count - COALESCE(b30.star_count, first.star_count),
+                (cur.star_count - COALESCE(b7.star_count, first.star_count))::float8
+                    / GREATEST(COALESCE(b7.star_count, first.star_count), 1),
+                -- Weekly gain damped by size, so a 50-star repo gaining 500 ranks above
+                -- a 200k-star repo gaining 600.
+                (cur.star_count - COALESCE(b7.star_count, first.star_count))::float8
+                    / SQRT(GREATEST(COALESCE(b7.star_count, first.star_count), 1) + 100),
+                cur.day - first.day,
+                NOW()
+            FROM (SELECT DISTINCT repository_id FROM trend_observations) a
+            CROSS JOIN LATERAL (
+                SELECT day, last_star_count AS star_count FROM repository_stars_daily d
+                WHERE d.repository_id = a.repository_id
+                ORDER BY day DESC LIMIT 1
+            ) cur
+            CROSS JOIN LATERAL (
+                SELECT day, last_star_count AS star_count FROM repository_stars_daily d
+                WHERE d.repository_id = a.repository_id AND d.day >= cur.day - 30
+                ORDER BY day LIMIT 1
+            ) first
+            LEFT JOIN LATERAL (
+                SELECT last_star_count AS star_count FROM repository_stars_daily d
+                WHERE d.repository_id = a.repository_id AND d.day <= cur.day - 1
+                ORDER BY day DESC LIMIT 1
+            ) b1 ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT last_star_count AS star_count FROM repository_stars_daily d
+                WHERE d.repository_id = a.repository_id AND d.day <= cur.day - 7
+                ORDER BY day DESC LIMIT 1
+            ) b7 ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT last_star_count AS star_count FROM repository_stars_daily d
+                WHERE d.repository_id = a.repository_id AND d.day <= cur.day - 30
+                ORDER BY day DESC LIMIT 1
+            ) b30 ON TRUE
+            ON CONFLICT (repository_id) DO UPDATE SET
+                day = EXCLUDED.day,
+                star_count = EXCLUDED.star_count,
+                stars_1d = EXCLUDED.stars_1d,
+                stars_7d = EXCLUDED.stars_7d,
+                stars_30d = EXCLUDED.stars_30d,
+                growth_7d = EXCLUDED.growth_7d,
+                trend_score = EXCLUDED.trend_score,
+                tracked_days = EXCLUDED.tracked_days,
+                computed_at = EXCLUDED.computed_at
+        """)
+        trends_written = curr.rowcount
+
+        curr.execute("""
+            INSERT INTO trend_watermarks(name, processed_through, updated_at)
+            VALUES ('repository_stars', %s, NOW())
+            ON CONFLICT (name) DO UPDATE SET
+                processed_through = GREATEST(trend_watermarks.processed_through, EXCLUDED.processed_through),
+                updated_at = NOW()
+        """, (processed_through,))
+        conn.commit()
+        curr.close()
+
+        print(f"Trends updated: {days_written:,} daily closes, {trends_written:,} repositories")
+        return days_written, trends_written
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+
+def trending(order: str = 'score', limit: int = 100, min_stars: int = 0, max_age_days: int = 1) -> List[Dict]:
+    # Summary rows only move when a repository gets a new observation, so ones that
+    # dropped out of the crawl are left out once their day is older than max_age_days.
+    if order not in TREND_ORDERS:
+        raise ValueError(f"Unknown trend order '{order}', expected one of {', '.join(TREND_ORDERS)}")
+
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        curr.execute(f"""
+            SELECT r.full_name, t.star_count, t.stars_1d, t.stars_7d, t.stars_30d,
+                   t.growth_7d, t.trend_score, t.tracked_days, t.day
+            FROM repository_trends t
+            JOIN repositories r ON r.id = t.repository_id
+            WHERE t.star_count >= %s
+              AND t.day >= (NOW() AT TIME ZONE 'UTC')::date - %s
+            ORDER BY t.{TREND_ORDERS[order]} DESC
+            LIMIT %s
+        """, (min_stars, max_age_days, limit))
+        columns = [column.name for column in curr.description]
+        return [dict(zip(columns, row)) for row in curr.fetchall()]
+
+    finally:
+        conn.close()
+
+
+def star_deltas(repository_id: int, days: int = 30, period: str = 'day') -> List[Tuple[date, int, Optional[int]]]:
+    # (period start, closing stars, change from the previous period) for one repository.
+    if period not in ('day', 'week'):
+        raise ValueError(f"Unknown period '{period}', expected 'day' or 'week'")
+
+    conn = db.get_connection()
+
+    try:
+        curr = conn.cursor()
+        curr.execute("""
+            SELECT period, star_count, star_count - LAG(star_count) OVER (ORDER BY period)
+            FROM (
+                SELECT DISTINCT ON (DATE_TRUNC(%(period)s, day))
+                    DATE_TRUNC(%(period)s, day)::date AS period, last_star_count AS star_count
+                FROM repository_stars_daily
+                WHERE repository_id = %(repository_id)s
+                  AND day >= (NOW() AT TIME ZONE 'UTC')::date - %(days)s
+                ORDER BY DATE_TRUNC(%(period)s, day), day DESC
+            ) closes
+            ORDER BY period
+        """, {'period': period, 'repository_id': repository_id, 'days': days})
+        return curr.fetchall()
+
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    update_trends()
+    for row in trending(limit=int(os.environ.get('TRENDS_TOP', '20')),
+                        max_age_days=int(os.environ.get('TRENDS_MAX_AGE_DAYS', '1'))):
+        print(f"{row['full_name']:<60}{row['star_count']:>10,}{row['stars_7d']:>+10,}{row['growth_7d']:>9.1%}")
@@ -0,0 +1,180 @@
+import time
+import zlib
+from itertools import count
+from operator import itemgetter
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional
+
+import metrics
+from checkpoints import ShardProgress
+from models import DB_ID, RepositoryRecord
+from storage import RepositoryStore
+
+
+class AdaptiveBatchSize:
+
+    # AIMD on commit latency: grow the flush size while commits come in under target,
+    # halve it as soon as one doesn't.
+
+    def __init__(self, initial: int = 500, minimum: int = 100, maximum: int = 5000,
+                 target_latency: float = 0.5, step: int = 100):
+        self._minimum = minimum
+        self._maximum = maximum
+        self._target_latency = target_latency
+        self._step = step
+        self.value = max(minimum, min(initial, maximum))
+
+    def observe(self, rows: int, latency: float):
+        if latency > self._target_latency:
+            self.value = max(self._minimum, self.value // 2)
+        elif rows >= self.value:
+            self.value = min(self._maximum, self.value + self._step)
+
+
+class WriterStats:
+
+    __slots__ = ('flushes', 'rows', 'commit_seconds', 'last_latency')
+
+    def __init__(self):
+        self.flushes = 0
+        self.rows = 0
+        self.commit_seconds = 0.0
+        self.last_latency = 0.0
+
+
+class WritePipeline:
+
+    # N writer threads, each with its own bounded queue. Pages from one shard always go
+    # to the same writer so its checkpoint cursor only ever moves forward; pages without
+    # a shard are spread round-robin. A full queue blocks put(), which is what slows the
+    # fetchers down when the database falls behind.
+
+    def __init__(self, repository: RepositoryStore, run_id: Optional[int] = None, writers: int = 4,
+                 queue_size: int = 64, flush_interval: float = 2.0, initial_batch: int = 500,
+                 min_batch: int = 100, max_batch: int = 5000, target_latency: float = 0.5,
+                 write: Optional[Callable] = None):
+        # ThreadedConnectionPool raises rather than blocks when exhausted, so never run
+        # more writers than it has connections.
+        writers = max(1, min(writers, repository.max_connections))
+        self._repository = repository
+        self._write = write or repository.upsert_batch
+        self._run_id = run_id
+        self._flush_interval = flush_interval
+        self._queues = [Queue(maxsize=queue_size) for _ in range(writers)]
+        self._batch_sizes = [AdaptiveBatchSize(initial_batch, min_batch, max_batch, target_latency)
+                             for _ in range(writers)]
+        self._stats = [WriterStats() for _ in range(writers)]
+        self._round_robin = count()
+        self._error = None
+        self._error_lock = Lock()
+        self._threads = [Thread(target=self._run_writer, args=(index,), daemon=True) for index in range(writers)]
+
+    @property
+    def error(self) -> Optional[Exception]:
+        return self._error
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    @property
+    def batch_sizes(self) -> List[int]:
+        return [batch_size.value for batch_size in self._batch_sizes]
+
+    @property
+    def stats(self) -> List[WriterStats]:
+        return self._stats
+
+    def start(self) -> 'WritePipeline':
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def put(self, records: List[RepositoryRecord], progress: Optional[ShardProgress] = None):
+        if progress:
+            index = zlib.crc32(progress.shard_key.encode()) % len(self._queues)
+        else:
+            index = next(self._round_robin) % len(self._queues)
+        self._queues[index].put((records, progress))
+
+    def close(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run_writer(self, index: int):
+
+        q = self._queues[index]
+        batch_size = self._batch_sizes[index]
+        buffer = []
+        progress = {}
+        deadline = None
+
+        while True:
+            timeout = max(0.0, deadline - time.monotonic()) if deadline else None
+            try:
+                item = q.get(timeout=timeout)
+            except Empty:
+                # Time-based flush, rows don't wait on a slow fetch period to fill a batch.
+                self._flush(index, buffer, progress)
+                buffer, progress, deadline = [], {}, None
+                continue
+
+            if item is None:
+                if buffer or progress:
+                    self._flush(index, buffer, progress)
+                break
+
+            if self._error:
+                # Keep draining so fetchers never block on a dead writer.
+                continue
+
+            records, shard_progress = item
+            buffer.extend(records)
+
+            if shard_progress:
+                existing = progress.get(shard_progress.shard_key)
+                if existing:
+                    existing.cursor = shard_progress.cursor or existing.cursor
+                    existing.row_count += shard_progress.row_count
+                    existing.done = existing.done or shard_progress.done
+                else:
+                    progress[shard_progress.shard_key] = shard_progress
+
+            if deadline is None:
+                deadline = time.monotonic() + self._flush_interval
+
+            if len(buffer) >= batch_size.value:
+                self._flush(index, buffer, progress)
+                buffer, progress, deadline = [], {}, None
+
+    def _flush(self, index: int, buffer: List[RepositoryRecord], progress: Dict[str, ShardProgress]):
+        if self._error or not (buffer or progress):
+            return
+
+        # Writers upsert in id order (and update checkpoints in key order) so two
+        # concurrent transactions never take row locks in opposite orders.
+        buffer.sort(key=itemgetter(DB_ID))
+        progress_list = [progress[key] for key in sorted(progress)]
+
+        start = time.monotonic()
+        try:
+            self._write(buffer, self._run_id, progress_list)
+        except Exception as e:
+            with self._error_lock:
+                self._error = self._error or e
+            print(f"Writer {index} error: {e}")
+            return
+        latency = time.monotonic() - start
+
+        self._batch_sizes[index].observe(len(buffer), latency)
+        metrics.WRITER_FLUSH_SECONDS.observe(latency, writer=index)
+        metrics.WRITER_FLUSH_ROWS.observe(len(buffer), writer=index)
+        metrics.WRITER_BATCH_SIZE.set(self._batch_sizes[index].value, writer=index)
+        stats = self._stats[index]
+        stats.flushes += 1
+        stats.rows += len(buffer)
+        stats.commit_seconds += latency
+        stats.last_latency = latency